@@ -0,0 +1,294 @@
+import datetime
+import random
+import time
+import tracemalloc
+
+import numpy as np
+
+from backend.algorithm.common import PROTEIN, VEGETABLE, GRAINS
+from backend.algorithm.integration import portion_optimizer, meal_item_selector, PORTION_ENGINES, ANNEALING
+from backend.algorithm.portion import MealItemSpec, PlateSectionState, SimulatedAnnealing, DEFAULT_COEFFICIENTS, \
+    SCHEDULE_GEOMETRIC, SCHEDULE_ADAPTIVE
+from backend.algorithm.requirements import StudentProfileSpec, nutritional_info_for, ACTIVITY_LEVEL_COEFF, SEX_COEFF, \
+    MACROS_COEFF
+
+# Bump this whenever the benchmarks (or the synthetic data) change, so that results of different versions aren't
+# compared
+BENCHMARK_VERSION = 1
+
+PERCENTILES = (50, 90, 99)
+
+# Size of the large and small plate sections, in mL
+LARGE_PORTION_MAX = 610
+SMALL_PORTION_MAX = 270
+
+
+def synthetic_profiles(rng: random.Random, count: int) -> list[StudentProfileSpec]:
+    """
+    @param rng: Random number generator, seeded for reproducible profiles
+    @param count: Number of profiles
+    @return: Random student profiles, cycling through every health goal
+    """
+    health_goals = sorted(MACROS_COEFF)
+    return [StudentProfileSpec(height=rng.uniform(150, 200),
+                               weight=rng.uniform(45, 110),
+                               birthdate=datetime.date(2003, 11, 24) - datetime.timedelta(days=rng.randint(0, 3650)),
+                               meals=['breakfast', 'lunch', 'dinner'],
+                               meal_length=30,
+                               sex=rng.choice(sorted(SEX_COEFF)),
+                               health_goal=health_goals[i % len(health_goals)],
+                               activity_level=rng.choice(sorted(ACTIVITY_LEVEL_COEFF)))
+            for i in range(count)]
+
+
+def synthetic_item(rng: random.Random, item_id: int, category: str) -> MealItemSpec:
+    """
+    @param rng: Random number generator, seeded for reproducible items
+    @param item_id: ID of the item
+    @param category: Category of the item
+    @return: A random meal item, which is discrete (counted in pieces) 25% of the time
+    """
+    discrete = rng.random() < 0.25
+    return MealItemSpec(id=item_id,
+                        category=category,
+                        cafeteria_id=str(item_id),
+                        portion_volume=-1. if discrete else rng.uniform(50, 250),
+                        max_pieces=rng.randint(2, 8),
+                        calories=rng.uniform(20, 400),
+                        carbohydrate=rng.uniform(0, 60),
+                        protein=rng.uniform(0, 40),
+                        total_fat=rng.uniform(0, 25),
+                        saturated_fat=rng.uniform(0, 8),
+                        sugar=rng.uniform(0, 15),
+                        cholesterol=rng.uniform(0, 80),
+                        fiber=rng.uniform(0, 8),
+                        sodium=rng.uniform(0, 700))
+
+
+def synthetic_menu(rng: random.Random, items_per_category: int) -> list[MealItemSpec]:
+    """
+    @param rng: Random number generator, seeded for reproducible menus
+    @param items_per_category: Self-explanatory
+    @return: A random menu with the given number of protein, vegetable and grain items
+    """
+    return [synthetic_item(rng, i * 3 + j, category) for i in range(items_per_category)
+            for j, category in enumerate((PROTEIN, VEGETABLE, GRAINS))]
+
+
+def synthetic_plate(rng: random.Random, items_per_section: int) -> list[PlateSectionState]:
+    """
+    @param rng: Random number generator, seeded for reproducible plates
+    @param items_per_section: Number of items in each of the three plate sections
+    @return: The sections of a plate, as given to the portion selecting algorithms
+    """
+    items = synthetic_menu(rng, items_per_section)
+    return [PlateSectionState.from_item_spec(item, volume, items_per_section, section_name)
+            for category, volume, section_name in zip((PROTEIN, VEGETABLE, GRAINS),
+                                                      (LARGE_PORTION_MAX, SMALL_PORTION_MAX, SMALL_PORTION_MAX),
+                                                      ('large', 'small1', 'small2'))
+            for item in items if item.category == category]
+
+
+def summarize(values) -> dict:
+    """
+    @param values: Measurements, e.g. runtimes
+    @return: Mean, min, max and percentiles (as 'p50' etc.) of the values
+    """
+    values = np.asarray(values, dtype=float)
+    if not len(values):
+        return {}
+    ret = {'mean': float(values.mean()), 'min': float(values.min()), 'max': float(values.max())}
+    ret.update({f'p{p}': float(np.percentile(values, p)) for p in PERCENTILES})
+    return ret
+
+
+def measure(make_alg, seeds: list[int]) -> dict:
+    """
+    Runs an algorithm once per seed, then once more with memory tracing (which slows it down, so it isn't timed)
+    @param make_alg: Function that takes a seed and returns a new algorithm object (anything with run_algorithm())
+    @param seeds: Self-explanatory
+    @return: Statistics of the runtimes (in seconds), iterations per second, final costs and peak memory (in bytes)
+    """
+    runtimes, rates, costs = [], [], []
+    for seed in seeds:
+        alg = make_alg(seed)
+        start_time = time.perf_counter()
+        alg.run_algorithm()
+        runtime = time.perf_counter() - start_time
+        runtimes.append(runtime)
+        costs.append(alg.final_cost if hasattr(alg, 'final_cost') else alg.result_cost)
+        iterations = alg.iterations if hasattr(alg, 'iterations') else alg.num_annealed
+        rates.append(iterations / runtime if runtime > 0 else 0.)
+
+    alg = make_alg(seeds[0])
+    tracemalloc.start()
+    try:
+        alg.run_algorithm()
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'runs': len(seeds),
+        'runtime': summarize(runtimes),
+        'iterations_per_second': summarize(rates),
+        'final_cost': summarize(costs),
+        'peak_memory': peak_memory
+    }
+
+
+def benchmark_requirements(seed: int, num_profiles: int, repeats: int) -> dict:
+    """
+    @param seed: Seed of the synthetic profiles
+    @param num_profiles: Number of profiles to compute the requirements of
+    @param repeats: Number of times to compute the requirements of all of the profiles
+    @return: Statistics of the time (in seconds) it takes to compute the requirements of one profile
+    """
+    profiles = synthetic_profiles(random.Random(seed), num_profiles)
+    runtimes = []
+    for _ in range(repeats):
+        for profile in profiles:
+            start_time = time.perf_counter()
+            nutritional_info_for(profile)
+            runtimes.append(time.perf_counter() - start_time)
+    return {'profiles': num_profiles, 'runtime': summarize(runtimes)}
+
+
+def benchmark_portions(seed: int, engine: str, items_per_section: int, runs: int) -> dict:
+    """
+    @param seed: Seed of the synthetic plates and profiles, and of the algorithm
+    @param engine: Portion selecting algorithm, one of integration.PORTION_ENGINES
+    @param items_per_section: Number of items in each plate section
+    @param runs: Number of plates (each for a different profile) to select the portions of
+    @return: See measure
+    """
+    def make_alg(run_seed):
+        rng = random.Random(run_seed)
+        alg = portion_optimizer(synthetic_profiles(rng, 1)[0], synthetic_plate(rng, items_per_section), engine)
+        alg.seed = run_seed
+        return alg
+
+    return {'engine': engine, 'items_per_section': items_per_section,
+            **measure(make_alg, [seed + i for i in range(runs)])}
+
+
+def benchmark_item_selector(seed: int, items_per_category: int, runs: int) -> dict:
+    """
+    Measures MealItemSelector without the triple costs cache, i.e. every triple is annealed unless it's pruned
+    @param seed: Seed of the synthetic menus and profiles, and of the algorithm
+    @param items_per_category: Number of protein, vegetable and grain items on the menu
+    @param runs: Number of menus (each for a different profile) to select the items of
+    @return: See measure.  The iterations are the number of triples annealed
+    """
+    def make_alg(run_seed):
+        rng = random.Random(run_seed)
+        alg = meal_item_selector(synthetic_profiles(rng, 1)[0], synthetic_menu(rng, items_per_category),
+                                 LARGE_PORTION_MAX, SMALL_PORTION_MAX)
+        alg.seed = run_seed
+        return alg
+
+    return {'items_per_category': items_per_category, **measure(make_alg, [seed + i for i in range(runs)])}
+
+
+def compare_engines(seed: int, items_per_section: int, runs: int, baseline: str = ANNEALING) -> dict:
+    """
+    Runs every portion selecting algorithm on the same plates
+    @param seed: See benchmark_portions
+    @param items_per_section: See benchmark_portions
+    @param runs: See benchmark_portions
+    @param baseline: The engine to compare the others with
+    @return: For each engine, on how many plates it found a lower/higher final cost than the baseline engine
+    """
+    costs = {}
+    for engine in PORTION_ENGINES:
+        for i in range(runs):
+            rng = random.Random(seed + i)
+            alg = portion_optimizer(synthetic_profiles(rng, 1)[0], synthetic_plate(rng, items_per_section), engine)
+            alg.seed = seed + i
+            alg.run_algorithm()
+            costs.setdefault(engine, []).append(alg.final_cost)
+
+    base = np.array(costs[baseline])
+    ret = {}
+    for engine in PORTION_ENGINES:
+        if engine != baseline:
+            cur = np.array(costs[engine])
+            tolerance = 1e-9 * np.maximum(1, np.abs(base))
+            ret[engine] = {'better': int((cur < base - tolerance).sum()), 'worse': int((cur > base + tolerance).sum())}
+    return {'baseline': baseline, 'items_per_section': items_per_section, 'runs': runs, 'engines': ret}
+
+
+def compare_schedules(seed: int, items_per_section: int, runs: int) -> dict:
+    """
+    Runs SimulatedAnnealing with the geometric and the adaptive cooling schedule on the same plates, without a time
+    budget
+    @param seed: See benchmark_portions
+    @param items_per_section: See benchmark_portions
+    @param runs: See benchmark_portions
+    @return: The mean number of iterations of each schedule, how much fewer the adaptive schedule needs (as a
+    fraction), and on how many plates it found a lower/higher final cost
+    """
+    results = {}
+    for schedule in (SCHEDULE_GEOMETRIC, SCHEDULE_ADAPTIVE):
+        for i in range(runs):
+            rng = random.Random(seed + i)
+            alg = SimulatedAnnealing(synthetic_profiles(rng, 1)[0], synthetic_plate(rng, items_per_section),
+                                     DEFAULT_COEFFICIENTS, alpha=0.999, smallest_temp=0.0005, seed=seed + i,
+                                     schedule=schedule)
+            alg.run_algorithm()
+            results.setdefault(schedule, []).append((alg.iterations, alg.final_cost))
+
+    iterations = {schedule: float(np.mean([res[0] for res in results[schedule]])) for schedule in results}
+    base = np.array([res[1] for res in results[SCHEDULE_GEOMETRIC]])
+    cur = np.array([res[1] for res in results[SCHEDULE_ADAPTIVE]])
+    tolerance = 1e-9 * np.maximum(1, np.abs(base))
+    return {
+        'items_per_section': items_per_section,
+        'runs': runs,
+        'iterations': iterations,
+        'step_reduction': 1 - iterations[SCHEDULE_ADAPTIVE] / iterations[SCHEDULE_GEOMETRIC],
+        'better': int((cur < base - tolerance).sum()),
+        'worse': int((cur > base + tolerance).sum())
+    }
+
+
+def run_benchmarks(seed: int = 20210226, portion_sizes=(1, 2, 3), menu_sizes=(4, 8), runs: int = 10,
+                   engines=PORTION_ENGINES) -> dict:
+    """
+    Runs all of the benchmarks
+    @param seed: Seed of all of the synthetic data and algorithms, so that the results of different commits can be
+    compared
+    @param portion_sizes: Numbers of items per plate section to benchmark the portion selecting algorithms with
+    @param menu_sizes: Numbers of items per category to benchmark the item selector with
+    @param runs: Number of runs of each benchmark
+    @param engines: Portion selecting algorithms to benchmark
+    @return: JSON-serializable results
+    """
+    return {
+        'version': BENCHMARK_VERSION,
+        'seed': seed,
+        'requirements': benchmark_requirements(seed, 100, runs),
+        'portions': [benchmark_portions(seed, engine, size, runs) for engine in engines for size in portion_sizes],
+        'engine_comparison': [compare_engines(seed, size, runs) for size in portion_sizes],
+        'schedule_comparison': [compare_schedules(seed, size, runs) for size in portion_sizes],
+        'item_selector': [benchmark_item_selector(seed, size, runs) for size in menu_sizes],
+    }
+
+
+def compare_results(old: dict, new: dict, stat: str = 'p50') -> list[tuple[str, float, float]]:
+    """
+    @param old: Results of run_benchmarks, e.g. from an earlier commit
+    @param new: Results of run_benchmarks with the same parameters
+    @param stat: Which runtime statistic to compare
+    @return: (benchmark name, old runtime, new runtime) of each benchmark in both results
+    """
+    def runtimes(results):
+        ret = {'requirements': results['requirements']['runtime'][stat]}
+        for res in results['portions']:
+            ret[f'portions.{res["engine"]}.{res["items_per_section"]}'] = res['runtime'][stat]
+        for res in results['item_selector']:
+            ret[f'item_selector.{res["items_per_category"]}'] = res['runtime'][stat]
+        return ret
+
+    old_runtimes, new_runtimes = runtimes(old), runtimes(new)
+    return [(name, old_runtimes[name], new_runtimes[name]) for name in new_runtimes if name in old_runtimes]
@@ -0,0 +1,315 @@
+import hashlib
+import threading
+import uuid
+from dataclasses import dataclass
+
+import numpy as np
+from cachetools import TTLCache
+from django.conf import settings
+from django.core.cache import cache
+
+from backend.algorithm.executor import get_executor
+from backend.algorithm.item_choice import MealItemSelector, TripleCosts
+from backend.algorithm.requirements import StudentProfileSpec, cached_nutritional_info_for, quantize_requirements
+from backend.algorithm.snapshot import MealSnapshot, ItemPreferences, SNAPSHOT_FORMAT_VERSION
+
+# Bump this whenever a change to the algorithms changes the triple costs they compute, so that old cache entries are
+# not reused
+ALGORITHM_VERSION = 3
+
+MEAL_VERSION_CACHE_KEY = 'meal_version'
+TRIPLE_COSTS_CACHE_KEY = 'triple_costs'
+TRIPLE_COSTS_VERSION_CACHE_KEY = 'triple_costs_version'
+TRIPLE_COSTS_INDEX_CACHE_KEY = 'triple_costs_index'
+SUGGESTION_CACHE_KEY = 'suggested_items'
+SUGGESTION_INDEX_CACHE_KEY = 'suggested_items_index'
+MEAL_SNAPSHOT_CACHE_KEY = 'meal_snapshot'
+
+# Per-worker LRU (with TTL) in front of the shared Django cache.  cachetools caches are not thread-safe
+_local_triple_costs = TTLCache(maxsize=settings.TRIPLE_COSTS_LOCAL_CACHE_SIZE, ttl=settings.TRIPLE_COSTS_CACHE_TIMEOUT)
+_local_snapshots = TTLCache(maxsize=settings.MEAL_SNAPSHOT_LOCAL_CACHE_SIZE, ttl=settings.MEAL_SNAPSHOT_CACHE_TIMEOUT)
+_local_lock = threading.Lock()
+
+
+def meal_version(meal_id: int) -> str:
+    """
+    @param meal_id: ID of a MealSelection
+    @return: A token that changes whenever the meal's items (or their nutrition facts or ingredients) change.  Random
+    rather than a counter, so that clearing the cache can never make an old token valid again
+    """
+    return cache.get_or_set(f'{MEAL_VERSION_CACHE_KEY}.{meal_id}', lambda: uuid.uuid4().hex, timeout=None)
+
+
+def invalidate_meal(meal_id: int) -> str:
+    """
+    Invalidates the cached snapshot and suggestions of a meal.  The triple costs only depend on the items in each
+    triple, so they're kept: triples of added items are computed when they're first needed, those of removed items
+    are no longer looked up, and triples of changed items must be dropped with forget_triple_costs
+    @param meal_id: ID of a MealSelection
+    @return: The new meal version
+    """
+    version = uuid.uuid4().hex
+    cache.set(f'{MEAL_VERSION_CACHE_KEY}.{meal_id}', version, timeout=None)
+    return version
+
+
+def _add_to_index(index_key: str, member: str, timeout: float):
+    """
+    Adds a member to a set stored in the cache.  Not atomic, so a concurrent update may be lost, which is fine for the
+    indexes below (it only means that an entry is recomputed rather than updated)
+    """
+    index = cache.get(index_key, set())
+    if member not in index:
+        cache.set(index_key, index | {member}, timeout=timeout)
+
+
+def triple_costs_version(meal_id: int) -> str:
+    """
+    @param meal_id: ID of a MealSelection
+    @return: A token that changes whenever some of the meal's cached triple costs are dropped (see meal_version)
+    """
+    return cache.get_or_set(f'{TRIPLE_COSTS_VERSION_CACHE_KEY}.{meal_id}', lambda: uuid.uuid4().hex, timeout=None)
+
+
+@dataclass
+class MealCacheEntries:
+    """
+    A meal's versions and other entries of the shared cache, read together by read_meal_cache
+    """
+    meal_version: str  # See meal_version
+    triple_costs_version: str  # See triple_costs_version
+    entries: dict  # The other entries that were found, by key
+
+
+def read_meal_cache(meal_id: int, keys=()) -> MealCacheEntries:
+    """
+    Reads a meal's versions and other entries of the shared cache (e.g. suggestions, see suggestion_key) with a single
+    get_many rather than a round trip each, which matters for backends where every read is a query (e.g.
+    DatabaseCache).  The result can be passed to the functions below that need the versions
+    @param meal_id: ID of a MealSelection
+    @param keys: Keys of the other entries to read
+    @return: The entries
+    """
+    version_keys = f'{MEAL_VERSION_CACHE_KEY}.{meal_id}', f'{TRIPLE_COSTS_VERSION_CACHE_KEY}.{meal_id}'
+    entries = cache.get_many(version_keys + tuple(keys))
+    # Versions that aren't set yet are created as usual
+    return MealCacheEntries(meal_version=entries.pop(version_keys[0], None) or meal_version(meal_id),
+                            triple_costs_version=entries.pop(version_keys[1], None) or triple_costs_version(meal_id),
+                            entries=entries)
+
+
+def triple_costs_fingerprint(alg: MealItemSelector) -> str:
+    """
+    @param alg: A selector.  Its requirements should be quantized (see requirements.quantize_requirements) for the
+    fingerprint to be shared between students
+    @return: A string that identifies the requirements and parameters the selector computes the triple costs with
+    """
+    lo, hi = alg.requirements
+    params = np.concatenate((lo.vec, hi.vec, np.asarray(alg.coefficients, dtype=float),
+                             [alg.large_portion_max, alg.small_portion_max, alg.sa_alpha, alg.sa_lo, alg.seed]))
+    # The health goal decides which category goes in the large section
+    return hashlib.sha1(params.tobytes() + alg.profile.health_goal.encode()).hexdigest()
+
+
+def triple_costs_key(meal_id: int, version: str, fingerprint: str) -> str:
+    """
+    @param meal_id: ID of the meal the triple costs are of
+    @param version: See triple_costs_version
+    @param fingerprint: See triple_costs_fingerprint
+    @return: Cache key of the triple costs
+    """
+    return f'{TRIPLE_COSTS_CACHE_KEY}.{ALGORITHM_VERSION}.{meal_id}.{version}.{fingerprint}'
+
+
+def get_triple_costs(key: str) -> TripleCosts:
+    """
+    @param key: See triple_costs_key
+    @return: The cached triple costs, or None if they're not cached
+    """
+    with _local_lock:
+        if (ret := _local_triple_costs.get(key)) is not None:
+            return ret
+
+    if (data := cache.get(key)) is not None:
+        ret = TripleCosts.from_bytes(data)
+        with _local_lock:
+            _local_triple_costs[key] = ret
+        return ret
+    return None
+
+
+def set_triple_costs(key: str, triple_costs: TripleCosts):
+    """
+    @param key: See triple_costs_key
+    @param triple_costs: Self-explanatory
+    @return: None
+    """
+    with _local_lock:
+        _local_triple_costs[key] = triple_costs
+    cache.set(key, triple_costs.to_bytes(), timeout=settings.TRIPLE_COSTS_CACHE_TIMEOUT)
+
+
+def run_meal_item_selector(meal_id: int, alg: MealItemSelector, entries: MealCacheEntries = None) -> MealItemSelector:
+    """
+    Runs a MealItemSelector on the configured executor (see backend.algorithm.executor), reusing the triple costs of
+    previous runs with the same meal, requirements and parameters.  The selector may choose from a subset of the meal's
+    items (e.g. without the student's banned items), newly computed triple costs are merged into the cached ones
+    @param meal_id: ID of the meal the selector chooses from
+    @param alg: The selector
+    @param entries: The meal's entries, if they were already read (see read_meal_cache)
+    @return: The finished selector, which may be a copy of alg
+    """
+    fingerprint = triple_costs_fingerprint(alg)
+    version = entries.triple_costs_version if entries is not None else triple_costs_version(meal_id)
+    key = triple_costs_key(meal_id, version, fingerprint)
+    cached = alg.triple_costs = get_triple_costs(key)
+    alg = get_executor().run(alg)
+    if alg.num_annealed:
+        set_triple_costs(key, alg.triple_costs if cached is None else cached.merged_with(alg.triple_costs))
+        _add_to_index(f'{TRIPLE_COSTS_INDEX_CACHE_KEY}.{meal_id}', fingerprint, settings.TRIPLE_COSTS_CACHE_TIMEOUT)
+    return alg
+
+
+def forget_triple_costs(meal_id: int, item_ids=None):
+    """
+    Drops the cached triple costs of some of a meal's items, e.g. because they were removed from the meal or their
+    nutrition facts changed.  The other triples are moved to a new key (see triple_costs_version), so that no worker
+    keeps using the old entries from its local cache
+    @param meal_id: ID of a MealSelection
+    @param item_ids: IDs of the MealItems to drop, or None to drop all of the meal's triple costs
+    @return: None
+    """
+    old_version = triple_costs_version(meal_id)
+    new_version = uuid.uuid4().hex
+    index_key = f'{TRIPLE_COSTS_INDEX_CACHE_KEY}.{meal_id}'
+    # The kept triples (and the index) are written before the new version is published: no worker can store fresh
+    # entries under it until then, which they would overwrite
+    if item_ids is None:
+        cache.delete(index_key)
+    else:
+        kept = set()
+        for fingerprint in cache.get(index_key, set()):
+            if (triple_costs := get_triple_costs(triple_costs_key(meal_id, old_version, fingerprint))) is not None:
+                set_triple_costs(triple_costs_key(meal_id, new_version, fingerprint), triple_costs.without(item_ids))
+                kept.add(fingerprint)
+        cache.set(index_key, kept, timeout=settings.TRIPLE_COSTS_CACHE_TIMEOUT)
+    cache.set(f'{TRIPLE_COSTS_VERSION_CACHE_KEY}.{meal_id}', new_version, timeout=None)
+
+
+def meal_snapshot_key(meal_id: int, entries: MealCacheEntries = None) -> str:
+    """
+    @param meal_id: ID of a MealSelection
+    @param entries: The meal's entries, if they were already read (see read_meal_cache)
+    @return: Cache key of the meal's current MealSnapshot.  Should be computed before loading the items to snapshot, so
+    that a snapshot of items that changed in the meantime is stored under an outdated key
+    """
+    version = entries.meal_version if entries is not None else meal_version(meal_id)
+    return f'{MEAL_SNAPSHOT_CACHE_KEY}.{SNAPSHOT_FORMAT_VERSION}.{meal_id}.{version}'
+
+
+def get_meal_snapshot(key: str) -> MealSnapshot:
+    """
+    @param key: See meal_snapshot_key
+    @return: The cached snapshot, or None if it's not cached
+    """
+    with _local_lock:
+        if (ret := _local_snapshots.get(key)) is not None:
+            return ret
+
+    if (data := cache.get(key)) is not None:
+        ret = MealSnapshot.from_bytes(data)
+        with _local_lock:
+            _local_snapshots[key] = ret
+        return ret
+    return None
+
+
+def set_meal_snapshot(key: str, snapshot: MealSnapshot):
+    """
+    @param key: See meal_snapshot_key
+    @param snapshot: Self-explanatory
+    @return: None
+    """
+    with _local_lock:
+        _local_snapshots[key] = snapshot
+    cache.set(key, snapshot.to_bytes(), timeout=settings.MEAL_SNAPSHOT_CACHE_TIMEOUT)
+
+
+def suggestion_fingerprint(meal_id: int, profile: StudentProfileSpec, preferences: ItemPreferences) -> str:
+    """
+    @param meal_id: ID of a MealSelection
+    @param profile: The student the suggestion is for
+    @param preferences: The student's banned, favoured and allergenic items
+    @return: A string that changes whenever the item suggestion for the student at the meal could change, apart from
+    changes to the meal's items (see meal_version)
+    """
+    lo, hi = quantize_requirements(*cached_nutritional_info_for(profile), settings.REQUIREMENT_BUCKET_RATIO)
+    return f'{ALGORITHM_VERSION}.{profile.health_goal}.' \
+           f'{hashlib.sha1(lo.vec.tobytes() + hi.vec.tobytes()).hexdigest()}.{preferences.fingerprint()}'
+
+
+def suggestion_key(meal_id: int, profile_id: int, large_portion_max: float, small_portion_max: float) -> str:
+    return f'{SUGGESTION_CACHE_KEY}.{meal_id}.{profile_id}.{float(large_portion_max)}.{float(small_portion_max)}'
+
+
+def get_suggestion(meal_id: int, profile_id: int, profile: StudentProfileSpec, preferences: ItemPreferences,
+                   large_portion_max: float, small_portion_max: float, entries: MealCacheEntries = None) -> dict:
+    """
+    @param meal_id: ID of the MealSelection
+    @param profile_id: ID of the StudentProfile
+    @param profile: The StudentProfile, as a StudentProfileSpec
+    @param preferences: The StudentProfile's preferences
+    @param large_portion_max: Size of the large plate section (mL)
+    @param small_portion_max: Size of the small plate sections (mL)
+    @param entries: The meal's entries, if they were already read along with the suggestion's key (see
+    read_meal_cache).  Read with the suggestion otherwise
+    @return: The stored MealItemSelector result object, or None if there isn't one or it is out of date
+    """
+    key = suggestion_key(meal_id, profile_id, large_portion_max, small_portion_max)
+    if entries is None:
+        entries = read_meal_cache(meal_id, (key,))
+    stored = entries.entries.get(key)
+    if stored is not None and stored['meal_version'] == entries.meal_version and \
+            stored['fingerprint'] == suggestion_fingerprint(meal_id, profile, preferences):
+        return stored['result']
+    return None
+
+
+def set_suggestion(meal_id: int, profile_id: int, profile: StudentProfileSpec, preferences: ItemPreferences,
+                   large_portion_max: float, small_portion_max: float, result: dict, entries: MealCacheEntries = None):
+    """
+    Stores a MealItemSelector result object, see get_suggestion for the parameters
+    @return: None
+    """
+    key = suggestion_key(meal_id, profile_id, large_portion_max, small_portion_max)
+    cache.set(key, {
+        'meal_version': entries.meal_version if entries is not None else meal_version(meal_id),
+        'fingerprint': suggestion_fingerprint(meal_id, profile, preferences),
+        'result': result
+    }, timeout=settings.SUGGESTION_CACHE_TIMEOUT)
+    _add_to_index(f'{SUGGESTION_INDEX_CACHE_KEY}.{meal_id}', key, settings.SUGGESTION_CACHE_TIMEOUT)
+
+
+def remove_meal_items(meal_id: int, item_ids):
+    """
+    Updates the cache after items were removed from a meal.  The triple costs are kept (see invalidate_meal), so they
+    are reused if the items are added back, and so are the suggestions that don't contain any of them, since the
+    cheapest combination of a set of items is still the cheapest one after removing items that aren't part of it.
+    Other suggestions are recomputed when they're next needed
+    @param meal_id: ID of a MealSelection
+    @param item_ids: IDs of the removed MealItems
+    @return: None
+    """
+    item_ids = set(item_ids)
+    old_version = meal_version(meal_id)
+    new_version = invalidate_meal(meal_id)
+
+    index_key = f'{SUGGESTION_INDEX_CACHE_KEY}.{meal_id}'
+    kept = set()
+    for key, stored in cache.get_many(cache.get(index_key, set())).items():
+        if stored['meal_version'] != old_version:
+            continue
+        if not any(item_ids.intersection(section['items']) for section in stored['result'].values()):
+            cache.set(key, {**stored, 'meal_version': new_version}, timeout=settings.SUGGESTION_CACHE_TIMEOUT)
+            kept.add(key)
+    cache.set(index_key, kept, timeout=settings.SUGGESTION_CACHE_TIMEOUT)
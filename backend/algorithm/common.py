@@ -1,4 +1,4 @@
-from dataclasses import dataclass, fields, asdict
+import numpy as np
 
 # Health goals
 LOSE_WEIGHT = 'lose_weight'
@@ -32,27 +32,61 @@ PROTEIN = 'protein'
 GRAINS = 'grain'
 
 
-@dataclass
+# Fixed order of the nutrient vector backing Nutrition.  Anything that deals with nutrient arrays (requirement bounds,
+# per-item nutrient rows, cost weights) should use this order
+NUTRIENTS = (
+    'calories',
+    'carbohydrate',
+    'protein',
+    'total_fat',
+    'saturated_fat',
+    'trans_fat',
+
+    'sugar',
+    'cholesterol',
+    'fiber',
+
+    'sodium',
+    'potassium',
+    'calcium',
+    'iron',
+
+    'vitamin_a',
+    'vitamin_c',
+    'vitamin_d',
+)
+NUM_NUTRIENTS = len(NUTRIENTS)
+NUTRIENT_INDEX = {name: i for i, name in enumerate(NUTRIENTS)}
+
+
+def _nutrient_property(idx: int) -> property:
+    def getter(self):
+        return float(self.vec[idx])
+
+    def setter(self, value):
+        self.vec[idx] = value
+
+    return property(getter, setter)
+
+
 class Nutrition:
-    calories: float = 0.
-    carbohydrate: float = 0.
-    protein: float = 0.
-    total_fat: float = 0.
-    saturated_fat: float = 0.
-    trans_fat: float = 0.
-
-    sugar: float = 0.
-    cholesterol: float = 0.
-    fiber: float = 0.
-
-    sodium: float = 0.
-    potassium: float = 0.
-    calcium: float = 0.
-    iron: float = 0.
-
-    vitamin_a: float = 0.
-    vitamin_c: float = 0.
-    vitamin_d: float = 0.
+    """
+    Nutrition facts, stored as a fixed-order vector of NUM_NUTRIENTS floats (see NUTRIENTS).  Each nutrient can still
+    be read and written as an attribute (e.g. nut.calories), but arithmetic is done in-place on the vector so that the
+    hot loops of the algorithms don't allocate a new object per operation
+    """
+    __slots__ = ('vec',)
+
+    def __init__(self, vec: np.ndarray = None, **kwargs):
+        """
+        @param vec: Nutrient vector to wrap (not copied), in the order of NUTRIENTS.  Zeros if not given
+        @param kwargs: Individual nutrient values, e.g. calories=100.  These overwrite the values in vec
+        """
+        self.vec = np.zeros(NUM_NUTRIENTS) if vec is None else vec
+        for name, value in kwargs.items():
+            if name not in NUTRIENT_INDEX:
+                raise TypeError(f'Unknown nutrient {name}')
+            self.vec[NUTRIENT_INDEX[name]] = value
 
     @classmethod
     def from_object(cls, obj):
@@ -60,139 +94,48 @@ class Nutrition:
         Creates a Nutrition object from any other object that has the same attributes.  Does not do type checking
         @param obj Object to initialize from
         """
-        field_dict = {}
-        for prop in fields(Nutrition):
-            field_dict[prop.name] = getattr(obj, prop.name)
-        return cls(**field_dict)
+        return cls(vec=np.array([getattr(obj, name) for name in NUTRIENTS], dtype=float))
 
     def as_dict(self):
-        return asdict(self)
+        return dict(zip(NUTRIENTS, self.vec.tolist()))
 
-    # speed?
-    # this is bad coding I know
-    # http://threecop1.blogspot.com/2011/04/python-3x-does-setattr-and-getattr-slow.html
-    def __iadd__(self, other):
-        self.calories += other.calories
-        self.carbohydrate += other.carbohydrate
-        self.protein += other.protein
-        self.total_fat += other.total_fat
-        self.saturated_fat += other.saturated_fat
-        self.trans_fat += other.trans_fat
-
-        self.sugar += other.sugar
-        self.cholesterol += other.cholesterol
-        self.fiber += other.fiber
-        self.sodium += other.sodium
-        self.potassium += other.potassium
-        self.calcium += other.calcium
-        self.iron += other.iron
-
-        self.vitamin_a += other.vitamin_a
-        self.vitamin_c += other.vitamin_c
-        self.vitamin_d += other.vitamin_d
+    def __repr__(self):
+        return f'Nutrition({", ".join(f"{k}={v}" for k, v in self.as_dict().items())})'
+
+    def __eq__(self, other):
+        return isinstance(other, Nutrition) and np.array_equal(self.vec, other.vec)
 
+    def __iadd__(self, other):
+        self.vec += other.vec
         return self
 
     def __isub__(self, other):
-        self.calories -= other.calories
-        self.carbohydrate -= other.carbohydrate
-        self.protein -= other.protein
-        self.total_fat -= other.total_fat
-        self.saturated_fat -= other.saturated_fat
-        self.trans_fat -= other.trans_fat
-
-        self.sugar -= other.sugar
-        self.cholesterol -= other.cholesterol
-        self.fiber -= other.fiber
-        self.sodium -= other.sodium
-        self.potassium -= other.potassium
-        self.calcium -= other.calcium
-        self.iron -= other.iron
-
-        self.vitamin_a -= other.vitamin_a
-        self.vitamin_c -= other.vitamin_c
-        self.vitamin_d -= other.vitamin_d
-
+        self.vec -= other.vec
         return self
 
     def __imul__(self, c):
-        self.calories *= c
-        self.carbohydrate *= c
-        self.protein *= c
-        self.total_fat *= c
-        self.saturated_fat *= c
-        self.trans_fat *= c
-
-        self.sugar *= c
-        self.cholesterol *= c
-        self.fiber *= c
-        self.sodium *= c
-        self.potassium *= c
-        self.calcium *= c
-        self.iron *= c
-
-        self.vitamin_a *= c
-        self.vitamin_c *= c
-        self.vitamin_d *= c
-
+        self.vec *= c
         return self
 
     def __itruediv__(self, c):
-        self.calories /= c
-        self.carbohydrate /= c
-        self.protein /= c
-        self.total_fat /= c
-        self.saturated_fat /= c
-        self.trans_fat /= c
-
-        self.sugar /= c
-        self.cholesterol /= c
-        self.fiber /= c
-        self.sodium /= c
-        self.potassium /= c
-        self.calcium /= c
-        self.iron /= c
-
-        self.vitamin_a /= c
-        self.vitamin_c /= c
-        self.vitamin_d /= c
-
+        self.vec /= c
         return self
 
     def copy(self):
-        return Nutrition(calories=self.calories,
-                         carbohydrate=self.carbohydrate,
-                         protein=self.protein,
-                         total_fat=self.total_fat,
-                         saturated_fat=self.saturated_fat,
-                         trans_fat=self.trans_fat,
-                         sugar=self.sugar,
-                         cholesterol=self.cholesterol,
-                         fiber=self.fiber,
-                         sodium=self.sodium,
-                         potassium=self.potassium,
-                         calcium=self.calcium,
-                         iron=self.iron,
-                         vitamin_a=self.vitamin_a,
-                         vitamin_c=self.vitamin_c,
-                         vitamin_d=self.vitamin_d)
+        return Nutrition(vec=self.vec.copy())
 
     def __add__(self, other):
-        ret = self.copy()
-        ret += other
-        return ret
+        return Nutrition(vec=self.vec + other.vec)
 
     def __sub__(self, other):
-        ret = self.copy()
-        ret -= other
-        return ret
+        return Nutrition(vec=self.vec - other.vec)
 
     def __mul__(self, c):
-        ret = self.copy()
-        ret *= c
-        return ret
+        return Nutrition(vec=self.vec * c)
 
     def __truediv__(self, c):
-        ret = self.copy()
-        ret /= c
-        return ret
+        return Nutrition(vec=self.vec / c)
+
+
+for _idx, _name in enumerate(NUTRIENTS):
+    setattr(Nutrition, _name, _nutrient_property(_idx))
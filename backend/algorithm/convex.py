@@ -0,0 +1,175 @@
+import logging
+import math
+import time
+
+import numpy as np
+
+from .common import Nutrition
+from .portion import PortionOptimizer, PlateSectionState, STOP_CONVERGED, STOP_DEADLINE
+from .requirements import StudentProfileSpec
+from .telemetry import AnnealingTrace
+
+logger = logging.getLogger(__name__)
+
+
+def bounded_least_squares(a: np.ndarray, b: np.ndarray, lo: np.ndarray, hi: np.ndarray, x0: np.ndarray,
+                          max_iterations: int = None) -> np.ndarray:
+    """
+    Solves min ||a @ x - b||^2 subject to lo <= x <= hi exactly, with an active-set method (as in Lawson-Hanson NNLS,
+    generalized to two-sided bounds)
+    @param a: Matrix of shape (m, n)
+    @param b: Vector of shape (m,)
+    @param lo: Lower bounds, shape (n,)
+    @param hi: Upper bounds, shape (n,)
+    @param x0: Starting point, shape (n,).  Clipped to the bounds
+    @param max_iterations: Maximum number of active set changes, 3 * n + 10 by default.  If it is reached, a warning is
+    logged and the current (feasible, but possibly not optimal) x is returned
+    @return: The minimizer x
+    """
+    n = len(x0)
+    x = np.clip(x0, lo, hi)
+    free = np.ones(n, dtype=bool)
+    if max_iterations is None:
+        max_iterations = 3 * n + 10
+    for _ in range(max_iterations):
+        if free.any():
+            z = np.linalg.lstsq(a[:, free], b - a[:, ~free] @ x[~free], rcond=None)[0]
+            cur = x[free]
+            lo_f, hi_f = lo[free], hi[free]
+            if np.any(z < lo_f) or np.any(z > hi_f):
+                # Move towards z until the first free variable hits a bound, then fix the variables on a bound
+                d = z - cur
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    steps = np.where(d < 0, (lo_f - cur) / d, np.where(d > 0, (hi_f - cur) / d, np.inf))
+                step = min(1., max(0., float(steps.min())))
+                x[free] = np.clip(cur + step * d, lo_f, hi_f)
+                free &= (x > lo) & (x < hi)
+                continue
+            x[free] = z
+
+        # Free a fixed variable whose multiplier has the wrong sign, if any
+        gradient = a.T @ (a @ x - b)
+        tolerance = 1e-10 * max(1., float(np.abs(gradient).max()))
+        violation = np.where(~free & (x <= lo), -gradient, 0.) + np.where(~free & (x >= hi), gradient, 0.)
+        if violation.max() <= tolerance:
+            break
+        free[int(np.argmax(violation))] = True
+    else:
+        logger.warning(f'Bounded least squares stopped after {max_iterations} iterations without converging '
+                       f'({n} variables)')
+    return x
+
+
+class ConvexPortionSolver(PortionOptimizer):
+    def __init__(self, profile: StudentProfileSpec, state: list[PlateSectionState], coefficients: tuple[float],
+                 requirements: tuple[Nutrition, Nutrition] = None, time_budget: float = None,
+                 trace: AnnealingTrace = None):
+        """
+        Portion-selecting algorithm that minimizes the same cost as SimulatedAnnealing directly.  The squared distance
+        of a nutrient total t to its allowed range [lo, hi] is the minimum of (t - u)^2 over lo <= u <= hi, and the
+        totals are linear in the volumes, so minimizing the cost over the continuous volumes is a single bounded least
+        squares problem in the volumes and u, which is solved exactly.  Discrete sections are solved as if they were
+        continuous, rounded, and then improved by local search over +-1 piece
+        @param profile: See PortionOptimizer
+        @param state: See PortionOptimizer
+        @param coefficients: See PortionOptimizer
+        @param requirements: See PortionOptimizer
+        @param time_budget: If given, the local search over the discrete sections stops after this many seconds, keeping
+        the best volumes found so far.  The continuous relaxation is always solved
+        @param trace: See PortionOptimizer.  Only the counters and timings are recorded, there is no annealing progress
+        to sample
+        """
+        super().__init__(profile, state, coefficients, requirements, trace)
+        self.time_budget = time_budget
+
+        # The closest allowed total of a nutrient always lies between the closest allowed totals of the smallest and
+        # largest reachable totals, so its bounds are narrowed to those.  This also replaces the INF sentinels of
+        # one-sided requirements (e.g. the lower bound of sugar), which would otherwise dwarf the other variables
+        lo_amounts = self._min_volume[:, None] * self._density
+        hi_amounts = self._max_volume[:, None] * self._density
+        lo_totals = np.minimum(lo_amounts, hi_amounts).sum(axis=0)
+        hi_totals = np.maximum(lo_amounts, hi_amounts).sum(axis=0)
+        lo_bound = np.maximum(self._lo_vec, np.minimum(lo_totals, self._hi_vec))
+        hi_bound = np.minimum(self._hi_vec, np.maximum(hi_totals, self._lo_vec))
+
+        # Only the weighted nutrients that can leave their allowed range matter, scaled so that the cost is a plain sum
+        # of squares
+        used = (self._weights > 0) & ((lo_totals < self._lo_vec) | (hi_totals > self._hi_vec))
+        scale = np.sqrt(self._weights[used])
+        self._a = (self._density[:, used] * scale).T
+        self._a_lo = lo_bound[used] * scale
+        self._a_hi = hi_bound[used] * scale
+
+    def solve(self, volumes: np.ndarray, variables: np.ndarray) -> np.ndarray:
+        """
+        Minimizes the cost over some of the volumes (treating them as continuous), keeping the others fixed
+        @param volumes: Starting volumes of all sections
+        @param variables: Boolean mask of the volumes to optimize
+        @return: The optimized volumes
+        """
+        volumes = volumes.copy()
+        if not variables.any() or not len(self._a):
+            return volumes
+        self.iterations += 1
+
+        # Variables are the volumes followed by the (scaled) closest allowed nutrient totals u
+        a = self._a[:, variables]
+        fixed = self._a[:, ~variables] @ volumes[~variables]
+        u = np.clip(a @ volumes[variables] + fixed, self._a_lo, self._a_hi)
+        x = bounded_least_squares(np.hstack((a, -np.eye(len(u)))), -fixed,
+                                  np.concatenate((self._min_volume[variables], self._a_lo)),
+                                  np.concatenate((self._max_volume[variables], self._a_hi)),
+                                  np.concatenate((volumes[variables], u)))
+        volumes[variables] = x[:len(x) - len(u)]
+        return volumes
+
+    def run_algorithm(self):
+        """
+        Runs the algorithm
+        @return: None, the result of the algorithm will be stored in the final state (self.state).  You can use
+        backend.algorithm.integration to retrieve the result in a way that will be returned to the frontend.
+        self.iterations is the number of least squares problems solved
+        """
+        start_time = time.perf_counter()
+        deadline = start_time + self.time_budget if self.time_budget is not None else math.inf
+        stop_reason = STOP_CONVERGED
+        volumes = self._mid_volume.copy()
+
+        # Continuous relaxation
+        volumes = self.solve(volumes, np.ones(len(volumes), dtype=bool))
+
+        # Round the discrete sections, then move them one piece at a time while that improves the cost
+        if self._discrete.any():
+            continuous = ~self._discrete
+            volumes[self._discrete] = np.clip(np.round(volumes[self._discrete]), self._min_volume[self._discrete],
+                                              self._max_volume[self._discrete])
+            volumes = self.solve(volumes, continuous)
+            cost = self.cost_of_volumes(volumes)
+            improved = True
+            while improved:
+                if time.perf_counter() >= deadline:
+                    stop_reason = STOP_DEADLINE
+                    break
+                improved = False
+                for i in np.flatnonzero(self._discrete):
+                    for change in (-1, 1):
+                        if not self._min_volume[i] <= volumes[i] + change <= self._max_volume[i]:
+                            continue
+                        candidate = volumes.copy()
+                        candidate[i] += change
+                        candidate = self.solve(candidate, continuous)
+                        if (new_cost := self.cost_of_volumes(candidate)) < cost:
+                            volumes, cost, improved = candidate, new_cost, True
+
+        # Set result vars
+        self.state = [s.copy(int(round(volume)) if s.discrete else float(volume))
+                      for s, volume in zip(self.state, volumes)]
+        self.reset_cost()
+        self.runtime = time.perf_counter() - start_time
+        self.final_cost = self.cur_cost
+        self.stop_reason = stop_reason
+        self.done = True
+        if self.trace is not None:
+            self.trace.counters['least_squares'] += self.iterations
+            self.trace.counters[f'stop_{stop_reason}'] += 1
+            self.trace.timings['total'] += self.runtime
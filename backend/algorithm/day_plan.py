@@ -0,0 +1,59 @@
+from typing import Optional
+
+import numpy as np
+
+# The day's nutritional requirements are split between the student's meals in shares of this many equal parts
+DAY_PLAN_UNITS = 12
+
+# How many parts a meal's share may differ from an equal split of the day's requirements
+DAY_PLAN_SPREAD = 1
+
+
+def share_options(num_slots: int) -> list[int]:
+    """
+    @param num_slots: Number of meals (e.g. breakfast, lunch and dinner) the day's requirements are split between
+    @return: The shares (in parts of DAY_PLAN_UNITS) a single meal can get, in increasing order
+    """
+    lo = max(1, DAY_PLAN_UNITS // num_slots - DAY_PLAN_SPREAD)
+    hi = min(DAY_PLAN_UNITS, -(-DAY_PLAN_UNITS // num_slots) + DAY_PLAN_SPREAD)
+    return list(range(lo, hi + 1))
+
+
+def best_day_plan(costs: list[np.ndarray], options: list[int]) -> Optional[tuple[list[tuple[int, int]], float]]:
+    """
+    Chooses a meal for every slot of the day (e.g. which of the lunch menus to eat) and how much of the day's
+    requirements each of them gets, so that the shares add up to the whole day and the sum of the meals' costs is the
+    lowest.  Done with a DP over the slots and the parts of the day's requirements given out so far
+    @param costs: For each slot, an array of shape (# of meals in the slot, len(options)) with the cost of the best
+    item selection of each meal when it gets each share.  Infinite for the combinations that can't be chosen
+    @param options: The shares (in parts of DAY_PLAN_UNITS) a meal can get, see share_options
+    @return: For each slot, the index of the chosen meal and of its share in options, and the total cost.  None if the
+    shares can't add up to the whole day
+    """
+    options = np.asarray(options, dtype=int)
+    # best[u] is the lowest cost of the slots so far with u parts given out, choices[i][u] the meal and share of slot i
+    best = np.full(DAY_PLAN_UNITS + 1, np.inf)
+    best[0] = 0.
+    choices = []
+    for slot_costs in costs:
+        meal = np.argmin(slot_costs, axis=0)
+        meal_costs = slot_costs[meal, np.arange(len(options))]
+        new_best = np.full(DAY_PLAN_UNITS + 1, np.inf)
+        choice = np.zeros((DAY_PLAN_UNITS + 1, 2), dtype=int)
+        for k, units in enumerate(options):
+            candidate = best[:DAY_PLAN_UNITS + 1 - units] + meal_costs[k]
+            improved = candidate < new_best[units:]
+            new_best[units:][improved] = candidate[improved]
+            choice[units:][improved] = meal[k], k
+        best = new_best
+        choices.append(choice)
+
+    if not np.isfinite(best[DAY_PLAN_UNITS]):
+        return None
+    ret = []
+    units = DAY_PLAN_UNITS
+    for choice in reversed(choices):
+        meal, k = choice[units]
+        ret.append((int(meal), int(k)))
+        units -= options[k]
+    return ret[::-1], float(best[DAY_PLAN_UNITS])
@@ -0,0 +1,120 @@
+import concurrent.futures
+import concurrent.futures.process
+import threading
+
+from django.conf import settings
+
+# Executor types
+INLINE = 'inline'
+THREAD = 'thread'
+PROCESS = 'process'
+
+
+class AlgorithmUnavailable(Exception):
+    """
+    Raised when an algorithm can't be run right now, the views answer with 503 Service Unavailable
+    """
+    pass
+
+
+def _run_algorithm(alg):
+    alg.run_algorithm()
+    return alg
+
+
+class AlgorithmExecutor:
+    def __init__(self, kind: str, max_workers: int, max_queue: int, timeout: float):
+        """
+        Runs algorithm objects (anything with a run_algorithm() method, e.g. MealItemSelector or SimulatedAnnealing)
+        either inline in the calling thread, on a thread pool, or on a pool of worker processes
+        @param kind: One of INLINE, THREAD or PROCESS
+        @param max_workers: Number of pool workers
+        @param max_queue: How many algorithms may wait for a free worker before new ones are rejected
+        @param timeout: Seconds to wait for an algorithm to finish before giving up on it
+        """
+        if kind not in (INLINE, THREAD, PROCESS):
+            raise ValueError(f'Unknown executor type {kind}')
+        self.kind = kind
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.pool = self._create_pool()
+        self._pool_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+
+    def _create_pool(self) -> concurrent.futures.Executor:
+        if self.kind == THREAD:
+            return concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+        elif self.kind == PROCESS:
+            pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers)
+            for _ in range(self.max_workers):  # Start the worker processes now rather than on the first request
+                pool.submit(int)
+            return pool
+        return None
+
+    def _replace_broken_pool(self, pool: concurrent.futures.Executor):
+        """
+        Replaces a process pool that broke (e.g. because a worker was killed), unless another thread already did
+        @param pool: The broken pool
+        @return: None
+        """
+        with self._pool_lock:
+            if self.pool is pool:
+                pool.shutdown(wait=False)
+                self.pool = self._create_pool()
+
+    def run(self, alg):
+        """
+        Runs an algorithm and waits for it to finish
+        @param alg: The algorithm object
+        @return: The finished algorithm object.  For process pools this is a copy of alg, so the return value should
+        always be used rather than alg
+        @raise AlgorithmUnavailable: If too many algorithms are queued already, the algorithm took too long, or the
+        worker process running it died (the pool is then replaced, and the other algorithms on it fail too).  In the
+        second case an algorithm that is still waiting for a worker is dropped, but one that has started can't be
+        stopped: it runs to completion in the background and keeps its slot (so it still counts against max_workers +
+        max_queue) until then.  Algorithms that may run for long should stop themselves, like the portion optimizers
+        do after settings.PORTION_TIME_BUDGET and the item selectors after settings.ITEM_SELECTOR_TIME_BUDGET
+        """
+        if self.pool is None:
+            return _run_algorithm(alg)
+
+        if not self._slots.acquire(blocking=False):
+            raise AlgorithmUnavailable('The server is busy computing suggestions, please try again later')
+        pool = self.pool
+        try:
+            future = pool.submit(_run_algorithm, alg)
+        except concurrent.futures.process.BrokenProcessPool:
+            self._slots.release()
+            self._replace_broken_pool(pool)
+            raise AlgorithmUnavailable('The server is restarting its workers, please try again later')
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+
+        try:
+            return future.result(timeout=self.timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()  # Only succeeds if the algorithm hasn't started yet, see above
+            raise AlgorithmUnavailable('Computing the suggestion took too long, please try again later')
+        except concurrent.futures.process.BrokenProcessPool:
+            self._replace_broken_pool(pool)
+            raise AlgorithmUnavailable('The server is restarting its workers, please try again later')
+
+
+_executor: AlgorithmExecutor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> AlgorithmExecutor:
+    """
+    @return: The executor configured by settings.ALGORITHM_EXECUTOR and related settings, created on first use
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = AlgorithmExecutor(kind=settings.ALGORITHM_EXECUTOR,
+                                          max_workers=settings.ALGORITHM_EXECUTOR_WORKERS,
+                                          max_queue=settings.ALGORITHM_EXECUTOR_MAX_QUEUE,
+                                          timeout=settings.ALGORITHM_TIMEOUT)
+        return _executor
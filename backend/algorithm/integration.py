@@ -1,11 +1,53 @@
-from dacite import from_dict
+import dataclasses
+import random
+from typing import Union
+
+import numpy as np
 from django.conf import settings
 
+from backend.algorithm.cache import meal_snapshot_key, get_meal_snapshot, set_meal_snapshot, run_meal_item_selector, \
+    read_meal_cache, MealCacheEntries
+from backend.algorithm.convex import ConvexPortionSolver
+from backend.algorithm.day_plan import share_options, best_day_plan, DAY_PLAN_UNITS
 from backend.algorithm.item_choice import MealItemSelector
-from backend.algorithm.portion import PlateSectionState, SimulatedAnnealing, MealItemSpec, DEFAULT_COEFFICIENTS
-from backend.algorithm.requirements import nutritional_info_for, StudentProfileSpec
+from backend.algorithm.portion import PlateSectionState, SimulatedAnnealing, MealItemSpec, DEFAULT_COEFFICIENTS, \
+    PortionOptimizer, MultiStartAnnealing
+from backend.algorithm.requirements import cached_nutritional_info_for, StudentProfileSpec, quantize_requirements, \
+    MEALS_PER_DAY
+from backend.algorithm.snapshot import MealSnapshot, ItemPreferences
+from backend.algorithm.telemetry import AnnealingTrace
 from backend.models import MealItem, StudentProfile, MealSelection
 
+# Model fields that make up the specs, in the order of the dataclass fields
+STUDENT_PROFILE_SPEC_FIELDS = tuple(field.name for field in dataclasses.fields(StudentProfileSpec))
+MEAL_ITEM_SPEC_FIELDS = tuple(field.name for field in dataclasses.fields(MealItemSpec))
+
+
+def student_profile_spec_from_model(profile: StudentProfile) -> StudentProfileSpec:
+    """
+    @param profile: The student
+    @return: The student's profile as a StudentProfileSpec
+    """
+    return StudentProfileSpec(*(getattr(profile, name) for name in STUDENT_PROFILE_SPEC_FIELDS))
+
+
+def item_preferences_from_model(profile: StudentProfile) -> ItemPreferences:
+    """
+    @param profile: The student.  Its ban, favour and allergies can be prefetched (prefetch_related)
+    @return: The student's banned, favoured and allergenic items
+    """
+    return ItemPreferences(ban=frozenset(item.id for item in profile.ban.all()),
+                           favour=frozenset(item.id for item in profile.favour.all()),
+                           allergies=frozenset(ingredient.id for ingredient in profile.allergies.all()))
+
+
+def meal_item_spec_from_model(item: MealItem) -> MealItemSpec:
+    """
+    @param item: The meal item
+    @return: The meal item as a MealItemSpec
+    """
+    return MealItemSpec(*(getattr(item, name) for name in MEAL_ITEM_SPEC_FIELDS))
+
 
 def plate_section_state_from_model(item: MealItem, container_volume: float, num_sections: int,
                                    section_name: str) -> PlateSectionState:
@@ -17,13 +59,71 @@ def plate_section_state_from_model(item: MealItem, container_volume: float, num_
     @param section_name The name of the section (currently, "large", "small1", or "small2")
     @return A PlateSectionState object
     """
-    return PlateSectionState.from_item_spec(from_dict(MealItemSpec, item.__dict__), container_volume, num_sections,
+    return PlateSectionState.from_item_spec(meal_item_spec_from_model(item), container_volume, num_sections,
                                             section_name)
 
 
-def simulated_annealing_from_model(
+# Portion selecting algorithms
+ANNEALING = 'annealing'
+MULTI_START = 'multistart'
+CONVEX = 'convex'
+PORTION_ENGINES = (MULTI_START, ANNEALING, CONVEX)
+
+
+def sampled_trace() -> AnnealingTrace:
+    """
+    @return: A new trace for a fraction (settings.ALGORITHM_TRACE_SAMPLE_RATE) of the calls, None otherwise
+    """
+    return AnnealingTrace() if random.random() < settings.ALGORITHM_TRACE_SAMPLE_RATE else None
+
+
+def portion_optimizer(profile: StudentProfileSpec, state: list[PlateSectionState],
+                      engine: str = MULTI_START, trace: AnnealingTrace = None) -> PortionOptimizer:
+    """
+    @param profile: The student to choose the portions for
+    @param state: The plate sections, see PortionOptimizer
+    @param engine: Which algorithm to use, one of PORTION_ENGINES
+    @param trace: See PortionOptimizer
+    @return: A portion selector object (MultiStartAnnealing, SimulatedAnnealing or ConvexPortionSolver) with the
+    parameters used in production
+    """
+    requirements = cached_nutritional_info_for(profile)
+    if engine == MULTI_START:
+        return MultiStartAnnealing(profile=profile,
+                                   state=state,
+                                   coefficients=DEFAULT_COEFFICIENTS,
+                                   alpha=0.98,
+                                   smallest_temp=0.0005,
+                                   seed=20210226 if settings.PROD else -1,
+                                   num_starts=256,
+                                   requirements=requirements,
+                                   time_budget=settings.PORTION_TIME_BUDGET,
+                                   plateau_steps=settings.PORTION_PLATEAU_STEPS,
+                                   trace=trace)
+    if engine == CONVEX:
+        return ConvexPortionSolver(profile=profile,
+                                   state=state,
+                                   coefficients=DEFAULT_COEFFICIENTS,
+                                   requirements=requirements,
+                                   time_budget=settings.PORTION_TIME_BUDGET,
+                                   trace=trace)
+    return SimulatedAnnealing(profile=profile,
+                              state=state,
+                              coefficients=DEFAULT_COEFFICIENTS,
+                              alpha=0.999,
+                              smallest_temp=0.0005,
+                              seed=20210226 if settings.PROD else -1,
+                              requirements=requirements,
+                              time_budget=settings.PORTION_TIME_BUDGET,
+                              plateau_steps=settings.PORTION_PLATEAU_STEPS,
+                              trace=trace,
+                              schedule=settings.PORTION_SCHEDULE)
+
+
+def portion_optimizer_from_model(
         profile: StudentProfile, large: list[MealItem], small1: list[MealItem], small2: list[MealItem],
-        large_max_volume: float, small_max_volume: float) -> SimulatedAnnealing:
+        large_max_volume: float, small_max_volume: float, engine: str = MULTI_START,
+        trace: AnnealingTrace = None) -> PortionOptimizer:
     """
     @param profile: The student to choose the portions for
     @param large: List of meal items to be put in the large section
@@ -31,8 +131,10 @@ def simulated_annealing_from_model(
     @param small2: List of meal items to be put in the second small section
     @param large_max_volume: Size of the large plate section, in mL
     @param small_max_volume: Size of the small plate section, in mL
-    @return: Returns SimulatedAnnealing (portion selector) object using Django DB model objects instead of the
-    dataclass objects normally used
+    @param engine: Which algorithm to use, one of PORTION_ENGINES
+    @param trace: See PortionOptimizer
+    @return: Returns a portion selector object (MultiStartAnnealing, SimulatedAnnealing or ConvexPortionSolver) using
+    Django DB model objects instead of the dataclass objects normally used
     """
 
     initial_state = []
@@ -42,15 +144,10 @@ def simulated_annealing_from_model(
         for item in items:
             initial_state.append(plate_section_state_from_model(item, container_volume, len(items), section_name))
 
-    return SimulatedAnnealing(profile=from_dict(StudentProfileSpec, profile.__dict__),
-                              state=initial_state,
-                              coefficients=DEFAULT_COEFFICIENTS,
-                              alpha=0.999,
-                              smallest_temp=0.0005,
-                              seed=20210226 if settings.PROD else -1)
+    return portion_optimizer(student_profile_spec_from_model(profile), initial_state, engine, trace)
 
 
-def result_object_for_simulated_annealing(obj: SimulatedAnnealing) -> list[dict[str, any]]:
+def result_object_for_portion_optimizer(obj: PortionOptimizer) -> list[dict[str, any]]:
     """
     @param obj: Object to generate result object from
     @return: Returns the result of the algorithm according to the endpoint specifications in the README.md.  The result will be in a JSON-serializable format
@@ -63,21 +160,130 @@ def result_object_for_simulated_annealing(obj: SimulatedAnnealing) -> list[dict[
     } for state in obj.state]
 
 
-def meal_item_selector_from_model(meal: MealSelection, profile: StudentProfile,
-                                  large_portion_max: float, small_portion_max: float):
+def meal_item_specs_from_model(meal: MealSelection) -> list[MealItemSpec]:
+    """
+    @param meal: The meal
+    @return: The items of the meal, as MealItemSpec.  Only the needed columns are loaded, without creating MealItem
+    objects
+    """
+    return [MealItemSpec(*row) for row in meal.items.values_list(*MEAL_ITEM_SPEC_FIELDS)]
+
+
+def meal_snapshot_from_model(meal: MealSelection, entries: MealCacheEntries = None) -> MealSnapshot:
+    """
+    @param meal: The meal
+    @param entries: The meal's cache entries, if they were already read (see backend.algorithm.cache.read_meal_cache)
+    @return: A snapshot of the meal's items.  Cached until the meal's items change (see backend.algorithm.cache)
+    """
+    key = meal_snapshot_key(meal.id, entries)
+    if (snapshot := get_meal_snapshot(key)) is None:
+        item_ingredients = MealItem.ingredients.through.objects.filter(mealitem__mealselection=meal) \
+            .values_list('mealitem_id', 'ingredient_id')
+        snapshot = MealSnapshot.from_item_specs(meal_item_specs_from_model(meal), list(item_ingredients))
+        set_meal_snapshot(key, snapshot)
+    return snapshot
+
+
+def meal_item_selector(profile: StudentProfileSpec, items: Union[list[MealItemSpec], MealSnapshot],
+                       large_portion_max: float, small_portion_max: float, num_alternatives: int = 0,
+                       trace: AnnealingTrace = None, favoured: frozenset = frozenset(),
+                       share_scales: tuple[float, ...] = ()) -> MealItemSelector:
     """
-    Creates a MealItemSelector class from Django model objects rather than the expected dataclasses
-    @param meal: The meal to choose items from
     @param profile: The student to choose the items for
+    @param items: The items to choose from
     @param large_portion_max: The size of the large container section (in mL)
     @param small_portion_max: The size of the small container sections (in mL)
-    @return: Returns MealItemSelector class created from Django model objects rather than the expected dataclasses
+    @param num_alternatives: See MealItemSelector
+    @param trace: See MealItemSelector
+    @param favoured: See MealItemSelector
+    @param share_scales: See MealItemSelector
+    @return: A MealItemSelector with the parameters used in production
     """
-    return MealItemSelector(profile=from_dict(StudentProfileSpec, profile.__dict__),
-                            items=[from_dict(MealItemSpec, item.__dict__) for item in meal.items.all()],
+    return MealItemSelector(profile=profile,
+                            items=items,
                             large_portion_max=large_portion_max,
                             small_portion_max=small_portion_max,
                             coefficients=DEFAULT_COEFFICIENTS,
                             sa_alpha=0.99,
                             sa_lo=0.01,
-                            seed=20210226 if settings.PROD else -1)
+                            seed=20210226 if settings.PROD else -1,
+                            requirements=quantize_requirements(*cached_nutritional_info_for(profile),
+                                                               settings.REQUIREMENT_BUCKET_RATIO),
+                            num_alternatives=num_alternatives,
+                            trace=trace,
+                            favoured=favoured,
+                            share_scales=share_scales,
+                            time_budget=settings.ITEM_SELECTOR_TIME_BUDGET)
+
+
+def meal_item_selector_from_model(meal: MealSelection, profile: StudentProfile,
+                                  large_portion_max: float, small_portion_max: float,
+                                  preferences: ItemPreferences, snapshot: MealSnapshot = None,
+                                  num_alternatives: int = 0, trace: AnnealingTrace = None):
+    """
+    Creates a MealItemSelector class from Django model objects rather than the expected dataclasses.  The student's
+    requirements can be quantized (see settings.REQUIREMENT_BUCKET_RATIO) so that the selector's triple costs are shared
+    between more students (see backend.algorithm.cache)
+    @param meal: The meal to choose items from
+    @param profile: The student to choose the items for
+    @param large_portion_max: The size of the large container section (in mL)
+    @param small_portion_max: The size of the small container sections (in mL)
+    @param preferences: The student's preferences.  Banned and allergenic items are never chosen, and favoured items
+    are preferred
+    @param snapshot: The meal's snapshot, if it was already loaded (e.g. when creating selectors for many students)
+    @param num_alternatives: See MealItemSelector
+    @param trace: See MealItemSelector
+    @return: Returns MealItemSelector class created from Django model objects rather than the expected dataclasses
+    """
+    return meal_item_selector(student_profile_spec_from_model(profile),
+                              (snapshot or meal_snapshot_from_model(meal)).subset(preferences),
+                              large_portion_max, small_portion_max, num_alternatives, trace,
+                              favoured=preferences.favour)
+
+
+def day_plan_from_model(profile: StudentProfile, meals: list[MealSelection], large_portion_max: float,
+                        small_portion_max: float, preferences: ItemPreferences) -> list[dict]:
+    """
+    Plans a student's meals for a day.  The day's requirements are split between the meals (see
+    backend.algorithm.day_plan) instead of giving each a third of them, and the items of each meal are selected for its
+    share.  Each meal's triples are annealed for the usual requirements, and then for every share it can get starting
+    from their best volumes (see MealItemSelector.share_scales).  The costs and volumes for the usual requirements are
+    cached with those of the usual suggestions, so only the triples no suggestion annealed yet are annealed from scratch
+    @param profile: The student to plan the day of
+    @param meals: The day's meals the student eats, in order.  Meals of the same group (e.g. two lunch menus) are
+    alternatives, only one of them is planned
+    @param large_portion_max: The size of the large container section (in mL)
+    @param small_portion_max: The size of the small container sections (in mL)
+    @param preferences: See meal_item_selector_from_model
+    @return: The planned meals, each as an object with the fields 'meal' (ID), 'group', 'share' (the fraction of the
+    day's requirements it meets) and those of MealItemSelector.result_obj.  Empty if no plan is feasible
+    """
+    slots = {}
+    for meal in meals:
+        slots.setdefault(meal.group, []).append(meal)
+    slots = list(slots.values())
+    if not slots:
+        return []
+
+    profile_spec = student_profile_spec_from_model(profile)
+    options = share_options(len(slots))
+    share_scales = tuple(units / DAY_PLAN_UNITS * MEALS_PER_DAY for units in options)
+    selectors, costs = [], []  # selectors[slot][meal], and the costs of their selections for each share
+    for slot in slots:
+        selectors.append([])
+        for meal in slot:
+            entries = read_meal_cache(meal.id)
+            selectors[-1].append(run_meal_item_selector(meal.id, meal_item_selector(
+                profile_spec, meal_snapshot_from_model(meal, entries).subset(preferences), large_portion_max,
+                small_portion_max, favoured=preferences.favour, share_scales=share_scales), entries))
+        costs.append(np.array([alg.share_result_costs for alg in selectors[-1]]))
+    if (best := best_day_plan(costs, options)) is None:
+        return []
+    plan, _ = best
+
+    return [{
+        'meal': slot[i].id,
+        'group': slot[i].group,
+        'share': options[k] / DAY_PLAN_UNITS,
+        **slot_selectors[i].shares_obj()[k]
+    } for slot, slot_selectors, (i, k) in zip(slots, selectors, plan)]
@@ -1,10 +1,17 @@
+import heapq
 import itertools
 import time
+from dataclasses import dataclass
+from typing import Union
 
-from .common import BUILD_MUSCLE, LOSE_WEIGHT, ATHLETIC_PERFORMANCE, IMPROVE_TONE, IMPROVE_HEALTH, PROTEIN, GRAINS, \
+import numpy as np
+
+from .common import Nutrition, BUILD_MUSCLE, LOSE_WEIGHT, ATHLETIC_PERFORMANCE, IMPROVE_TONE, IMPROVE_HEALTH, PROTEIN, GRAINS, \
     VEGETABLE
-from .portion import SimulatedAnnealing, PlateSectionState, MealItemSpec
+from .portion import BatchSimulatedAnnealing, MealItemSpec, SectionCandidates
 from .requirements import nutritional_info_for, StudentProfileSpec
+from .snapshot import MealSnapshot, CATEGORIES
+from .telemetry import AnnealingTrace
 
 
 class PlateSection:
@@ -30,16 +37,262 @@ LARGE_PORTION = {
 # How many items to pick
 CHOOSE_COUNT = 3
 
+# The cost of a triple is multiplied by this for every favoured item in it, when searching for the best combination
+FAVOURED_DISCOUNT = 0.7
+
+
+@dataclass
+class TripleCosts:
+    """
+    The (annealed) cost of every (large, small1, small2) item triple, as a dense array indexed by the position of each
+    item in its section.  Triples that were pruned (see pruned_triples) have cost NaN
+    """
+    large_ids: tuple[int, ...]
+    small1_ids: tuple[int, ...]
+    small2_ids: tuple[int, ...]
+    costs: np.ndarray  # Shape (len(large_ids), len(small1_ids), len(small2_ids))
+    # The best volumes annealing found for the (large, small1, small2) sections of each triple, with shape costs.shape +
+    # (3,).  NaN for the triples without a cost, None if none are known
+    volumes: np.ndarray = None
+
+    def to_bytes(self) -> bytes:
+        """
+        @return: Compact binary form of the object: the three section sizes, whether there are volumes (0 or 1), the
+        item IDs, the costs and then the volumes, as int64 and float64 values
+        """
+        ids = self.large_ids + self.small1_ids + self.small2_ids
+        ret = np.array(self.costs.shape + (int(self.volumes is not None),) + ids, dtype=np.int64).tobytes() + \
+            np.ascontiguousarray(self.costs, dtype=np.float64).tobytes()
+        if self.volumes is not None:
+            ret += np.ascontiguousarray(self.volumes, dtype=np.float64).tobytes()
+        return ret
+
+    def _lookup(self, array: np.ndarray, large_ids, small1_ids, small2_ids) -> np.ndarray:
+        ret = np.full((len(large_ids), len(small1_ids), len(small2_ids)) + array.shape[3:], np.nan)
+        have, want = [], []
+        for have_ids, want_ids in zip((self.large_ids, self.small1_ids, self.small2_ids),
+                                      (large_ids, small1_ids, small2_ids)):
+            index_of = {item_id: i for i, item_id in enumerate(have_ids)}
+            want.append([i for i, item_id in enumerate(want_ids) if item_id in index_of])
+            have.append([index_of[item_id] for item_id in want_ids if item_id in index_of])
+        ret[np.ix_(*want)] = array[np.ix_(*have)]
+        return ret
+
+    def lookup(self, large_ids, small1_ids, small2_ids) -> np.ndarray:
+        """
+        @param large_ids: IDs of the large section items to get the triple costs of, in order
+        @param small1_ids: Self-explanatory
+        @param small2_ids: Self-explanatory
+        @return: Array with the cost of each triple of the given items, NaN for triples with items not in this object
+        """
+        return self._lookup(self.costs, large_ids, small1_ids, small2_ids)
+
+    def lookup_volumes(self, large_ids, small1_ids, small2_ids) -> np.ndarray:
+        """
+        @param large_ids: See lookup
+        @param small1_ids: See lookup
+        @param small2_ids: See lookup
+        @return: Array with the volumes of each triple of the given items (see volumes), NaN for unknown triples
+        """
+        volumes = self.volumes if self.volumes is not None else np.full(self.costs.shape + (3,), np.nan)
+        return self._lookup(volumes, large_ids, small1_ids, small2_ids)
+
+    def merged_with(self, other):
+        """
+        @param other: Triple costs of (possibly) other items, computed for the same requirements and parameters
+        @return: Triple costs of the items of both objects.  Triples known by neither (e.g. a large item only in self
+        with a small1 item only in other) have cost NaN
+        """
+        section_ids = tuple(ids + tuple(item_id for item_id in other_ids if item_id not in set(ids))
+                            for ids, other_ids in zip((self.large_ids, self.small1_ids, self.small2_ids),
+                                                      (other.large_ids, other.small1_ids, other.small2_ids)))
+        costs = np.full(tuple(map(len, section_ids)), np.nan)
+        costs[:self.costs.shape[0], :self.costs.shape[1], :self.costs.shape[2]] = self.costs
+        other_costs = other.lookup(*section_ids)
+        known = ~np.isnan(other_costs)
+        costs[known] = other_costs[known]
+        volumes = None
+        if self.volumes is not None or other.volumes is not None:
+            volumes = self.lookup_volumes(*section_ids)
+            volumes[known] = other.lookup_volumes(*section_ids)[known]
+        return TripleCosts(*section_ids, costs=costs, volumes=volumes)
+
+    def without(self, item_ids):
+        """
+        @param item_ids: IDs of items to leave out
+        @return: Triple costs of the items of this object that aren't in item_ids
+        """
+        keep = [[i for i, item_id in enumerate(ids) if item_id not in item_ids]
+                for ids in (self.large_ids, self.small1_ids, self.small2_ids)]
+        return TripleCosts(*(tuple(ids[i] for i in indices)
+                             for ids, indices in zip((self.large_ids, self.small1_ids, self.small2_ids), keep)),
+                           costs=self.costs[np.ix_(*keep)],
+                           volumes=self.volumes[np.ix_(*keep)] if self.volumes is not None else None)
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        """
+        Loads an object created by to_bytes.  The arrays are read-only views of data (i.e. they're not copied)
+        @param data: Self-explanatory
+        @return: A TripleCosts object
+        """
+        header = np.frombuffer(data, dtype=np.int64, count=4).tolist()
+        shape, has_volumes = tuple(header[:3]), header[3]
+        ids = np.frombuffer(data, dtype=np.int64, count=sum(shape), offset=4 * 8).tolist()
+        size = shape[0] * shape[1] * shape[2]
+        offset = (4 + sum(shape)) * 8
+        costs = np.frombuffer(data, dtype=np.float64, count=size, offset=offset).reshape(shape)
+        volumes = None
+        if has_volumes:
+            volumes = np.frombuffer(data, dtype=np.float64, count=size * 3, offset=offset + size * 8) \
+                .reshape(shape + (3,))
+        return cls(large_ids=tuple(ids[:shape[0]]),
+                   small1_ids=tuple(ids[shape[0]:shape[0] + shape[1]]),
+                   small2_ids=tuple(ids[shape[0] + shape[1]:]),
+                   costs=costs,
+                   volumes=volumes)
+
+
+def best_combination(costs: np.ndarray, choose: int) -> tuple[tuple[int, ...], tuple[int, ...], tuple[int, ...], float]:
+    """
+    Finds the cheapest combination of items, given the cost of every (large, small1, small2) triple.  A combination is
+    a subset of size min(choose, # of items) of each section's items, and its cost is the sum of the costs of all
+    triples in the product of the subsets.
+
+    This gives the same result as checking every combination in itertools order (including the tie-breaking), but
+    once the large and small1 subsets are fixed the cost is a sum of independent per-item terms over the small2 items,
+    so the best small2 subset is simply the `choose` items with the smallest terms.
+    @param costs: Array of shape (# large items, # small1 items, # small2 items) with the cost of each triple
+    @param choose: How many items to pick for each section
+    @return: Indices of the chosen large, small1 and small2 items (in increasing order) and the cost of the combination
+    """
+    k_l, k_s1, k_s2 = (min(choose, n) for n in costs.shape)
+    if costs.size == 0:  # Every combination costs nothing, so the first one is picked
+        return tuple(range(k_l)), tuple(range(k_s1)), tuple(range(k_s2)), 0.
+
+    combs_l = np.array(list(itertools.combinations(range(costs.shape[0]), k_l)), dtype=int)
+    combs_s1 = np.array(list(itertools.combinations(range(costs.shape[1]), k_s1)), dtype=int)
+
+    best_cost, best_l, best_s1 = None, 0, 0
+    for i_l, comb_l in enumerate(combs_l):
+        # terms[i_s1][z] is the cost of small2 item z given the large subset i_l and small1 subset i_s1
+        terms = costs[comb_l].sum(axis=0)[combs_s1].sum(axis=1)
+        comb_costs = np.partition(terms, k_s2 - 1, axis=1)[:, :k_s2].sum(axis=1)
+        i_s1 = int(np.argmin(comb_costs))
+        if best_cost is None or comb_costs[i_s1] < best_cost:
+            best_cost, best_l, best_s1 = comb_costs[i_s1], i_l, i_s1
+
+    comb_l, comb_s1 = combs_l[best_l], combs_s1[best_s1]
+    terms = costs[comb_l].sum(axis=0)[comb_s1].sum(axis=0)
+    comb_s2 = np.sort(np.argsort(terms, kind='stable')[:k_s2])
+    return tuple(comb_l.tolist()), tuple(comb_s1.tolist()), tuple(comb_s2.tolist()), float(best_cost)
+
+
+def top_combinations(costs: np.ndarray, choose: int, count: int) \
+        -> list[tuple[tuple[int, ...], tuple[int, ...], tuple[int, ...], float]]:
+    """
+    Finds the `count` cheapest combinations of items (see best_combination), in one pass with a bounded heap.  The
+    combinations of a (large subset, small1 subset) pair whose best small2 subset (found as in best_combination) isn't
+    cheaper than the worst combination kept so far are skipped without enumerating their small2 subsets
+    @param costs: See best_combination
+    @param choose: See best_combination
+    @param count: How many combinations to return
+    @return: The combinations, in the format returned by best_combination, cheapest first.  Ties are broken in
+    itertools order, so the first combination is the one best_combination returns
+    """
+    k_l, k_s1, k_s2 = (min(choose, n) for n in costs.shape)
+    if costs.size == 0 or count <= 0:
+        return [best_combination(costs, choose)][:count]
+
+    combs_l = np.array(list(itertools.combinations(range(costs.shape[0]), k_l)), dtype=int)
+    combs_s1 = np.array(list(itertools.combinations(range(costs.shape[1]), k_s1)), dtype=int)
+    combs_s2 = np.array(list(itertools.combinations(range(costs.shape[2]), k_s2)), dtype=int)
+
+    # Max-heap (by cost, then by itertools order) of the best combinations found so far, as
+    # (-cost, -i_l, -i_s1, -i_s2) so that the root is the combination to drop first
+    heap = []
+    for i_l, comb_l in enumerate(combs_l):
+        terms = costs[comb_l].sum(axis=0)[combs_s1].sum(axis=1)
+        bound = -heap[0][0] if len(heap) == count else np.inf
+        row_best = np.partition(terms, k_s2 - 1, axis=1)[:, :k_s2].sum(axis=1)
+        rows = np.flatnonzero(row_best <= bound + 1e-9 * abs(bound))
+        if not len(rows):
+            continue
+
+        # Only the `count` cheapest candidates (and ties) of this batch can make it into the heap
+        comb_costs = terms[rows][:, combs_s2].sum(axis=2).ravel()
+        candidates = np.flatnonzero(comb_costs <= bound)
+        if len(candidates) > count:
+            kth = np.partition(comb_costs[candidates], count - 1)[count - 1]
+            candidates = candidates[comb_costs[candidates] <= kth]
+        for r, i_s2 in zip(*np.divmod(candidates, len(combs_s2))):
+            entry = (-float(comb_costs[r * len(combs_s2) + i_s2]), -i_l, -int(rows[r]), -int(i_s2))
+            if len(heap) < count:
+                heapq.heappush(heap, entry)
+            elif entry > heap[0]:
+                heapq.heapreplace(heap, entry)
+
+    return [(tuple(combs_l[-i_l].tolist()), tuple(combs_s1[-i_s1].tolist()), tuple(combs_s2[-i_s2].tolist()), -cost)
+            for cost, i_l, i_s1, i_s2 in sorted(heap, reverse=True)]
+
+
+def smallest_sums(costs: np.ndarray, k: int, axis: int) -> np.ndarray:
+    """
+    @param costs: Self-explanatory
+    @param k: How many costs to sum, at least 1
+    @param axis: Axis to sum over
+    @return: The sums of the k smallest costs along the axis
+    """
+    return np.partition(costs, k - 1, axis=axis).take(range(k), axis=axis).sum(axis=axis)
+
+
+def pruned_triples(lower: np.ndarray, upper: np.ndarray, choose: int, count: int) -> np.ndarray:
+    """
+    Finds the triples that can't be in any of the `count` cheapest combinations (see top_combinations), given bounds on
+    the cost of every triple.  The triples of a combination containing an item include one triple of that item with
+    every chosen item of each other section, so (by the lower bounds) they cost at least the sum of the smallest sums of
+    that item's triples, and so on for the section's other chosen items.  If that is more than the cost of the
+    `count`-th cheapest combination by the upper bounds, the item is in none of the cheapest combinations
+    @param lower: Lower bounds of the (non-negative) triple costs, in the format of best_combination's costs
+    @param upper: Upper bounds of the triple costs, with the same shape
+    @param choose: See best_combination
+    @param count: How many of the cheapest combinations have to be kept
+    @return: Boolean array with the shape of the costs, true for the triples of the items that can be left out
+    """
+    ret = np.zeros(lower.shape, dtype=bool)
+    if lower.size == 0:
+        return ret
+
+    combinations = top_combinations(upper, choose, count) if count > 1 else [best_combination(upper, choose)]
+    threshold = combinations[-1][3]
+    threshold += 1e-9 * abs(threshold)  # Rounding errors of the different summation orders
+    for axis in range(lower.ndim):
+        costs = np.moveaxis(lower, axis, 0)
+        k, k1, k2 = (min(choose, n) for n in costs.shape)
+        # Cheapest triples of each item of this section with the chosen items of the other two, summed in either order
+        item_bounds = np.maximum(smallest_sums(smallest_sums(costs, k2, 2), k1, 1),
+                                 smallest_sums(smallest_sums(costs, k1, 1), k2, 1))
+        # Plus the k - 1 cheapest other items of this section
+        order = np.argsort(item_bounds, kind='stable')
+        bounds = item_bounds + item_bounds[order[:k - 1]].sum()
+        bounds[order[:k - 1]] = item_bounds[order[:k]].sum()
+        np.moveaxis(ret, axis, 0)[bounds > threshold] = True
+    return ret
+
 
 class MealItemSelector:
-    def __init__(self, profile: StudentProfileSpec, items: list[MealItemSpec],
+    def __init__(self, profile: StudentProfileSpec, items: Union[list[MealItemSpec], MealSnapshot],
                  large_portion_max: float, small_portion_max: float,
-                 coefficients: tuple[float], sa_alpha: float, sa_lo: float, seed: int):
+                 coefficients: tuple[float], sa_alpha: float, sa_lo: float, seed: int,
+                 requirements: tuple[Nutrition, Nutrition] = None, triple_costs: TripleCosts = None,
+                 num_alternatives: int = 0, trace: AnnealingTrace = None, prune: bool = True,
+                 favoured: frozenset = frozenset(), share_scales: tuple[float, ...] = (), time_budget: float = None):
         """
         Creates a MealItemSelector object, which runs the algorithm that selects the best item choices given a list of
         meal items.
         @param profile: An object that contains the correct biological/health properties of the student to choose for
-        @param items: A list of MealItemSpec, which represent the list of meal items available at the meal
+        @param items: The meal items available at the meal, as a list of MealItemSpec or a MealSnapshot (e.g.
+        MealSnapshot.subset, so that they don't have to be unpacked)
         @param large_portion_max: Size of the large plate section (mL)
         @param small_portion_max: Size of the small plate sections (mL)
         @param coefficients: List of weights denoting how much each nutrient is weighted.  The cost of a state is
@@ -49,6 +302,26 @@ class MealItemSelector:
         @param sa_alpha: Alpha for simulated annealing runs
         @param sa_lo: Minimum temperature for simulated annealing runs
         @param seed: RNG seed for simulated annealing runs
+        @param requirements: The (lo, hi) nutritional requirements to use, if they were already computed.  Computed from
+        the profile otherwise
+        @param triple_costs: Previously computed triple costs (for the same requirements and parameters) to reuse.  Only
+        triples with items missing from it are annealed
+        @param num_alternatives: How many runner-up selections to find besides the best one (see alternatives_obj)
+        @param trace: If given, the annealing progress (see BatchSimulatedAnnealing), the number of annealed, pruned and
+        cached triples and the time spent searching for the best combination are recorded in it
+        @param prune: Whether to skip annealing the triples that can't be in the result, see pruned_triples.  Their
+        costs are left NaN in self.triple_costs
+        @param favoured: IDs of the items the student favours.  The triples containing them are discounted (see
+        FAVOURED_DISCOUNT) in the search for the best combination, but not in self.triple_costs, so that the triple
+        costs can still be shared between students
+        @param share_scales: Factors to scale the requirements by, e.g. for the other shares of the day's requirements a
+        meal can get (see backend.algorithm.day_plan).  For each of them, every triple is annealed again for the scaled
+        requirements, starting from its best volumes scaled (see BatchSimulatedAnnealing.rescaled_volumes), and the
+        best selection is stored (see shares_obj).  The warm start usually ends up at least as good as annealing from
+        scratch, and these runs aren't counted in num_annealed.  That needs the best volumes of every triple, so the
+        triples whose volumes aren't in the given triple_costs are annealed too, and prune is ignored
+        @param time_budget: If given, all annealing stops after this many seconds in total, keeping the best volumes
+        found so far (see BatchSimulatedAnnealing)
         """
         self.profile = profile
         self.items = items
@@ -60,9 +333,21 @@ class MealItemSelector:
         self.large_portion_max = large_portion_max
         self.small_portion_max = small_portion_max
 
-        self.requirements = nutritional_info_for(profile)
+        self.requirements = requirements or nutritional_info_for(profile)
+        self.triple_costs: TripleCosts = triple_costs
+        self.num_alternatives = num_alternatives
+        self.trace = trace
+        self.prune = prune
+        self.favoured = favoured
+        self.share_scales = share_scales
+        self.time_budget = time_budget
         self._result_obj = {}
+        self._alternatives_obj = []
+        self._shares_obj = []
         self.result_cost = -1
+        self.share_result_costs = []  # Cost of each selection of shares_obj
+        self.num_annealed = 0  # How many triples had to be annealed (i.e. weren't in the given triple_costs)
+        self.num_pruned = 0  # How many triples weren't in the given triple_costs but didn't need to be annealed
         self.runtime = -1
         self.done = False
 
@@ -71,9 +356,10 @@ class MealItemSelector:
         small1_category = VEGETABLE
         small2_category = GRAINS
 
-        large_items = [item for item in self.items if item.category == PROTEIN]
-        small1_items = [item for item in self.items if item.category == VEGETABLE]
-        small2_items = [item for item in self.items if item.category == GRAINS]
+        # The items are sliced from the arrays of a snapshot, by their indices in it
+        items = self.items if isinstance(self.items, MealSnapshot) else MealSnapshot.from_item_specs(self.items)
+        large_items, small1_items, small2_items = (np.flatnonzero(items.categories == CATEGORIES.index(category))
+                                                   for category in (PROTEIN, VEGETABLE, GRAINS))
 
         large_portion = LARGE_PORTION[self.profile.health_goal]
         # TODO: remove later, temporary workaround to allow for 2 sections for testing breakfast
@@ -87,63 +373,140 @@ class MealItemSelector:
             large_items, small2_items = small2_items, large_items
             large_category, small2_category = small2_category, large_category
 
-        cost_cache = {}
         start_time = time.perf_counter()
+        deadline = start_time + self.time_budget if self.time_budget is not None else None
+
+        section_items = (large_items, small1_items, small2_items)
+        section_ids = tuple(tuple(items.ids[indices].tolist()) for indices in section_items)
+        if self.triple_costs is None:
+            costs = np.full(tuple(map(len, section_items)), np.nan)
+            volumes = np.full(costs.shape + (3,), np.nan)
+        else:
+            costs = self.triple_costs.lookup(*section_ids)
+            volumes = self.triple_costs.lookup_volumes(*section_ids)
 
-        def cache_id(item_1, item_2, item_3):
-            return f'{item_1.id}-{item_2.id}-{item_3.id}'
-
-        for item_l, item_s1, item_s2 in itertools.product(large_items, small1_items, small2_items):
-            sa = SimulatedAnnealing(profile=self.profile,
-                                    state=[PlateSectionState.from_item_spec(item, volume, 1, 'who cares')
-                                           for item, volume in zip((item_l, item_s1, item_s2), (
-                                        self.large_portion_max, self.small_portion_max, self.small_portion_max))],
-                                    coefficients=self.coefficients,
-                                    alpha=self.sa_alpha,
-                                    smallest_temp=self.sa_lo,
-                                    seed=self.seed)
-            sa.run_algorithm()
-            cost_cache[cache_id(item_l, item_s1, item_s2)] = sa.final_cost
-
-        best = [], [], []
-        best_cost = sum(cost_cache.values()) + 1
-        for comb_l, comb_s1, comb_s2 in itertools.product(
-                itertools.combinations(large_items, min(CHOOSE_COUNT, len(large_items))),
-                itertools.combinations(small1_items, min(CHOOSE_COUNT, len(small1_items))),
-                itertools.combinations(small2_items, min(CHOOSE_COUNT, len(small2_items)))
-        ):
-            l1 = list(comb_l)
-            l2 = list(comb_s1)
-            l3 = list(comb_s2)
-            cur_cost = 0
-            for x, y, z in itertools.product(l1, l2, l3):
-                cur_cost += cost_cache[cache_id(x, y, z)]
-
-            if cur_cost < best_cost:
-                best_cost = cur_cost
-                best = (l1, l2, l3)
-
-        def to_id_list(items):
-            return [item.id for item in items]
-
-        l1, l2, l3 = best
-        self._result_obj = {
-            PlateSection.LARGE: {
-                'items': to_id_list(l1),
-                'category': large_category
-            },
-            PlateSection.SMALL1: {
-                'items': to_id_list(l2),
-                'category': small1_category
-            },
-            PlateSection.SMALL2: {
-                'items': to_id_list(l3),
-                'category': small2_category
-            },
-        }
-        self.result_cost = best_cost
+        # Every favoured item of a triple multiplies its cost by FAVOURED_DISCOUNT
+        favoured = [np.isin(ids, list(self.favoured)).astype(int) for ids in section_ids]
+        discount = FAVOURED_DISCOUNT ** (favoured[0][:, None, None] + favoured[1][None, :, None] +
+                                         favoured[2][None, None, :])
+
+        # Anneal every triple we don't know the cost of at once, or the volumes of, if the shares start from them
+        unknown = np.isnan(costs)
+        if self.share_scales:
+            unknown |= np.isnan(volumes).any(axis=-1)
+        choices = np.argwhere(unknown)
+        search_costs = costs
+        sections = [SectionCandidates.from_items(items.portion_volumes[indices], items.max_pieces[indices],
+                                                 items.nutrients[indices], volume, 1)
+                    for indices, volume in zip(section_items, (
+                        self.large_portion_max, self.small_portion_max, self.small_portion_max))]
+
+        def annealing(choices, initial_volumes=None, requirements=None):
+            return BatchSimulatedAnnealing(profile=self.profile,
+                                           sections=sections,
+                                           choices=choices,
+                                           coefficients=self.coefficients,
+                                           alpha=self.sa_alpha,
+                                           smallest_temp=self.sa_lo,
+                                           seed=self.seed,
+                                           requirements=requirements or self.requirements,
+                                           initial_volumes=initial_volumes,
+                                           time_budget=None if deadline is None else deadline - time.perf_counter(),
+                                           trace=self.trace,
+                                           chain_keys=np.stack([np.asarray(ids, dtype=np.int64)[choices[:, j]]
+                                                                for j, ids in enumerate(section_ids)], axis=1))
+
+        if len(choices):
+            # Leave out the triples whose cost bounds show that they can't be in the result.  Their lower bounds
+            # stand in for their costs in the search, which can't make them part of the result either
+            if self.prune and not self.share_scales:
+                lower, upper = costs.copy(), costs.copy()
+                lower[tuple(choices.T)], upper[tuple(choices.T)] = annealing(choices).cost_bounds()
+                pruned = pruned_triples(lower * discount, upper * discount, CHOOSE_COUNT,
+                                        self.num_alternatives + 1)[tuple(choices.T)]
+                choices = choices[~pruned]
+                self.num_pruned = int(pruned.sum())
+
+            if len(choices):
+                sa = annealing(choices)
+                sa.run_algorithm()
+                costs[tuple(choices.T)] = sa.final_costs
+                volumes[tuple(choices.T)] = sa.volumes
+            if self.num_pruned:
+                search_costs = np.where(np.isnan(costs), lower, costs)
+        self.num_annealed = len(choices)
+
+        # Every triple is annealed for each share from its best volumes, scaled.  Scale 1 is the usual requirements,
+        # whose costs are already known
+        share_costs = []
+        if self.share_scales:
+            every_triple = np.argwhere(np.ones(costs.shape, dtype=bool))
+            best = annealing(every_triple, volumes.reshape(-1, 3))
+            lo, hi = self.requirements
+            for scale in self.share_scales:
+                if scale == 1:
+                    share_costs.append(costs)
+                    continue
+                sa = annealing(every_triple, best.rescaled_volumes(scale),
+                               (Nutrition(lo.vec * scale), Nutrition(hi.vec * scale)))
+                sa.run_algorithm()
+                share_costs.append(sa.final_costs.reshape(costs.shape))
+        if self.favoured:
+            search_costs = search_costs * discount
+            share_costs = [share_cost * discount for share_cost in share_costs]
+
+        self.triple_costs = TripleCosts(*section_ids, costs=costs, volumes=volumes)
+        search_start_time = time.perf_counter()
+        if self.num_alternatives:
+            combinations = top_combinations(search_costs, CHOOSE_COUNT, self.num_alternatives + 1)
+        else:
+            combinations = [best_combination(search_costs, CHOOSE_COUNT)]
+        share_combinations = [best_combination(share_cost, CHOOSE_COUNT) for share_cost in share_costs]
+        search_time = time.perf_counter() - search_start_time
+
+        def selection_obj(combination):
+            l1, l2, l3 = ([ids[i] for i in comb] for ids, comb in zip(section_ids, combination))
+            return {
+                PlateSection.LARGE: {
+                    'items': l1,
+                    'category': large_category
+                },
+                PlateSection.SMALL1: {
+                    'items': l2,
+                    'category': small1_category
+                },
+                PlateSection.SMALL2: {
+                    'items': l3,
+                    'category': small2_category
+                },
+            }
+
+        self._result_obj = selection_obj(combinations[0][:3])
+        self._alternatives_obj = [selection_obj(combination[:3]) for combination in combinations[1:]]
+        self._shares_obj = [selection_obj(combination[:3]) for combination in share_combinations]
+        self.result_cost = combinations[0][3]
+        self.share_result_costs = [combination[3] for combination in share_combinations]
         self.runtime = time.perf_counter() - start_time
         self.done = True
+        if self.trace is not None:
+            self.trace.counters['triples_annealed'] += self.num_annealed
+            self.trace.counters['triples_pruned'] += self.num_pruned
+            self.trace.counters['triples_cached'] += costs.size - self.num_annealed - self.num_pruned
+            self.trace.timings['combination_search'] += search_time
+            self.trace.timings['total'] += self.runtime
 
     def result_obj(self):
         return self._result_obj
+
+    def alternatives_obj(self):
+        """
+        @return: Up to num_alternatives runner-up selections, best first, in the same format as result_obj
+        """
+        return self._alternatives_obj
+
+    def shares_obj(self):
+        """
+        @return: For each of share_scales, the best selection for the scaled requirements, in the same format as
+        result_obj
+        """
+        return self._shares_obj
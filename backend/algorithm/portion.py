@@ -1,4 +1,4 @@
-import dataclasses
+import abc
 import math
 import random
 import time
@@ -6,8 +6,11 @@ from dataclasses import dataclass
 from math import exp
 from typing import Union
 
-from .common import Nutrition
+import numpy as np
+
+from .common import Nutrition, NUM_NUTRIENTS
 from .requirements import nutritional_info_for, StudentProfileSpec
+from .telemetry import AnnealingTrace
 
 
 @dataclass
@@ -72,12 +75,13 @@ def dist_sq(x: float, l: float, r: float) -> float:
     return 0
 
 
-def random_sign() -> int:
+def random_sign(rng: random.Random = random) -> int:
     """
     Randomly returns -1 or 1
+    @param rng: The random number generator to use.  The global one by default
     @return:
     """
-    return 1 - 2 * random.randint(0, 1)  # random sign
+    return 1 - 2 * rng.randint(0, 1)  # random sign
 
 
 def ceil_div(a: int, b: int) -> int:
@@ -91,15 +95,31 @@ def ceil_div(a: int, b: int) -> int:
     return (a + b - 1) // b
 
 
-@dataclass
 class PlateSectionState:
-    nutrition: Nutrition
-    portion_volume: Union[float, int]
-    discrete: bool
-    max_volume: Union[float, int]
-    volume: Union[float, int] = 0
-    section_name: str = ''
-    id: Union[str, int] = ''  # We allow either pk (int) or cafeteria_id (str)
+    """
+    An item in a plate section, with its current volume.  The nutrition facts are shared (not copied) between a state
+    and its clones, since only the volume of a state changes while the algorithms run, so the nutrient vector of a
+    state created with from_item_spec is read-only
+    """
+    __slots__ = ('nutrition', 'portion_volume', 'discrete', 'max_volume', 'volume', 'section_name', 'id')
+
+    def __init__(self, nutrition: Nutrition, portion_volume: Union[float, int], discrete: bool,
+                 max_volume: Union[float, int], volume: Union[float, int] = 0, section_name: str = '',
+                 id: Union[str, int] = ''):  # We allow either pk (int) or cafeteria_id (str) as the id
+        self.nutrition = nutrition
+        self.portion_volume = portion_volume
+        self.discrete = discrete
+        self.max_volume = max_volume
+        self.volume = volume
+        self.section_name = section_name
+        self.id = id
+
+    def __repr__(self):
+        return f'PlateSectionState({", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)})'
+
+    def __eq__(self, other):
+        return isinstance(other, PlateSectionState) and \
+               all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
 
     @classmethod
     def from_item_spec(cls, item: MealItemSpec, container_volume: float, num_sections: int, section_name: str):
@@ -121,7 +141,9 @@ class PlateSectionState:
             portion_volume = item.portion_volume
             max_volume = container_volume / num_sections
 
-        return PlateSectionState(nutrition=Nutrition.from_object(item),
+        nutrition = Nutrition.from_object(item)
+        nutrition.vec.flags.writeable = False
+        return PlateSectionState(nutrition=nutrition,
                                  portion_volume=portion_volume,
                                  discrete=discrete,
                                  max_volume=max_volume,
@@ -136,6 +158,13 @@ class PlateSectionState:
         """
         return max(1, ceil_div(self.max_volume, 2)) if self.discrete else self.max_volume / 2
 
+    @property
+    def mid_volume(self):
+        """
+        @return: Returns the volume the algorithms start from, between the min and max volumes
+        """
+        return ceil_div(3 * self.max_volume, 4) if self.discrete else 0.75 * self.max_volume
+
     def scaled_nutrition(self):
         """
         @return: Returns the nutrition facts scaled by the portion volume
@@ -159,46 +188,35 @@ class PlateSectionState:
         Convert fields to dict
         @return: dict with the fields
         """
-        return dataclasses.asdict(self)
+        ret = {name: getattr(self, name) for name in self.__slots__}
+        ret['nutrition'] = self.nutrition.as_dict()
+        return ret
 
-    def copy(self):
+    def copy(self, volume: Union[float, int] = None):
         """
-        @return: Creates a copy, nutrition facts are cloned recursively
+        @param volume: Volume of the copy, the same as this state's volume if not given
+        @return: Creates a copy.  The nutrition facts are shared with this state, not cloned
         """
-        return PlateSectionState(nutrition=self.nutrition.copy(),
-                                 volume=self.volume,
-                                 portion_volume=self.portion_volume,
-                                 max_volume=self.max_volume,
-                                 section_name=self.section_name,
-                                 discrete=self.discrete,
-                                 id=self.id)
+        return PlateSectionState(self.nutrition, self.portion_volume, self.discrete, self.max_volume,
+                                 self.volume if volume is None else volume, self.section_name, self.id)
 
     def with_min_volume(self):
         """
         Clones the state but with the min-volume.
         """
-        ret = self.copy()
-        ret.volume = ret.min_volume
-        return ret
+        return self.copy(self.min_volume)
 
     def with_max_volume(self):
         """
         Clones the state but with the max-volume.
         """
-        ret = self.copy()
-        ret.volume = ret.max_volume
-        return ret
+        return self.copy(self.max_volume)
 
     def with_mid_volume(self):
         """
         Clones the state but with the mid-volume.
         """
-        ret = self.copy()
-        if ret.discrete:
-            ret.volume = ceil_div(3 * ret.max_volume, 4)
-        else:
-            ret.volume = 0.75 * ret.max_volume
-        return ret
+        return self.copy(self.mid_volume)
 
     def nudge(self, ratio):
         """
@@ -251,43 +269,94 @@ DEFAULT_COEFFICIENTS = [
 ]
 
 
-# Source: https://en.wikipedia.org/wiki/Simulated_annealing#Overview
-# https://codeforces.com/blog/entry/94437
-class SimulatedAnnealing:
-    def __init__(self, profile: StudentProfileSpec, state: list[PlateSectionState],
-                 coefficients: tuple[float], alpha: float, smallest_temp: float, seed: int):
+def cost_weights(coefficients: tuple[float]) -> np.ndarray:
+    """
+    Maps a list of coefficients (in the format of DEFAULT_COEFFICIENTS) to a weight per nutrient, in the order of
+    common.NUTRIENTS.  Note that trans fat and sugar share a coefficient, and that the vitamins are listed as C, D, A
+    @param coefficients: Self-explanatory
+    @return: Array of NUM_NUTRIENTS weights
+    """
+    c = coefficients
+    return np.array([c[0], c[1], c[2], c[3], c[4], c[5],
+                     c[5], c[6], c[7],
+                     c[8], c[9], c[10], c[11],
+                     c[14], c[12], c[13]], dtype=float)
+
+
+# Why PortionOptimizer.run_algorithm stopped
+STOP_CONVERGED = 'converged'  # The algorithm finished normally (e.g. the temperature reached smallest_temp)
+STOP_DEADLINE = 'deadline'  # The time budget ran out
+STOP_PLATEAU = 'plateau'  # The best cost stopped improving
+
+# How many iterations to run between checks of the time budget
+DEADLINE_CHECK_INTERVAL = 16
+
+# Cooling schedules of SimulatedAnnealing
+SCHEDULE_GEOMETRIC = 'geometric'  # The nudge size is multiplied by alpha after each iteration
+SCHEDULE_ADAPTIVE = 'adaptive'  # Also cools faster while most nudges are accepted, and reheats on stagnation
+
+# Parameters of SCHEDULE_ADAPTIVE, tuned with the benchmark (see backend.algorithm.benchmark.compare_schedules)
+ADAPTIVE_WINDOW = 20  # Iterations between adjustments, over which the acceptance rate is measured
+ADAPTIVE_TARGET_ACCEPTANCE = 0.5  # The nudge size shrinks faster while the acceptance rate is above this
+ADAPTIVE_SHRINK = 0.93  # Extra factor the nudge size is multiplied by
+ADAPTIVE_COOLING = 0.85  # Factor the acceptance temperature is multiplied by after each window
+REHEAT_STALL_WINDOWS = 10  # Reheat once the best cost hasn't improved for this many windows
+MAX_REHEATS = 3
+
+
+class PortionOptimizer(abc.ABC):
+    def __init__(self, profile: StudentProfileSpec, state: list[PlateSectionState], coefficients: tuple[float],
+                 requirements: tuple[Nutrition, Nutrition] = None, trace: AnnealingTrace = None):
         """
-        Creates a SimulatedAnnealing object which can run the portion-selecting algorithm
-        @param
+        Base class of the portion-selecting algorithms, which choose the volumes of a fixed list of plate sections.
+        Holds the cost function shared by all of them
+        @param profile: The student to choose the portions for
         @param state: Initial algorithm state, as a list of PlateSectionState.  For the purposes of data analysis of
         algorithm performance, each element can be constructed using the first four parameters with the rest being in
         their default state.
         @param coefficients: List of weights denoting how much each nutrient is weighted.  The cost of a state is
         determined by the distance of its nutrition facts to the 'allowed' range.  Euclidian distance**2 is the metric
         used to measure how far each nutrient is from its goal.  These are then scaled by the individual coefficients.
-        See self.cost_of for more details on which coefficient affects what.
-        @param alpha: Amount temperature is multiplied by after each iteration
-        @param smallest_temp: Minimal temperature before algorithm termination.
-        @param seed: Seed value of RNG to make run deterministic.  -1 means no set seed
+        See cost_weights for more details on which coefficient affects what.
+        @param requirements: The (lo, hi) nutritional requirements to use, if they were already computed.  Computed from
+        the profile otherwise
+        @param trace: If given, the algorithm records its progress, counters and timings in it
         """
         # Info properties
-        self.lo_req, self.hi_req = nutritional_info_for(profile)
+        self.lo_req, self.hi_req = requirements or nutritional_info_for(profile)
 
         # Parameter properties
-        self.seed = seed
-        self.alpha = alpha
-        self.smallest_temp = smallest_temp
         self.coefficients = coefficients
+        self.trace = trace
 
         # State properties
-        self.t = 1
-        self.last_nudge: tuple[int, float] = (0, 0)
         self.state: list[PlateSectionState] = state
+        self.cur_cost = -1  # Cost of self.state, see self.reset_cost
+
+        # Vectorized cost evaluation.  The buffers are allocated once here so that evaluating a cost doesn't allocate
+        self._weights = cost_weights(coefficients)
+        self._lo_vec = self.lo_req.vec
+        self._hi_vec = self.hi_req.vec
+        self._nutrients = np.array([s.nutrition.vec for s in state]).reshape(len(state), NUM_NUTRIENTS)
+        self._density = self._nutrients / np.array([s.portion_volume for s in state]).reshape(len(state), 1)
+        # Volume bounds of each section.  The sections never change, only their volumes, so the boundary states are
+        # evaluated from these instead of cloning the states
+        self._min_volume = np.array([s.min_volume for s in state], dtype=float)
+        self._mid_volume = np.array([s.mid_volume for s in state], dtype=float)
+        self._max_volume = np.array([s.max_volume for s in state], dtype=float)
+        self._discrete = np.array([s.discrete for s in state], dtype=bool)
+        self._ratios = np.zeros(len(state))
+        self._eval_total = np.zeros(NUM_NUTRIENTS)
+        self._below = np.zeros(NUM_NUTRIENTS)
+        self._above = np.zeros(NUM_NUTRIENTS)
+        self._total = np.zeros(NUM_NUTRIENTS)  # Running total of self.state
 
         # Result properties
         self.done = False
         self.final_cost = -1
         self.runtime = -1
+        self.iterations = 0
+        self.stop_reason: str = None  # One of the STOP_* constants
 
     def mid_state(self):
         """
@@ -307,45 +376,135 @@ class SimulatedAnnealing:
         """
         return [state.with_max_volume() for state in self.state]
 
+    def reset_cost(self):
+        """
+        Recomputes the running nutrient totals and self.cur_cost from scratch for self.state.  Must be called whenever
+        self.state (or the volume of one of its sections) is replaced
+        @return: None
+        """
+        for i, s in enumerate(self.state):
+            self._ratios[i] = s.volume / s.portion_volume
+        np.dot(self._ratios, self._nutrients, out=self._total)
+        self.cur_cost = self.cost_of_nutrients(self._total)
+
+    def cost_of(self, state):
+        """
+        Given a state, returns its cost, which is based on the current nutritional limits (upper and lower).
+        @param state: Self-explanatory.  Must hold the same sections (in the same order) as self.state, only the
+        volumes may differ (i.e. self.state, or the result of self.lo_state(), self.mid_state(), ...)
+        @return: Self-explanatory
+        """
+        ratios = self._ratios
+        for i, s in enumerate(state):
+            ratios[i] = s.volume / s.portion_volume
+        np.dot(ratios, self._nutrients, out=self._eval_total)
+        return self.cost_of_nutrients(self._eval_total)
+
+    def cost_of_volumes(self, volumes: np.ndarray) -> float:
+        """
+        @param volumes: Volume of each section of self.state
+        @return: Cost of the state with those volumes, as in cost_of
+        """
+        np.dot(volumes, self._density, out=self._eval_total)
+        return self.cost_of_nutrients(self._eval_total)
+
+    def cost_of_nutrients(self, nutrients: np.ndarray) -> float:
+        """
+        Returns the cost of a nutrient vector, i.e. the weighted sum of the squared distances of each nutrient to its
+        allowed range.  Equivalent to calling dist_sq on each nutrient, but done with preallocated buffers
+        @param nutrients: Nutrient vector, in the order of common.NUTRIENTS
+        @return: Self-explanatory
+        """
+        below, above = self._below, self._above
+        np.subtract(self._lo_vec, nutrients, out=below)
+        np.subtract(nutrients, self._hi_vec, out=above)
+        np.maximum(below, above, out=below)
+        np.maximum(below, 0., out=below)
+        np.multiply(below, below, out=below)
+        return float(np.dot(self._weights, below))
+
+    @abc.abstractmethod
+    def run_algorithm(self):
+        """
+        Runs the algorithm
+        @return: None, the result of the algorithm will be stored in the final state (self.state).  You can use
+        backend.algorithm.integration to retrieve the result in a way that will be returned to the frontend.
+        """
+
+
+# Source: https://en.wikipedia.org/wiki/Simulated_annealing#Overview
+# https://codeforces.com/blog/entry/94437
+class SimulatedAnnealing(PortionOptimizer):
+    def __init__(self, profile: StudentProfileSpec, state: list[PlateSectionState],
+                 coefficients: tuple[float], alpha: float, smallest_temp: float, seed: int,
+                 requirements: tuple[Nutrition, Nutrition] = None, time_budget: float = None,
+                 plateau_steps: int = None, trace: AnnealingTrace = None, schedule: str = SCHEDULE_GEOMETRIC):
+        """
+        Creates a SimulatedAnnealing object which can run the portion-selecting algorithm
+        @param profile: See PortionOptimizer
+        @param state: See PortionOptimizer
+        @param coefficients: See PortionOptimizer
+        @param alpha: Amount temperature is multiplied by after each iteration
+        @param smallest_temp: Minimal temperature before algorithm termination.
+        @param seed: Seed value of RNG to make run deterministic.  -1 means no set seed
+        @param requirements: See PortionOptimizer
+        @param time_budget: If given, the algorithm stops after this many seconds even if the temperature is still above
+        smallest_temp
+        @param plateau_steps: If given, the algorithm stops once the best cost seen hasn't improved for this many steps
+        @param trace: See PortionOptimizer
+        @param schedule: SCHEDULE_GEOMETRIC or SCHEDULE_ADAPTIVE.  With the adaptive schedule, the acceptance
+        temperature is lowered and the nudge size shrinks faster while most nudges are accepted (i.e. the landscape is
+        flat at the current nudge size).  If the best cost stops improving, the search is restarted from the best state
+        with the initial temperature and nudge size (at most MAX_REHEATS times)
+        """
+        super().__init__(profile, state, coefficients, requirements, trace)
+
+        # Parameter properties
+        self.seed = seed
+        self.alpha = alpha
+        self.smallest_temp = smallest_temp
+        self.time_budget = time_budget
+        self.plateau_steps = plateau_steps
+        self.schedule = schedule
+
+        # State properties
+        self.t = 1
+        self.last_nudge: tuple[int, float] = (0, 0)
+        self.rng = random.Random(None if seed == -1 else seed)  # Reseeded by every run, so runs are reproducible
+
+        # Values of the running totals and cost from before the last nudge (restored by un_nudge)
+        self._prev_total = np.zeros(NUM_NUTRIENTS)
+        self._prev_cost = -1
+        self._delta = np.zeros(NUM_NUTRIENTS)
+
     def nudge(self, t):
         """
-        Nudges self.state to a random neighbour based on a given temperature
+        Nudges self.state to a random neighbour based on a given temperature.  Only the contribution of the nudged
+        section is updated in the running totals, so self.cur_cost is updated in O(# of nutrients)
         @return: None
         """
-        idx = random.randint(0, len(self.state) - 1)
-        self.last_nudge = idx, self.state[idx].nudge(t * random_sign())
+        idx = self.rng.randint(0, len(self.state) - 1)
+        section = self.state[idx]
+        old_volume = section.nudge(t * random_sign(self.rng))
+        self.last_nudge = idx, old_volume
+
+        np.copyto(self._prev_total, self._total)
+        self._prev_cost = self.cur_cost
+        if section.volume != old_volume:
+            np.multiply(self._density[idx], section.volume - old_volume, out=self._delta)
+            np.add(self._total, self._delta, out=self._total)
+            self.cur_cost = self.cost_of_nutrients(self._total)
 
     def un_nudge(self):
         """
-        Un-nudges self.state based on the self.last_nudge property (which is set by self.nudge(...))
+        Un-nudges self.state based on the self.last_nudge property (which is set by self.nudge(...)), restoring the
+        running totals and cost from before the nudge
         @return: None
         """
         idx, old_volume = self.last_nudge
         self.state[idx].volume = old_volume
-
-    def cost_of(self, state):
-        """
-        Given a state, returns its cost, which is based on the current nutritional limits (upper and lower).
-        @param state: Self-explanatory
-        @return: Self-explanatory
-        """
-        cur_info = nutrition_of(state)
-        return self.coefficients[0] * dist_sq(cur_info.calories, self.lo_req.calories, self.hi_req.calories) + \
-               self.coefficients[1] * dist_sq(cur_info.carbohydrate, self.lo_req.carbohydrate, self.hi_req.carbohydrate) + \
-               self.coefficients[2] * dist_sq(cur_info.protein, self.lo_req.protein, self.hi_req.protein) + \
-               self.coefficients[3] * dist_sq(cur_info.total_fat, self.lo_req.total_fat, self.hi_req.total_fat) + \
-               self.coefficients[4] * dist_sq(cur_info.saturated_fat, self.lo_req.saturated_fat, self.hi_req.saturated_fat) + \
-               self.coefficients[5] * dist_sq(cur_info.trans_fat, self.lo_req.trans_fat, self.hi_req.trans_fat) + \
-               self.coefficients[5] * dist_sq(cur_info.sugar, self.lo_req.sugar, self.hi_req.sugar) + \
-               self.coefficients[6] * dist_sq(cur_info.cholesterol, self.lo_req.cholesterol, self.hi_req.cholesterol) + \
-               self.coefficients[7] * dist_sq(cur_info.fiber, self.lo_req.fiber, self.hi_req.fiber) + \
-               self.coefficients[8] * dist_sq(cur_info.sodium, self.lo_req.sodium, self.hi_req.sodium) + \
-               self.coefficients[9] * dist_sq(cur_info.potassium, self.lo_req.potassium, self.hi_req.potassium) + \
-               self.coefficients[10] * dist_sq(cur_info.calcium, self.lo_req.calcium, self.hi_req.calcium) + \
-               self.coefficients[11] * dist_sq(cur_info.iron, self.lo_req.iron, self.hi_req.iron) + \
-               self.coefficients[12] * dist_sq(cur_info.vitamin_c, self.lo_req.vitamin_c, self.hi_req.vitamin_c) + \
-               self.coefficients[13] * dist_sq(cur_info.vitamin_d, self.lo_req.vitamin_d, self.hi_req.vitamin_d) + \
-               self.coefficients[14] * dist_sq(cur_info.vitamin_a, self.lo_req.vitamin_a, self.hi_req.vitamin_a)
+        np.copyto(self._total, self._prev_total)
+        self.cur_cost = self._prev_cost
 
     def accept_probability_of(self, c_new: float, c_old: float, scale_coeff: float):
         """
@@ -361,31 +520,495 @@ class SimulatedAnnealing:
     def run_algorithm(self):
         """
         Runs the algorithm
-        @return: None, the result of the algorithm will be stored in the final state (self.state).  You can use
-        backend.algorithm.integration to retrieve the result in a way that will be returned to the frontend.
+        @return: None, the best state seen will be stored in self.state.  You can use backend.algorithm.integration to
+        retrieve the result in a way that will be returned to the frontend.  self.stop_reason tells why the algorithm
+        stopped, and self.iterations how many nudges it made
         """
-        if self.seed != -1:
-            random.seed(self.seed)
+        self.rng = random.Random(None if self.seed == -1 else self.seed)
+        self.t = 1
 
         # Initialization
-        cost_bound = max(self.cost_of(self.lo_state()), self.cost_of(self.hi_state()))
+        cost_bound = max(self.cost_of_volumes(self._min_volume), self.cost_of_volumes(self._max_volume))
         scale_cost_by = 60 / (cost_bound + 0.0001)  # special case when cost_bound == 0
         self.state = self.mid_state()
+        self.reset_cost()
+
+        # Best state seen, stored as volumes
+        best_cost = self.cur_cost
+        best_volumes = [s.volume for s in self.state]
+        best_iteration = 0
 
         # Run algorithm
         start_time = time.perf_counter()
+        deadline = start_time + self.time_budget if self.time_budget is not None else math.inf
+        plateau_steps = self.plateau_steps if self.plateau_steps is not None else math.inf
+        trace = self.trace
+        adaptive = self.schedule == SCHEDULE_ADAPTIVE
+        window_accepted = 0
+        stall_start = 0  # Iteration the best cost last improved, or the last reheat
+        reheats = 0
+        iterations = 0
+        stop_reason = STOP_CONVERGED
         t = 0.5  # Initial Temp, we only take half to full filled anyway
         while t >= self.smallest_temp:
-            c_old = self.cost_of(self.state)
-            self.nudge(t)
-            c_new = self.cost_of(self.state)
-            if self.accept_probability_of(c_new, c_old, scale_cost_by) < random.random():
+            if iterations - best_iteration >= plateau_steps:
+                stop_reason = STOP_PLATEAU
+                break
+            if iterations % DEADLINE_CHECK_INTERVAL == 0 and time.perf_counter() >= deadline:
+                stop_reason = STOP_DEADLINE
+                break
+
+            c_old = self.cur_cost
+            if trace is None:
+                self.nudge(t)
+            else:
+                cost_start_time = time.perf_counter()
+                self.nudge(t)
+                trace.timings['cost'] += time.perf_counter() - cost_start_time
+            c_new = self.cur_cost
+            accepted = self.accept_probability_of(c_new, c_old, scale_cost_by) >= self.rng.random()
+            if not accepted:
                 self.un_nudge()  # undo the nudge if it failed
+            elif c_new < best_cost:
+                best_cost = c_new
+                best_volumes = [s.volume for s in self.state]
+                best_iteration = stall_start = iterations + 1
+
+            if trace is not None:
+                trace.counters['proposed'] += 1
+                trace.counters['accepted'] += accepted
+                trace.counters['improved'] += best_iteration == iterations + 1
+                if trace.wants_sample(iterations):
+                    trace.sample(iterations, t, self.cur_cost, best_cost)
 
             # update tmp
             t *= self.alpha
+            iterations += 1
+            if adaptive:
+                window_accepted += accepted
+                if iterations % ADAPTIVE_WINDOW == 0:
+                    self.t *= ADAPTIVE_COOLING
+                    if window_accepted > ADAPTIVE_TARGET_ACCEPTANCE * ADAPTIVE_WINDOW:
+                        t *= ADAPTIVE_SHRINK
+                    window_accepted = 0
+
+                    if iterations - stall_start >= REHEAT_STALL_WINDOWS * ADAPTIVE_WINDOW and reheats < MAX_REHEATS:
+                        for s, volume in zip(self.state, best_volumes):
+                            s.volume = volume
+                        self.reset_cost()
+                        t, self.t = 0.5, 1
+                        stall_start = iterations
+                        reheats += 1
+                        if trace is not None:
+                            trace.counters['reheats'] += 1
+
+        # Set result vars
+        for s, volume in zip(self.state, best_volumes):
+            s.volume = volume
+        self.reset_cost()
+        self.runtime = time.perf_counter() - start_time
+        self.final_cost = self.cur_cost
+        self.iterations = iterations
+        self.stop_reason = stop_reason
+        self.done = True
+        if trace is not None:
+            trace.counters[f'stop_{stop_reason}'] += 1
+            trace.timings['total'] += self.runtime
+
+
+# Number of steps BatchSimulatedAnnealing draws random numbers for at once
+RANDOM_BLOCK_STEPS = 32
+
+
+def splitmix64(x: np.ndarray) -> np.ndarray:
+    """
+    The SplitMix64 mixing function (see https://prng.di.unimi.it/splitmix64.c), applied elementwise
+    @param x: uint64 array
+    @return: uint64 array of the same shape, with every bit of each element depending on every bit of the input
+    """
+    z = x + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+def chain_seeds(seed: int, keys: np.ndarray) -> np.ndarray:
+    """
+    @param seed: See SimulatedAnnealing.  -1 for a random seed
+    @param keys: Integer array of shape (# of chains, # of key columns), identifying each chain
+    @return: uint64 array with the seed of every chain's random stream, which only depends on seed and its keys
+    """
+    if seed == -1:
+        seed = int(np.random.default_rng().integers(0, 2 ** 63))
+    with np.errstate(over='ignore'):
+        ret = np.full(len(keys), splitmix64(np.uint64(seed)), dtype=np.uint64)
+        for column in np.asarray(keys, dtype=np.int64).reshape(len(keys), -1).T:
+            ret = splitmix64(ret ^ column.astype(np.uint64))
+    return ret
+
+
+@dataclass(frozen=True)
+class SectionCandidates:
+    """
+    The candidate items of a plate section, as arrays (one element/row per item) in the same units as
+    PlateSectionState: volumes in mL for continuous items, and in pieces for discrete items
+    """
+    density: np.ndarray  # float64, shape (# of items, NUM_NUTRIENTS).  Nutrients per unit of volume
+    max_volume: np.ndarray  # float64
+    min_volume: np.ndarray  # float64
+    discrete: np.ndarray  # bool
+
+    def __len__(self):
+        return len(self.density)
+
+    @classmethod
+    def from_states(cls, states: list[PlateSectionState]):
+        """
+        @param states: The candidates, as PlateSectionStates
+        @return: A SectionCandidates object of them
+        """
+        return cls(density=np.array([s.nutrition.vec / s.portion_volume for s in states]).reshape(len(states),
+                                                                                                    NUM_NUTRIENTS),
+                   max_volume=np.array([s.max_volume for s in states], dtype=float),
+                   min_volume=np.array([s.min_volume for s in states], dtype=float),
+                   discrete=np.array([s.discrete for s in states], dtype=bool))
+
+    @classmethod
+    def from_items(cls, portion_volumes: np.ndarray, max_pieces: np.ndarray, nutrients: np.ndarray,
+                   container_volume: float, num_sections: int):
+        """
+        Vectorized version of PlateSectionState.from_item_spec, e.g. for the arrays of a MealSnapshot
+        @param portion_volumes: Portion volume of each item, in DB format (i.e. negative for discrete items)
+        @param max_pieces: Max. number of pieces of each item
+        @param nutrients: Nutrition facts of each item, with shape (# of items, NUM_NUTRIENTS)
+        @param container_volume: See PlateSectionState.from_item_spec
+        @param num_sections: See PlateSectionState.from_item_spec
+        @return: A SectionCandidates object of the items
+        """
+        discrete = portion_volumes < 0
+        max_pieces = -(-np.asarray(max_pieces) // num_sections)  # ceil_div
+        max_volume = np.where(discrete, max_pieces, container_volume / num_sections).astype(float)
+        return cls(density=np.asarray(nutrients, dtype=float).reshape(len(discrete), NUM_NUTRIENTS) /
+                   np.abs(portion_volumes)[:, None],
+                   max_volume=max_volume,
+                   min_volume=np.where(discrete, np.maximum(1, -(-max_pieces // 2)), max_volume / 2),
+                   discrete=discrete)
+
+
+class BatchSimulatedAnnealing:
+    def __init__(self, profile: StudentProfileSpec, sections: list[Union[list[PlateSectionState], SectionCandidates]],
+                 choices: np.ndarray,
+                 coefficients: tuple[float], alpha: float, smallest_temp: float, seed: int,
+                 requirements: tuple[Nutrition, Nutrition] = None, initial_volumes: np.ndarray = None,
+                 time_budget: float = None, plateau_steps: int = None, trace: AnnealingTrace = None,
+                 chain_keys: np.ndarray = None):
+        """
+        Creates a BatchSimulatedAnnealing object, which runs many independent portion-selecting annealing chains at
+        once as NumPy arrays.  Each chain behaves like a SimulatedAnnealing run (same cost, nudges and acceptance rule),
+        but all chains are advanced together in one vectorized step.  Every chain has its own random stream (derived
+        from the seed and its key), so a chain's result doesn't depend on the other chains in the batch, as long as
+        the time budget and plateau_steps don't stop the run
+        @param profile: The student to choose the portions for
+        @param sections: For each plate section, the candidates that can be put in it, as a list of PlateSectionStates
+        or as SectionCandidates
+        @param choices: Integer array of shape (# of chains, # of sections).  choices[k][j] is the index into
+        sections[j] of the item chain k puts in section j
+        @param coefficients: See SimulatedAnnealing
+        @param alpha: See SimulatedAnnealing
+        @param smallest_temp: See SimulatedAnnealing
+        @param seed: See SimulatedAnnealing
+        @param requirements: See SimulatedAnnealing
+        @param initial_volumes: Volumes every chain starts from, with the same shape as choices.  The middle volumes
+        (see mid_volumes) if not given
+        @param time_budget: See SimulatedAnnealing.  Every chain stops when the time budget runs out
+        @param plateau_steps: If given, the algorithm stops once the best cost of no chain has improved for this many
+        steps
+        @param trace: If given, the algorithm records its progress and counters (summed over all chains) in it, and the
+        time spent computing costs.  The total time is left to the caller
+        @param chain_keys: Integer array of shape (# of chains[, # of key columns]) identifying each chain, e.g. the IDs
+        of the items it puts in each section.  The chain's index if not given
+        """
+        # Info properties
+        self.lo_req, self.hi_req = requirements or nutritional_info_for(profile)
+
+        # Parameter properties
+        self.seed = seed
+        self.alpha = alpha
+        self.smallest_temp = smallest_temp
+        self.coefficients = coefficients
+        self.time_budget = time_budget
+        self.plateau_steps = plateau_steps
+        self.trace = trace
+        self.t = 1
+
+        # Per-chain arrays, with shape (# of chains, # of sections[, # of nutrients])
+        self.choices = np.asarray(choices, dtype=int).reshape(-1, len(sections))
+        self._weights = cost_weights(coefficients)
+        density, max_volume, min_volume, discrete = [], [], [], []
+        for j, candidates in enumerate(sections):
+            if not isinstance(candidates, SectionCandidates):
+                candidates = SectionCandidates.from_states(candidates)
+            chosen = self.choices[:, j]
+            density.append(candidates.density[chosen])
+            max_volume.append(candidates.max_volume[chosen])
+            min_volume.append(candidates.min_volume[chosen])
+            discrete.append(candidates.discrete[chosen])
+        self.density = np.stack(density, axis=1).reshape(len(self.choices), len(sections), NUM_NUTRIENTS)
+        self.max_volume = np.stack(max_volume, axis=1).reshape(self.choices.shape)
+        self.min_volume = np.stack(min_volume, axis=1).reshape(self.choices.shape)
+        self.discrete = np.stack(discrete, axis=1).reshape(self.choices.shape)
+        self.initial_volumes = self.mid_volumes() if initial_volumes is None else \
+            np.asarray(initial_volumes, dtype=float).reshape(self.choices.shape)
+        self.volumes = self.initial_volumes.copy()
+        self.chain_keys = np.arange(len(self.choices)) if chain_keys is None else np.asarray(chain_keys, dtype=np.int64)
+
+        # Result properties
+        self.done = False
+        self.final_costs: np.ndarray = np.zeros(len(self.choices))
+        self.runtime = -1
+        self.iterations = 0  # Steps taken by every chain
+        self.stop_reason: str = None  # One of the STOP_* constants
+
+    def mid_volumes(self) -> np.ndarray:
+        """
+        @return: The middle volumes of every chain, as in PlateSectionState.with_mid_volume
+        """
+        return np.where(self.discrete, np.floor((3 * self.max_volume + 3) / 4), 0.75 * self.max_volume)
+
+    def cost_bounds(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Bounds the cost every chain will end up with, without annealing.  The nutrient totals are linear in the
+        volumes, so each total lies between the totals of the corners of the volume box (every section at its min or max
+        volume, whichever gives less or more of that nutrient).  The cost of the distance between those ranges and the
+        allowed ranges is the lower bound.  Chains keep the best state they've seen, so the cost of the initial volumes
+        is the upper bound
+        @return: Lower and upper bounds of self.final_costs after running the algorithm, each with shape (# of chains,)
+        """
+        lo_amounts = self.min_volume[:, :, None] * self.density
+        hi_amounts = self.max_volume[:, :, None] * self.density
+        lo_totals = np.minimum(lo_amounts, hi_amounts).sum(axis=1)
+        hi_totals = np.maximum(lo_amounts, hi_amounts).sum(axis=1)
+        dist = np.maximum(np.maximum(self.lo_req.vec - hi_totals, lo_totals - self.hi_req.vec), 0.)
+        return (dist * dist) @ self._weights, self.costs_of(self.initial_volumes)
+
+    def costs_of_totals(self, totals: np.ndarray) -> np.ndarray:
+        """
+        Vectorized version of SimulatedAnnealing.cost_of_nutrients
+        @param totals: Nutrient vectors, with shape (# of chains, # of nutrients)
+        @return: Cost of each chain
+        """
+        dist = np.maximum(np.maximum(self.lo_req.vec - totals, totals - self.hi_req.vec), 0.)
+        return (dist * dist) @ self._weights
+
+    def costs_of(self, volumes: np.ndarray) -> np.ndarray:
+        """
+        Vectorized version of SimulatedAnnealing.cost_of
+        @param volumes: Volumes of every section of every chain, with shape (# of chains, # of sections)
+        @return: Cost of each chain
+        """
+        return self.costs_of_totals(np.einsum('ks,ksn->kn', volumes, self.density))
+
+    def rescaled_volumes(self, scale: float) -> np.ndarray:
+        """
+        Volumes to start from for requirements scaled by some factor (e.g. a meal that gets a larger share of the day's
+        requirements).  The nutrient totals are linear in the volumes, so the volumes are scaled by the same factor
+        (rounded for discrete sections, and clipped to the volume bounds).  This is only a heuristic: the volume bounds,
+        the discrete pieces and the asymmetric cost weights can make the scaled volumes far from the best ones for the
+        scaled requirements (their cost can be hundreds of times higher), so they should be annealed from rather than
+        used as they are
+        @param scale: The factor
+        @return: Each chain's volumes (self.volumes, so after running the algorithm its best ones), scaled
+        """
+        volumes = self.volumes * scale
+        return np.clip(np.where(self.discrete, np.round(volumes), volumes), self.min_volume, self.max_volume)
+
+    def run_algorithm(self):
+        """
+        Runs the algorithm
+        @return: None, the best volumes each chain has seen are stored in self.volumes and their costs in
+        self.final_costs
+        """
+        num_chains, num_sections = self.choices.shape
+        seeds = chain_seeds(self.seed, self.chain_keys)
+
+        # Initialization
+        cost_bound = np.maximum(self.costs_of(self.min_volume), self.costs_of(self.max_volume))
+        scale_cost_by = 60 / (cost_bound + 0.0001)  # special case when cost_bound == 0
+        self.volumes = self.initial_volumes.copy()
+        totals = np.einsum('ks,ksn->kn', self.volumes, self.density)
+        costs = self.costs_of_totals(totals)
+        best_costs = costs.copy()
+        best_volumes = self.volumes.copy()
+        self.iterations = 0
+
+        # Flat views, indexed by chain * num_sections + section
+        offsets = np.arange(num_chains) * num_sections
+        volumes = self.volumes.reshape(-1)
+        max_volumes = self.max_volume.reshape(-1)
+        min_volumes = self.min_volume.reshape(-1)
+        discrete = self.discrete.reshape(-1)
+        density = self.density.reshape(-1, NUM_NUTRIENTS)
+
+        # Run algorithm
+        start_time = time.perf_counter()
+        deadline = start_time + self.time_budget if self.time_budget is not None else math.inf
+        plateau_steps = self.plateau_steps if self.plateau_steps is not None else math.inf
+        best_iteration = 0  # Last iteration any chain's best cost improved
+        stop_reason = STOP_CONVERGED
+        trace = self.trace
+        t = 0.5  # Initial Temp, we only take half to full filled anyway
+        while t >= self.smallest_temp and num_chains:
+            if self.iterations - best_iteration >= plateau_steps:
+                stop_reason = STOP_PLATEAU
+                break
+            if self.iterations % DEADLINE_CHECK_INTERVAL == 0 and time.perf_counter() >= deadline:
+                stop_reason = STOP_DEADLINE
+                break
+
+            # Random numbers are drawn for a block of steps at once.  A chain's random bits at step n are the hash of its
+            # seed and n: the top 53 bits give the number the acceptance probability is compared with, the lowest one
+            # the sign of the nudge and the ones above it the section to nudge
+            step = self.iterations % RANDOM_BLOCK_STEPS
+            if step == 0:
+                counters = np.arange(self.iterations, self.iterations + RANDOM_BLOCK_STEPS, dtype=np.uint64)
+                with np.errstate(over='ignore'):
+                    bits = splitmix64(seeds ^ splitmix64(counters)[:, None])
+                idx_block = offsets + ((bits & np.uint64(0x3FF)) >> np.uint64(1)).astype(int) % num_sections
+                sign_block = 1 - 2 * (bits & np.uint64(1)).astype(int)
+                r_block = (bits >> np.uint64(11)) * 2. ** -53
+
+            # Nudge one section of every chain, see PlateSectionState.nudge
+            idx, sign = idx_block[step], sign_block[step]
+            old_volumes = volumes[idx]
+            max_volume = max_volumes[idx]
+            new_volumes = np.where(discrete[idx], old_volumes + np.ceil(t * max_volume) * sign,
+                                   old_volumes + t * sign * max_volume)
+            np.maximum(new_volumes, min_volumes[idx], out=new_volumes)
+            np.minimum(new_volumes, max_volume, out=new_volumes)
+            if trace is not None:
+                cost_start_time = time.perf_counter()
+            new_totals = totals + (new_volumes - old_volumes)[:, None] * density[idx]
+            new_costs = self.costs_of_totals(new_totals)
+            if trace is not None:
+                trace.timings['cost'] += time.perf_counter() - cost_start_time
+
+            # Accept or reject every chain's nudge, see SimulatedAnnealing.accept_probability_of
+            accept_probability = np.exp(np.minimum(-(new_costs - costs) * scale_cost_by / self.t, 0.))
+            accept = accept_probability >= r_block[step]
+            volumes[idx[accept]] = new_volumes[accept]
+            totals[accept] = new_totals[accept]
+            costs[accept] = new_costs[accept]
+            improved = costs < best_costs
+            if improved.any():
+                best_costs[improved] = costs[improved]
+                best_volumes[improved] = self.volumes[improved]
+                best_iteration = self.iterations + 1
+
+            if trace is not None:
+                trace.counters['proposed'] += num_chains
+                trace.counters['accepted'] += int(accept.sum())
+                trace.counters['improved'] += int(improved.sum())
+                if trace.wants_sample(self.iterations):
+                    trace.sample(self.iterations, t, costs.mean(), best_costs.min())
+
+            # update tmp
+            t *= self.alpha
+            self.iterations += 1
+
+        # Set result vars
+        self.volumes = best_volumes
+        self.runtime = time.perf_counter() - start_time
+        self.final_costs = self.costs_of(self.volumes)
+        self.stop_reason = stop_reason
+        self.done = True
+
+    def state_of(self, chain: int, sections: list[list[PlateSectionState]]) -> list[PlateSectionState]:
+        """
+        @param chain: Index of the chain
+        @param sections: The sections passed to the constructor
+        @return: The current state of a chain, as a list of PlateSectionState (as in SimulatedAnnealing.state)
+        """
+        ret = []
+        for j, candidates in enumerate(sections):
+            state = candidates[self.choices[chain][j]]
+            volume = self.volumes[chain][j]
+            ret.append(state.copy(int(volume) if state.discrete else float(volume)))
+        return ret
+
+
+class MultiStartAnnealing(PortionOptimizer):
+    def __init__(self, profile: StudentProfileSpec, state: list[PlateSectionState], coefficients: tuple[float],
+                 alpha: float, smallest_temp: float, seed: int, num_starts: int,
+                 requirements: tuple[Nutrition, Nutrition] = None, time_budget: float = None,
+                 plateau_steps: int = None, trace: AnnealingTrace = None):
+        """
+        Portion-selecting algorithm that runs several short annealing chains from different starting states (the min,
+        middle and max volumes, then random volumes) at once with BatchSimulatedAnnealing, and keeps the best result.
+        Many short chains usually find a better state than one long chain in less time
+        @param profile: See PortionOptimizer
+        @param state: See PortionOptimizer
+        @param coefficients: See PortionOptimizer
+        @param alpha: See SimulatedAnnealing
+        @param smallest_temp: See SimulatedAnnealing
+        @param seed: See SimulatedAnnealing
+        @param num_starts: Number of chains
+        @param requirements: See PortionOptimizer
+        @param time_budget: See SimulatedAnnealing
+        @param plateau_steps: If given, the algorithm stops once the best cost of no chain has improved for this many
+        steps
+        @param trace: See PortionOptimizer
+        """
+        super().__init__(profile, state, coefficients, requirements, trace)
+        self.alpha = alpha
+        self.smallest_temp = smallest_temp
+        self.seed = seed
+        self.num_starts = num_starts
+        self.time_budget = time_budget
+        self.plateau_steps = plateau_steps
+
+    def initial_volumes(self) -> np.ndarray:
+        """
+        @return: The starting volumes of every chain, with shape (num_starts, # of sections)
+        """
+        rng = np.random.default_rng(None if self.seed == -1 else self.seed)
+        ret = rng.uniform(self._min_volume, self._max_volume, size=(self.num_starts, len(self.state)))
+        ret = np.where(self._discrete, np.round(ret), ret)
+        fixed_starts = (self._min_volume, self._mid_volume, self._max_volume)
+        for i, volumes in enumerate(fixed_starts[:self.num_starts]):
+            ret[i] = volumes
+        return ret
+
+    def run_algorithm(self):
+        """
+        Runs the algorithm
+        @return: None, the result of the algorithm will be stored in the final state (self.state).  You can use
+        backend.algorithm.integration to retrieve the result in a way that will be returned to the frontend.
+        self.iterations is the total number of nudges over all chains
+        """
+        start_time = time.perf_counter()
+        sections = [[s] for s in self.state]
+        batch = BatchSimulatedAnnealing(profile=None,
+                                        sections=sections,
+                                        choices=np.zeros((self.num_starts, len(self.state)), dtype=int),
+                                        coefficients=self.coefficients,
+                                        alpha=self.alpha,
+                                        smallest_temp=self.smallest_temp,
+                                        seed=self.seed,
+                                        requirements=(self.lo_req, self.hi_req),
+                                        initial_volumes=self.initial_volumes(),
+                                        time_budget=self.time_budget,
+                                        plateau_steps=self.plateau_steps,
+                                        trace=self.trace)
+        batch.run_algorithm()
 
         # Set result vars
+        self.state = batch.state_of(int(np.argmin(batch.final_costs)), sections)
+        self.reset_cost()
         self.runtime = time.perf_counter() - start_time
-        self.final_cost = self.cost_of(self.state)
+        self.final_cost = self.cur_cost
+        self.iterations = batch.iterations * self.num_starts
+        self.stop_reason = batch.stop_reason
         self.done = True
+        if self.trace is not None:
+            self.trace.counters[f'stop_{self.stop_reason}'] += 1
+            self.trace.timings['total'] += self.runtime
@@ -1,7 +1,11 @@
 import datetime
+import threading
 from dataclasses import dataclass
 
-from backend.algorithm.common import Nutrition, SEDENTARY, MILD, MODERATE, HEAVY, EXTREME, MALE, FEMALE, BUILD_MUSCLE, \
+import numpy as np
+from cachetools import LRUCache
+
+from backend.algorithm.common import Nutrition, NUTRIENT_INDEX, SEDENTARY, MILD, MODERATE, HEAVY, EXTREME, MALE, FEMALE, BUILD_MUSCLE, \
     ATHLETIC_PERFORMANCE, LOSE_WEIGHT, IMPROVE_TONE, IMPROVE_HEALTH
 
 # JSON does not support infinity
@@ -84,6 +88,12 @@ MACROS_COEFF = {
 # Max portion sizes and min fill requirement, in ML
 CALS_IN_FAT = 9
 
+# The requirements are for one meal, i.e. the daily requirements divided by this
+MEALS_PER_DAY = 3
+
+# Number of profiles whose requirements are memoized by cached_nutritional_info_for (per worker)
+REQUIREMENTS_CACHE_SIZE = 4096
+
 
 # ProfileSpec
 @dataclass
@@ -133,8 +143,127 @@ def nutritional_info_for(profile: StudentProfileSpec) -> tuple[Nutrition, Nutrit
     hi.saturated_fat = sat_fat[1] * calories / CALS_IN_FAT
 
     # Divide reqs by 3 since these are daily
-    for prop in DEFAULT_HI_REQS.keys():  # Doesn't matter if hi or lo
-        setattr(lo, prop, getattr(lo, prop) / 3)
-        setattr(hi, prop, getattr(hi, prop) / 3)
+    lo /= MEALS_PER_DAY
+    hi /= MEALS_PER_DAY
+
+    return lo, hi
+
+
+def _lookup(table: dict, keys) -> np.ndarray:
+    """
+    @param table: Dict with array-like values of the same shape
+    @param keys: Array of keys
+    @return: Array of table[key] for every key, stacked along the first axis
+    """
+    uniques, inverse = np.unique(np.asarray(keys), return_inverse=True)
+    width = np.size(next(iter(table.values())))
+    return np.array([table[key] for key in uniques], dtype=float).reshape(len(uniques), width)[inverse]
+
+
+def nutritional_info_for_many(height: np.ndarray, weight: np.ndarray, birthdate: np.ndarray, sex: np.ndarray,
+                              health_goal: np.ndarray, activity_level: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Vectorized version of nutritional_info_for, computing the requirements of many students at once.  All parameters
+    are arrays (or lists) with one element per student
+    @param height: Heights, in cm
+    @param weight: Weights, in kg
+    @param birthdate: Birthdates, as datetime.date objects or numpy datetime64
+    @param sex: Sexes (MALE or FEMALE)
+    @param health_goal: Health goals
+    @param activity_level: Activity levels
+    @return: The (lo, hi) requirements, as arrays of shape (# of students, NUM_NUTRIENTS).  Row i is equal to the
+    vectors of nutritional_info_for for student i up to rounding, so the two shouldn't be mixed where the exact values
+    matter (e.g. the cache fingerprints of backend.algorithm.cache)
+    """
+    height = np.asarray(height, dtype=float)
+    weight = np.asarray(weight, dtype=float)
+    health_goal = np.asarray(health_goal)
+    n = len(height)
+
+    # Formulae: See nutritional_info_for
+    c_base, c_weight, c_height, c_age = _lookup(SEX_COEFF, sex).T
+    c_activity = _lookup(ACTIVITY_LEVEL_COEFF, activity_level)[:, 0]
+    age = (np.datetime64(datetime.date.today(), 'D') - np.asarray(birthdate, dtype='datetime64[D]')).astype(int) // 365
+    lo = np.tile(Nutrition(**DEFAULT_LO_REQS).vec, (n, 1))
+    hi = np.tile(Nutrition(**DEFAULT_HI_REQS).vec, (n, 1))
+
+    # Set calorie count
+    calories = (c_base + c_weight * weight + c_height * height - c_age * age) * c_activity * 1.1
+    calories += np.where(health_goal == LOSE_WEIGHT, -250, 0) + np.where(health_goal == BUILD_MUSCLE, 250, 0)
+    lo[:, NUTRIENT_INDEX['calories']] = calories * 0.85
+    hi[:, NUTRIENT_INDEX['calories']] = calories * 1.15
+
+    # Set Macros count
+    macros = _lookup(MACROS_COEFF, health_goal).reshape(n, 4, 2)
+    for i, (name, base) in enumerate((('protein', weight), ('carbohydrate', weight),
+                                      ('total_fat', calories / CALS_IN_FAT), ('saturated_fat', calories / CALS_IN_FAT))):
+        lo[:, NUTRIENT_INDEX[name]] = macros[:, i, 0] * base
+        hi[:, NUTRIENT_INDEX[name]] = macros[:, i, 1] * base
+
+    # Divide reqs by 3 since these are daily
+    lo /= MEALS_PER_DAY
+    hi /= MEALS_PER_DAY
 
     return lo, hi
+
+
+_requirements_cache = LRUCache(maxsize=REQUIREMENTS_CACHE_SIZE)
+_requirements_lock = threading.Lock()  # cachetools caches are not thread-safe
+
+
+def requirements_key(profile: StudentProfileSpec) -> tuple:
+    """
+    @param profile: The student (a StudentProfileSpec or StudentProfile)
+    @return: Everything the student's requirements depend on, including today's date since the student's age is used
+    """
+    return (float(profile.height), float(profile.weight), profile.birthdate, profile.sex, profile.health_goal,
+            profile.activity_level, datetime.date.today())
+
+
+def cached_nutritional_info_for(profile: StudentProfileSpec) -> tuple[Nutrition, Nutrition]:
+    """
+    Memoized version of nutritional_info_for
+    @param profile: The student (a StudentProfileSpec or StudentProfile)
+    @return: Copies of the (lo, hi) requirements, so they can be modified by the caller
+    """
+    key = requirements_key(profile)
+    with _requirements_lock:
+        ret = _requirements_cache.get(key)
+    if ret is None:
+        ret = nutritional_info_for(profile)
+        with _requirements_lock:
+            _requirements_cache[key] = ret
+    return ret[0].copy(), ret[1].copy()
+
+
+def invalidate_requirements(profile: StudentProfileSpec):
+    """
+    Forgets the memoized requirements of a student.  Should be called with the student's old settings when they change
+    @param profile: The student (a StudentProfileSpec or StudentProfile)
+    @return: None
+    """
+    with _requirements_lock:
+        _requirements_cache.pop(requirements_key(profile), None)
+
+
+def quantize_requirements(lo: Nutrition, hi: Nutrition, ratio: float = None) -> tuple[Nutrition, Nutrition]:
+    """
+    Rounds every requirement bound to the nearest power of ratio (keeping the sign), so that students with
+    near-identical requirements end up with exactly the same bounds and can share algorithm results.  This can change
+    their selections, since the bounds are off by up to half a bucket (e.g. ~1% for a ratio of 1.02)
+    @param lo: Lower bounds, as returned by nutritional_info_for
+    @param hi: Upper bounds, as returned by nutritional_info_for
+    @param ratio: Ratio of consecutive buckets, e.g. settings.REQUIREMENT_BUCKET_RATIO.  If None, the bounds are kept
+    exact
+    @return: The quantized (lo, hi) bounds
+    """
+    if ratio is None:
+        return lo.copy(), hi.copy()
+
+    def quantize(vec: np.ndarray) -> np.ndarray:
+        mag = np.abs(vec)
+        nonzero = mag > 0
+        buckets = np.round(np.log(np.where(nonzero, mag, 1.)) / np.log(ratio))
+        return np.where(nonzero, np.sign(vec) * ratio ** buckets, 0.)
+
+    return Nutrition(vec=quantize(lo.vec)), Nutrition(vec=quantize(hi.vec))
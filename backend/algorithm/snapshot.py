@@ -0,0 +1,163 @@
+import hashlib
+from dataclasses import dataclass
+
+import numpy as np
+
+from .common import NUM_NUTRIENTS, NUTRIENTS, PROTEIN, VEGETABLE, GRAINS
+from .portion import MealItemSpec
+
+# Categories are stored as their index in this tuple, or -1 for items without a category
+CATEGORIES = (PROTEIN, VEGETABLE, GRAINS)
+NO_CATEGORY = -1
+
+# Bump this whenever the binary format of MealSnapshot changes
+SNAPSHOT_FORMAT_VERSION = 2
+
+
+@dataclass(frozen=True)
+class ItemPreferences:
+    """
+    The items a student doesn't want (or can't have), and the items they like
+    """
+    ban: frozenset = frozenset()  # MealItem IDs
+    favour: frozenset = frozenset()  # MealItem IDs
+    allergies: frozenset = frozenset()  # Ingredient IDs
+
+    def fingerprint(self) -> str:
+        """
+        @return: A string that changes whenever the preferences change
+        """
+        return hashlib.sha1(repr((sorted(self.ban), sorted(self.favour), sorted(self.allergies))).encode()).hexdigest()
+
+
+@dataclass(frozen=True)
+class MealSnapshot:
+    """
+    The items of a meal, packed into arrays (one element/row per item) so that they can be stored as one compact binary
+    blob and loaded without copying
+    """
+    ids: np.ndarray  # int64
+    categories: np.ndarray  # int64, index into CATEGORIES or NO_CATEGORY
+    portion_volumes: np.ndarray  # float64
+    max_pieces: np.ndarray  # int64
+    nutrients: np.ndarray  # float64, shape (# of items, NUM_NUTRIENTS) in the order of common.NUTRIENTS
+    ingredient_ids: np.ndarray  # int64, every ingredient of any of the items
+    ingredients: np.ndarray  # uint64, shape (# of items, # of 64 bit words).  Bit j is set if the item has ingredient j
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_item_specs(cls, items: list[MealItemSpec], item_ingredients: list[tuple[int, int]] = ()):
+        """
+        @param items: The items of the meal
+        @param item_ingredients: (MealItem ID, Ingredient ID) pairs of the items' ingredients
+        @return: A MealSnapshot of the items
+        """
+        ids = np.array([item.id for item in items], dtype=np.int64)
+        item_index = {item.id: i for i, item in enumerate(items)}
+        ingredient_ids = np.array(sorted({ingredient_id for _, ingredient_id in item_ingredients}), dtype=np.int64)
+        ingredient_index = {ingredient_id: j for j, ingredient_id in enumerate(ingredient_ids.tolist())}
+        ingredients = np.zeros((len(items), (len(ingredient_ids) + 63) // 64), dtype=np.uint64)
+        for item_id, ingredient_id in item_ingredients:
+            j = ingredient_index[ingredient_id]
+            ingredients[item_index[item_id], j // 64] |= np.uint64(1 << (j % 64))
+
+        return cls(ids=ids,
+                   categories=np.array([CATEGORIES.index(item.category) if item.category in CATEGORIES else NO_CATEGORY
+                                        for item in items], dtype=np.int64),
+                   portion_volumes=np.array([item.portion_volume for item in items], dtype=np.float64),
+                   max_pieces=np.array([item.max_pieces for item in items], dtype=np.int64),
+                   nutrients=np.array([[getattr(item, name) for name in NUTRIENTS] for item in items],
+                                      dtype=np.float64).reshape(len(items), NUM_NUTRIENTS),
+                   ingredient_ids=ingredient_ids,
+                   ingredients=ingredients)
+
+    def allowed(self, preferences: ItemPreferences) -> np.ndarray:
+        """
+        @param preferences: The student's preferences
+        @return: Boolean mask of the items that are neither banned nor contain an ingredient the student is allergic to
+        """
+        allergens = np.zeros(self.ingredients.shape[1], dtype=np.uint64)
+        for j in np.flatnonzero(np.isin(self.ingredient_ids, list(preferences.allergies))).tolist():
+            allergens[j // 64] |= np.uint64(1 << (j % 64))
+        has_allergen = (self.ingredients & allergens).any(axis=1)
+        return ~has_allergen & ~np.isin(self.ids, list(preferences.ban))
+
+    def indices(self, preferences: ItemPreferences = None) -> np.ndarray:
+        """
+        @param preferences: If given, items the student can't have are left out, and favoured items are put first.
+        The item selection prefers favoured items by discounting their costs (see MealItemSelector), this order only
+        breaks ties
+        @return: Indices of the items, in order
+        """
+        indices = np.arange(len(self))
+        if preferences is not None:
+            indices = np.flatnonzero(self.allowed(preferences))
+            favoured = np.isin(self.ids[indices], list(preferences.favour))
+            indices = np.concatenate((indices[favoured], indices[~favoured]))
+        return indices
+
+    def subset(self, preferences: ItemPreferences = None):
+        """
+        @param preferences: See indices
+        @return: A MealSnapshot of the items given by indices, e.g. to pass to MealItemSelector without unpacking them
+        into MealItemSpecs
+        """
+        indices = self.indices(preferences)
+        return MealSnapshot(ids=self.ids[indices],
+                            categories=self.categories[indices],
+                            portion_volumes=self.portion_volumes[indices],
+                            max_pieces=self.max_pieces[indices],
+                            nutrients=self.nutrients[indices],
+                            ingredient_ids=self.ingredient_ids,
+                            ingredients=self.ingredients[indices])
+
+    def item_specs(self, preferences: ItemPreferences = None) -> list[MealItemSpec]:
+        """
+        @param preferences: See indices
+        @return: The items of the meal as MealItemSpec.  The cafeteria IDs aren't stored in the snapshot, so they're
+        left empty
+        """
+        indices = self.indices(preferences).tolist()
+        ids, categories = self.ids.tolist(), self.categories.tolist()
+        portion_volumes, max_pieces = self.portion_volumes.tolist(), self.max_pieces.tolist()
+        nutrients = self.nutrients.tolist()
+        return [MealItemSpec(ids[i], CATEGORIES[categories[i]] if categories[i] != NO_CATEGORY else None, '',
+                             portion_volumes[i], max_pieces[i], **dict(zip(NUTRIENTS, nutrients[i])))
+                for i in indices]
+
+    def to_bytes(self) -> bytes:
+        """
+        @return: Compact binary form of the object: the number of items and ingredients, then each array in the order
+        of the fields
+        """
+        return np.array([len(self), len(self.ingredient_ids)], dtype=np.int64).tobytes() + b''.join(
+            np.ascontiguousarray(array).tobytes()
+            for array in (self.ids, self.categories, self.portion_volumes, self.max_pieces, self.nutrients,
+                          self.ingredient_ids, self.ingredients))
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        """
+        Loads an object created by to_bytes.  The arrays are read-only views of data (i.e. they're not copied)
+        @param data: Self-explanatory
+        @return: A MealSnapshot object
+        """
+        n, m = np.frombuffer(data, dtype=np.int64, count=2).tolist()
+        words = (m + 63) // 64
+        offset = 2 * 8
+
+        def read(dtype, count):
+            nonlocal offset
+            ret = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+            offset += count * 8
+            return ret
+
+        return cls(ids=read(np.int64, n),
+                   categories=read(np.int64, n),
+                   portion_volumes=read(np.float64, n),
+                   max_pieces=read(np.int64, n),
+                   nutrients=read(np.float64, n * NUM_NUTRIENTS).reshape(n, NUM_NUTRIENTS),
+                   ingredient_ids=read(np.int64, m),
+                   ingredients=read(np.uint64, n * words).reshape(n, words))
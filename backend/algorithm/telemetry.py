@@ -0,0 +1,100 @@
+import dataclasses
+import logging
+from collections import Counter
+from dataclasses import dataclass
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class TraceSample:
+    iteration: int
+    temperature: float
+    cost: float  # Current cost (the mean over all chains for batched algorithms)
+    best_cost: float  # Best cost seen so far (the lowest over all chains for batched algorithms)
+    acceptance_rate: float  # Fraction of the nudges accepted since the previous sample
+
+
+class AnnealingTrace:
+    def __init__(self, sample_every: int = 100, callback: Callable[[TraceSample], None] = None):
+        """
+        Optional instrumentation of the annealing algorithms, passed to them as their trace parameter.  Records a
+        sample of the algorithm's progress every few iterations, counters (e.g. nudges proposed and accepted) and how
+        long each part of the algorithm took.  Tracing slows the algorithms down a bit, so it should only be enabled
+        for some runs
+        @param sample_every: Number of iterations between samples
+        @param callback: If given, called with every sample as it is recorded.  Note that the trace is copied (without
+        calling the callback in the caller's process) when the algorithm runs on a process pool
+        """
+        self.sample_every = sample_every
+        self.callback = callback
+        self.samples: list[TraceSample] = []
+        self.counters = Counter()
+        # Seconds spent in each (non-overlapping) part of the algorithm, e.g. 'cost' for computing the costs of new
+        # states.  'total' is the whole run
+        self.timings = Counter()
+        self._last_proposed = 0
+        self._last_accepted = 0
+
+    def __getstate__(self):
+        # Callbacks are often lambdas, which can't be pickled
+        return {**self.__dict__, 'callback': None}
+
+    def wants_sample(self, iteration: int) -> bool:
+        """
+        @param iteration: The current iteration
+        @return: Whether a sample should be recorded at this iteration
+        """
+        return iteration % self.sample_every == 0
+
+    def sample(self, iteration: int, temperature: float, cost: float, best_cost: float):
+        """
+        Records a sample.  The acceptance rate is computed from the 'proposed' and 'accepted' counters
+        @param iteration: The current iteration
+        @param temperature: The current temperature
+        @param cost: See TraceSample
+        @param best_cost: See TraceSample
+        @return: None
+        """
+        proposed = self.counters['proposed'] - self._last_proposed
+        accepted = self.counters['accepted'] - self._last_accepted
+        self._last_proposed, self._last_accepted = self.counters['proposed'], self.counters['accepted']
+        sample = TraceSample(iteration=iteration,
+                             temperature=float(temperature),
+                             cost=float(cost),
+                             best_cost=float(best_cost),
+                             acceptance_rate=accepted / proposed if proposed else 1.)
+        self.samples.append(sample)
+        if self.callback is not None:
+            self.callback(sample)
+
+    def as_dict(self) -> dict:
+        """
+        @return: The trace in a JSON-serializable format.  'bookkeeping' is the time not spent in any of the timed parts
+        """
+        timings = dict(self.timings)
+        if 'total' in timings:
+            timings['bookkeeping'] = timings['total'] - sum(v for k, v in timings.items() if k != 'total')
+        return {
+            'counters': dict(self.counters),
+            'timings': timings,
+            'samples': [dataclasses.asdict(sample) for sample in self.samples]
+        }
+
+    def log(self, name: str, level: int = logging.INFO):
+        """
+        Writes a summary of the trace and its samples to the log
+        @param name: Name of the traced run, e.g. the algorithm's class
+        @param level: Log level
+        @return: None
+        """
+        if not logger.isEnabledFor(level):
+            return
+        obj = self.as_dict()
+        logger.log(level, '%s: counters %s, timings %s', name, obj['counters'],
+                   {k: round(v, 6) for k, v in obj['timings'].items()})
+        for sample in self.samples:
+            logger.log(level, '%s: iteration %d, temperature %.6g, cost %.6g, best cost %.6g, acceptance rate %.3f',
+                       name, sample.iteration, sample.temperature, sample.cost, sample.best_cost,
+                       sample.acceptance_rate)
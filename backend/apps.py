@@ -7,6 +7,8 @@ class BackendConfig(AppConfig):
     name = 'backend'
 
     def ready(self):
+        from . import signals  # Registers the signal receivers
+
         for k, v in settings.SETTINGS_LOG_MSG:
             print(f'{k}: {v}')
         print()
@@ -0,0 +1,73 @@
+import json
+import subprocess
+
+from django.conf import settings
+from django.core.management import BaseCommand
+
+from backend.algorithm.benchmark import run_benchmarks, compare_results
+from backend.algorithm.integration import PORTION_ENGINES
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the algorithms on reproducible synthetic menus and profiles, optionally saving the results as ' \
+           'JSON and comparing them with earlier results'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=20210226, help='Seed of the synthetic data and algorithms')
+        parser.add_argument('--runs', type=int, default=10, help='Number of runs of each benchmark')
+        parser.add_argument('--portion-sizes', type=int, nargs='+', default=[1, 2, 3],
+                            help='Numbers of items per plate section for the portion benchmarks')
+        parser.add_argument('--menu-sizes', type=int, nargs='+', default=[4, 8],
+                            help='Numbers of items per category for the item selector benchmarks')
+        parser.add_argument('--engines', nargs='+', choices=PORTION_ENGINES, default=list(PORTION_ENGINES),
+                            help='Portion selecting algorithms to benchmark')
+        parser.add_argument('-o', '--output', help='File to save the results to, as JSON')
+        parser.add_argument('-c', '--compare', help='Results (JSON) of an earlier run to compare the runtimes with')
+
+    def git_commit(self):
+        try:
+            return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True, text=True,
+                                  check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def handle(self, *args, **options):
+        results = run_benchmarks(seed=options['seed'], portion_sizes=options['portion_sizes'],
+                                 menu_sizes=options['menu_sizes'], runs=options['runs'], engines=options['engines'])
+        results['commit'] = self.git_commit()
+
+        self.stdout.write(f'requirements: p50 {results["requirements"]["runtime"]["p50"] * 1e6:.1f}us')
+        for res in results['portions']:
+            self.stdout.write(f'portions ({res["engine"]}, {res["items_per_section"]} items/section): '
+                              f'p50 {res["runtime"]["p50"] * 1e3:.1f}ms, p99 {res["runtime"]["p99"] * 1e3:.1f}ms, '
+                              f'{res["iterations_per_second"]["mean"]:.0f} it/s, '
+                              f'mean cost {res["final_cost"]["mean"]:.4g}, peak memory {res["peak_memory"] / 1024:.0f}KiB')
+        for res in results['engine_comparison']:
+            for engine, counts in res['engines'].items():
+                self.stdout.write(f'{engine} vs {res["baseline"]} ({res["items_per_section"]} items/section): '
+                                  f'better on {counts["better"]}, worse on {counts["worse"]} of {res["runs"]} plates')
+        for res in results['schedule_comparison']:
+            self.stdout.write(f'adaptive vs geometric schedule ({res["items_per_section"]} items/section): '
+                              f'{res["step_reduction"] * 100:.0f}% fewer steps, better on {res["better"]}, '
+                              f'worse on {res["worse"]} of {res["runs"]} plates')
+        for res in results['item_selector']:
+            self.stdout.write(f'item selector ({res["items_per_category"]} items/category): '
+                              f'p50 {res["runtime"]["p50"] * 1e3:.1f}ms, p99 {res["runtime"]["p99"] * 1e3:.1f}ms, '
+                              f'{res["iterations_per_second"]["mean"]:.0f} triples/s, '
+                              f'peak memory {res["peak_memory"] / 1024:.0f}KiB')
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(f'Saved results to {options["output"]}')
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                old = json.load(f)
+            if old.get('version') != results['version'] or old.get('seed') != results['seed']:
+                self.stderr.write('The results were computed with a different benchmark version or seed')
+                return
+            for name, old_runtime, new_runtime in compare_results(old, results):
+                # Runtimes below the timer's resolution are 0
+                change = f'{(new_runtime / old_runtime - 1) * 100:+.1f}%' if old_runtime > 0 else 'n/a'
+                self.stdout.write(f'{name}: {old_runtime * 1e3:.2f}ms -> {new_runtime * 1e3:.2f}ms ({change})')
@@ -0,0 +1,83 @@
+from django.db.models.signals import m2m_changed, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from backend.algorithm.cache import invalidate_meal, forget_triple_costs, remove_meal_items
+from backend.algorithm.common import NUTRIENTS
+from backend.models import MealSelection, MealItem
+
+# The fields of a MealItem the algorithms use, apart from its ingredients.  Saves that change none of them don't
+# affect any cached result
+ALGORITHM_FIELDS = ('category', 'portion_volume', 'max_pieces') + NUTRIENTS
+
+
+@receiver(m2m_changed, sender=MealSelection.items.through)
+def meal_items_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Updates the cached algorithm results of meals whose item list changed.  Only the results involving the added or
+    removed items are recomputed, see backend.algorithm.cache
+    """
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+
+    if action == 'post_add':
+        for meal_id in ([instance.id] if not reverse else pk_set):
+            invalidate_meal(meal_id)
+    elif not reverse:  # instance is the MealSelection, pk_set isn't given when clearing
+        remove_meal_items(instance.id, instance.items.values_list('id', flat=True) if action == 'pre_clear' else pk_set)
+    else:  # instance is the MealItem
+        for meal_id in (instance.mealselection_set.values_list('id', flat=True) if action == 'pre_clear' else pk_set):
+            remove_meal_items(meal_id, [instance.id])
+
+
+@receiver(m2m_changed, sender=MealItem.ingredients.through)
+def meal_item_ingredients_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Invalidates cached algorithm results of meals containing an item whose ingredients changed, since the ingredients
+    decide which items students with allergies can be given
+    """
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+
+    if not reverse:  # instance is the MealItem
+        items = [instance]
+    elif action == 'pre_clear':  # instance is an Ingredient, pk_set isn't given when clearing
+        items = instance.mealitem_set.all()
+    else:
+        items = MealItem.objects.filter(pk__in=pk_set)
+    for meal_id in MealSelection.objects.filter(items__in=items).values_list('id', flat=True).distinct():
+        invalidate_meal(meal_id)
+
+
+@receiver(pre_save, sender=MealItem)
+def meal_item_saving(sender, instance, update_fields=None, **kwargs):
+    """
+    Remembers whether a save changes any of the ALGORITHM_FIELDS of an existing item, for meal_item_changed
+    """
+    if instance.pk is None or (update_fields is not None and not set(update_fields).intersection(ALGORITHM_FIELDS)):
+        instance.algorithm_fields_changed = False
+        return
+    stored = MealItem.objects.filter(pk=instance.pk).values_list(*ALGORITHM_FIELDS).first()
+    instance.algorithm_fields_changed = stored is not None and \
+        stored != tuple(getattr(instance, name) for name in ALGORITHM_FIELDS)
+
+
+@receiver(post_save, sender=MealItem)
+def meal_item_changed(sender, instance, **kwargs):
+    """
+    Invalidates cached algorithm results of meals containing an item whose nutrition facts, volume, pieces or category
+    changed.  Only the triple costs of the item's triples are dropped
+    """
+    if not getattr(instance, 'algorithm_fields_changed', True):
+        return
+    for meal_id in instance.mealselection_set.values_list('id', flat=True):
+        invalidate_meal(meal_id)
+        forget_triple_costs(meal_id, {instance.id})
+
+
+@receiver(pre_delete, sender=MealItem)
+def meal_item_deleted(sender, instance, **kwargs):
+    """
+    Deleting an item removes it from its meals without sending m2m_changed
+    """
+    for meal_id in instance.mealselection_set.values_list('id', flat=True):
+        remove_meal_items(meal_id, [instance.id])
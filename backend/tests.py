@@ -1,9 +1,39 @@
-from django.test import TestCase
+from django.core.cache import cache
+from django.test import TestCase, SimpleTestCase, override_settings
 from django.test.client import Client
-
-from backend.models import School, Ingredient, MealItem, MealSelection
-
+from django.utils import timezone
+
+from backend.algorithm.benchmark import run_benchmarks, synthetic_menu, synthetic_profiles, compare_results, \
+    synthetic_item
+from backend.algorithm.cache import run_meal_item_selector, invalidate_meal, meal_snapshot_key, get_meal_snapshot, \
+    set_meal_snapshot, forget_triple_costs, remove_meal_items, get_suggestion, set_suggestion, read_meal_cache, \
+    suggestion_key, meal_version, triple_costs_version
+from backend.algorithm.convex import ConvexPortionSolver, bounded_least_squares
+from backend.algorithm.day_plan import share_options, best_day_plan, DAY_PLAN_UNITS
+from backend.algorithm.executor import AlgorithmExecutor, AlgorithmUnavailable, INLINE, THREAD, PROCESS
+from backend.algorithm.integration import student_profile_spec_from_model, item_preferences_from_model
+from backend.algorithm.item_choice import best_combination, MealItemSelector, TripleCosts, top_combinations, \
+    pruned_triples
+from backend.algorithm.common import Nutrition, NUTRIENTS, PROTEIN, VEGETABLE, GRAINS
+from backend.algorithm.portion import SimulatedAnnealing, PlateSectionState, DEFAULT_COEFFICIENTS, \
+    dist_sq, BatchSimulatedAnnealing, MultiStartAnnealing, STOP_CONVERGED, STOP_DEADLINE, STOP_PLATEAU, \
+    SCHEDULE_ADAPTIVE, MAX_REHEATS, SectionCandidates
+from backend.algorithm.requirements import StudentProfileSpec, nutritional_info_for, quantize_requirements, \
+    cached_nutritional_info_for, invalidate_requirements, nutritional_info_for_many, INF
+from backend.algorithm.snapshot import MealSnapshot, ItemPreferences
+from backend.algorithm.telemetry import AnnealingTrace
+from backend.models import School, Ingredient, MealItem, MealSelection, StudentProfile
+
+import concurrent.futures
 import datetime
+import itertools
+import json
+import os
+import random
+import threading
+from unittest import mock
+
+import numpy as np
 
 
 class UserTestCase(TestCase):
@@ -161,3 +191,797 @@ class DataFetchTestCase(UserTestCase):
         res = c.get(f'/api/ingredients/').json()
         # print(res)
         self.check_response_list(res)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class SuggestionTestCase(UserTestCase):
+    fixtures = ['test_school.yaml', 'test_user.yaml']
+
+    def setUp(self):
+        super().setUp()
+        for item, category in ((self.m_apple_pie, GRAINS), (self.m_anchovy, PROTEIN), (self.m_pizza, PROTEIN),
+                               (self.m_orange, VEGETABLE)):
+            item.category = category
+            item.save()
+        self.mm_lunch.items.add(self.m_orange)
+        self.mm_lunch.timestamp = timezone.now() + datetime.timedelta(hours=1)
+        self.mm_lunch.save()
+        self.profile = StudentProfile.objects.get(pk=1)
+
+    def suggestion(self, large_max_volume, small_max_volume):
+        return get_suggestion(self.mm_lunch.id, self.profile.id, student_profile_spec_from_model(self.profile),
+                              item_preferences_from_model(self.profile), large_max_volume, small_max_volume)
+
+    def test_precompute_suggestions(self):
+        c = Client()
+        self.assertEqual(c.get('/jobs/precompute_suggestions/').content,
+                         b'Precomputed 2 suggestions for 1 meals, 0 failed, 0 left')
+        self.assertIsNotNone(self.suggestion(610, 270))
+        self.assertIsNotNone(self.suggestion(800, 400))
+        # Already stored suggestions aren't computed again
+        self.assertEqual(c.get('/jobs/precompute_suggestions/').content,
+                         b'Precomputed 0 suggestions for 1 meals, 0 failed, 0 left')
+
+    def test_precompute_suggestions_meal_groups(self):
+        # Only for the meals the student eats
+        self.profile.meals = ['breakfast', 'dinner']
+        self.profile.save()
+        self.assertEqual(Client().get('/jobs/precompute_suggestions/').content,
+                         b'Precomputed 0 suggestions for 1 meals, 0 failed, 0 left')
+        self.assertIsNone(self.suggestion(610, 270))
+
+    def test_precompute_suggestions_time_limit(self):
+        c = Client()
+        with override_settings(SUGGESTION_PRECOMPUTE_TIME_LIMIT=0), self.assertLogs('backend.views.jobs', 'WARNING'):
+            self.assertEqual(c.get('/jobs/precompute_suggestions/').content,
+                             b'Precomputed 0 suggestions for 1 meals, 0 failed, 2 left')
+        self.assertIsNone(self.suggestion(610, 270))
+        # The next run picks up the ones left
+        self.assertEqual(c.get('/jobs/precompute_suggestions/').content,
+                         b'Precomputed 2 suggestions for 1 meals, 0 failed, 0 left')
+
+    def test_precompute_suggestions_unavailable(self):
+        with mock.patch('backend.views.jobs.run_meal_item_selector', side_effect=AlgorithmUnavailable('busy')), \
+                self.assertLogs('backend.views.jobs', 'WARNING'):
+            self.assertEqual(Client().get('/jobs/precompute_suggestions/').content,
+                             b'Precomputed 0 suggestions for 1 meals, 2 failed, 0 left')
+        self.assertIsNone(self.suggestion(610, 270))
+
+    def test_item_changes(self):
+        self.assertEqual(Client().get('/jobs/precompute_suggestions/').content,
+                         b'Precomputed 2 suggestions for 1 meals, 0 failed, 0 left')
+        with mock.patch('backend.signals.forget_triple_costs') as forget:
+            # Nothing the algorithms use
+            self.m_orange.name = 'Blood orange'
+            self.m_orange.save()
+            self.assertIsNotNone(self.suggestion(610, 270))
+            self.m_orange.calories += 10
+            self.m_orange.save(update_fields=['name'])
+            self.assertIsNotNone(self.suggestion(610, 270))
+            forget.assert_not_called()
+
+            self.m_orange.save()
+            self.assertIsNone(self.suggestion(610, 270))
+            forget.assert_called_once_with(self.mm_lunch.id, {self.m_orange.id})
+
+    def test_day_plan(self):
+        day = datetime.datetime(2030, 2, 14, tzinfo=datetime.timezone.utc)
+        self.mm_lunch.timestamp = day + datetime.timedelta(hours=12)
+        self.mm_lunch.save()
+        breakfast = MealSelection.objects.create(name='Breakfast', group='breakfast', school=self.school,
+                                                 timestamp=day + datetime.timedelta(hours=8))
+        breakfast.items.set([self.m_apple_pie, self.m_pizza, self.m_orange])
+
+        c = Client()
+        c.force_login(self.profile.user)
+        url = '/api/suggest/day/?date=2030-02-14&large_max_volume=610&small_max_volume=270'
+        res = c.get(url).json()
+        self.assertEqual(res['date'], '2030-02-14')
+        self.assertEqual([meal['meal'] for meal in res['meals']], [breakfast.id, self.mm_lunch.id])
+        self.assertAlmostEqual(sum(meal['share'] for meal in res['meals']), 1)
+        for meal in res['meals']:
+            chosen = {item_id for section in ('large', 'small1', 'small2') for item_id in meal[section]['items']}
+            self.assertNotIn(self.m_anchovy.id, chosen)  # Banned
+
+        self.assertEqual(c.get(url.replace('2030-02-14', '2030-02-15')).json()['meals'], [])
+
+    def test_items_uses_stored_suggestion(self):
+        c = Client()
+        c.force_login(self.profile.user)
+        url = f'/api/suggest/{self.mm_lunch.id}/items/?large_max_volume=610&small_max_volume=270'
+        result = c.get(url).json()
+        self.assertEqual(self.suggestion(610, 270), result)
+
+        stored = {**result, 'stored': True}
+        set_suggestion(self.mm_lunch.id, self.profile.id, student_profile_spec_from_model(self.profile),
+                       item_preferences_from_model(self.profile), 610, 270, stored)
+        self.assertEqual(c.get(url).json(), stored)
+        with mock.patch('backend.views.api.meal_planning.run_meal_item_selector',
+                        side_effect=AlgorithmUnavailable('busy')):
+            self.assertEqual(c.get(url).status_code, 200)
+            self.assertEqual(c.get(url.replace('610', '800')).status_code, 503)
+
+
+def random_profile_spec(rng: random.Random) -> StudentProfileSpec:
+    return StudentProfileSpec(height=rng.uniform(150, 200),
+                              weight=rng.uniform(45, 110),
+                              birthdate=datetime.date(2003, 11, 24),
+                              meals=['breakfast', 'lunch', 'dinner'],
+                              meal_length=30,
+                              sex=rng.choice(('male', 'female')),
+                              health_goal=rng.choice(('lose_weight', 'build_muscle', 'athletic_performance',
+                                                      'improve_tone', 'improve_health')),
+                              activity_level=rng.choice(('sedentary', 'mild', 'moderate', 'heavy', 'extreme')))
+
+
+def random_sections(rng: random.Random) -> list[PlateSectionState]:
+    return [PlateSectionState.from_item_spec(synthetic_item(rng, i, category), volume, 1, section)
+            for i, (category, volume, section) in enumerate(zip((PROTEIN, VEGETABLE, GRAINS), (610, 270, 270),
+                                                                ('large', 'small1', 'small2')))]
+
+
+class PortionAlgorithmTestCase(SimpleTestCase):
+    def test_nutrition_vector(self):
+        nut = Nutrition(calories=100, vitamin_d=3)
+        self.assertEqual(nut.vec[NUTRIENTS.index('calories')], 100)
+        self.assertEqual(nut.vitamin_d, 3)
+        nut += Nutrition(calories=50)
+        nut *= 2
+        self.assertEqual(nut.as_dict()['calories'], 300)
+        self.assertEqual(list(nut.as_dict().keys()), list(NUTRIENTS))
+
+    def test_cost_matches_reference(self):
+        rng = random.Random(20210226)
+        for _ in range(20):
+            sa = SimulatedAnnealing(random_profile_spec(rng), random_sections(rng), DEFAULT_COEFFICIENTS, 0.99, 0.01,
+                                    -1)
+            state = sa.mid_state()
+            total = Nutrition()
+            for s in state:
+                total += s.scaled_nutrition()
+            c = DEFAULT_COEFFICIENTS
+            weights = dict(calories=c[0], carbohydrate=c[1], protein=c[2], total_fat=c[3], saturated_fat=c[4],
+                           trans_fat=c[5], sugar=c[5], cholesterol=c[6], fiber=c[7], sodium=c[8], potassium=c[9],
+                           calcium=c[10], iron=c[11], vitamin_c=c[12], vitamin_d=c[13], vitamin_a=c[14])
+            expected = sum(weight * dist_sq(getattr(total, name), getattr(sa.lo_req, name), getattr(sa.hi_req, name))
+                           for name, weight in weights.items())
+            self.assertAlmostEqual(sa.cost_of(state) / max(expected, 1), expected / max(expected, 1))
+
+    def test_state_clones_share_nutrition(self):
+        rng = random.Random(5)
+        sections = random_sections(rng)
+        sa = SimulatedAnnealing(random_profile_spec(rng), sections, DEFAULT_COEFFICIENTS, 0.99, 0.01, -1)
+        for original, lo, hi in zip(sections, sa.lo_state(), sa.hi_state()):
+            self.assertIs(lo.nutrition, original.nutrition)
+            self.assertEqual((lo.volume, hi.volume), (original.min_volume, original.max_volume))
+            self.assertEqual(lo.copy(), lo)
+            self.assertEqual(lo.as_dict(), {**original.as_dict(), 'volume': lo.volume})
+        with self.assertRaises(ValueError):  # Shared nutrition facts are read-only
+            sections[0].nutrition += sections[1].nutrition
+        self.assertEqual(sa.cost_of_volumes(sa._max_volume), sa.cost_of(sa.hi_state()))
+
+    def test_trace(self):
+        rng = random.Random(11)
+        profile, sections = random_profile_spec(rng), random_sections(rng)
+        plain = SimulatedAnnealing(profile, [s.copy() for s in sections], DEFAULT_COEFFICIENTS, 0.99, 0.01, 5)
+        plain.run_algorithm()
+
+        samples = []
+        trace = AnnealingTrace(sample_every=50, callback=samples.append)
+        traced = SimulatedAnnealing(profile, [s.copy() for s in sections], DEFAULT_COEFFICIENTS, 0.99, 0.01, 5,
+                                    trace=trace)
+        traced.run_algorithm()
+        self.assertEqual(traced.final_cost, plain.final_cost)  # Tracing doesn't change the run
+        self.assertEqual(trace.counters['proposed'], traced.iterations)
+        self.assertEqual(len(trace.samples), (traced.iterations + 49) // 50)
+        self.assertEqual(samples, trace.samples)
+        self.assertEqual(trace.samples[-1].best_cost, min(sample.best_cost for sample in trace.samples))
+        obj = trace.as_dict()
+        self.assertAlmostEqual(obj['timings']['cost'] + obj['timings']['bookkeeping'], obj['timings']['total'])
+
+        trace = AnnealingTrace()
+        multi = MultiStartAnnealing(profile, [s.copy() for s in sections], DEFAULT_COEFFICIENTS, 0.98, 0.0005, 5, 16,
+                                    trace=trace)
+        multi.run_algorithm()
+        self.assertEqual(trace.counters['proposed'], multi.iterations)
+        self.assertTrue(all(0 <= sample.acceptance_rate <= 1 for sample in trace.samples))
+
+    def test_adaptive_schedule(self):
+        rng = random.Random(12)
+        for _ in range(5):
+            profile, sections = random_profile_spec(rng), random_sections(rng)
+            geometric = SimulatedAnnealing(profile, [s.copy() for s in sections], DEFAULT_COEFFICIENTS, 0.999, 0.0005, 3)
+            geometric.run_algorithm()
+            trace = AnnealingTrace()
+            adaptive = SimulatedAnnealing(profile, [s.copy() for s in sections], DEFAULT_COEFFICIENTS, 0.999, 0.0005, 3,
+                                          trace=trace, schedule=SCHEDULE_ADAPTIVE)
+            adaptive.run_algorithm()
+            self.assertLess(adaptive.iterations, geometric.iterations)
+            self.assertLessEqual(trace.counters['reheats'], MAX_REHEATS)
+            self.assertAlmostEqual(adaptive.final_cost / max(adaptive.final_cost, 1),
+                                   adaptive.cost_of(adaptive.state) / max(adaptive.final_cost, 1))
+
+    def test_incremental_cost(self):
+        rng = random.Random(1)
+        sa = SimulatedAnnealing(random_profile_spec(rng), random_sections(rng), DEFAULT_COEFFICIENTS, 0.99, 0.01, -1)
+        sa.state = sa.mid_state()
+        sa.reset_cost()
+        for i in range(500):
+            sa.nudge(0.3)
+            if i % 3 == 0:
+                sa.un_nudge()
+            self.assertAlmostEqual(sa.cur_cost / max(sa.cur_cost, 1), sa.cost_of(sa.state) / max(sa.cur_cost, 1))
+
+    def test_batch_cost_matches(self):
+        rng = random.Random(2)
+        profile = random_profile_spec(rng)
+        sections = [random_sections(rng) for _ in range(4)]
+        sections = [[state[j] for state in sections] for j in range(3)]
+        choices = np.indices((4, 4, 4)).reshape(3, -1).T
+        batch = BatchSimulatedAnnealing(profile, sections, choices, DEFAULT_COEFFICIENTS, 0.95, 0.01, 0)
+        batch.run_algorithm()
+        for k in range(len(choices)):
+            state = batch.state_of(k, sections)
+            for s in state:
+                self.assertTrue(s.min_volume <= s.volume <= s.max_volume)
+            expected = SimulatedAnnealing(profile, state, DEFAULT_COEFFICIENTS, 0.95, 0.01, 0).cost_of(state)
+            self.assertAlmostEqual(batch.final_costs[k] / max(expected, 1), expected / max(expected, 1))
+
+    def test_batch_independent_chains(self):
+        rng = random.Random(5)
+        profile = random_profile_spec(rng)
+        items = synthetic_menu(rng, 4)
+
+        def triple_costs(menu):
+            alg = MealItemSelector(profile, menu, 610, 270, DEFAULT_COEFFICIENTS, 0.9, 0.01, 0, prune=False)
+            alg.run_algorithm()
+            return alg.triple_costs
+
+        full = triple_costs(items)
+        # A triple's cost only depends on its own items, not on the other triples annealed in the same batch
+        for menu in (items[::-1], items[::2]):
+            costs = triple_costs(menu)
+            self.assertTrue(np.array_equal(costs.costs, full.lookup(costs.large_ids, costs.small1_ids,
+                                                                    costs.small2_ids)))
+
+    def test_anytime_stops(self):
+        rng = random.Random(3)
+        profile, sections = random_profile_spec(rng), random_sections(rng)
+
+        full = SimulatedAnnealing(profile, [s.copy() for s in sections], DEFAULT_COEFFICIENTS, 0.9999, 0.0005, 0)
+        full.run_algorithm()
+        self.assertEqual(full.stop_reason, STOP_CONVERGED)
+        self.assertAlmostEqual(full.final_cost, full.cost_of(full.state))
+        self.assertLessEqual(full.final_cost, full.cost_of(full.mid_state()))
+
+        timed = SimulatedAnnealing(profile, [s.copy() for s in sections], DEFAULT_COEFFICIENTS, 0.9999, 0.0005, 0,
+                                   time_budget=0)
+        timed.run_algorithm()
+        self.assertEqual(timed.stop_reason, STOP_DEADLINE)
+        self.assertLess(timed.iterations, full.iterations)
+
+        plateau = SimulatedAnnealing(profile, [s.copy() for s in sections], DEFAULT_COEFFICIENTS, 0.9999, 0.0005, 0,
+                                     plateau_steps=100)
+        plateau.run_algorithm()
+        self.assertEqual(plateau.stop_reason, STOP_PLATEAU)
+        self.assertLessEqual(plateau.final_cost, plateau.cost_of(plateau.mid_state()))
+
+    def test_multi_start_stops(self):
+        rng = random.Random(4)
+        profile, sections = random_profile_spec(rng), random_sections(rng)
+
+        full = MultiStartAnnealing(profile, [s.copy() for s in sections], DEFAULT_COEFFICIENTS, 0.9999, 0.0005, 0, 16)
+        full.run_algorithm()
+        self.assertEqual(full.stop_reason, STOP_CONVERGED)
+
+        timed = MultiStartAnnealing(profile, [s.copy() for s in sections], DEFAULT_COEFFICIENTS, 0.9999, 0.0005, 0, 16,
+                                    time_budget=0.01)
+        timed.run_algorithm()
+        self.assertEqual(timed.stop_reason, STOP_DEADLINE)
+        self.assertLess(timed.iterations, full.iterations)
+        self.assertLess(timed.runtime, 0.5)
+        self.assertAlmostEqual(timed.final_cost, timed.cost_of(timed.state))
+
+        plateau = MultiStartAnnealing(profile, [s.copy() for s in sections], DEFAULT_COEFFICIENTS, 0.9999, 0.0005, 0,
+                                      16, plateau_steps=100)
+        plateau.run_algorithm()
+        self.assertEqual(plateau.stop_reason, STOP_PLATEAU)
+        self.assertLess(plateau.iterations, full.iterations)
+
+    def test_seeded_runs_in_threads(self):
+        rng = random.Random(5)
+        profile, sections = random_profile_spec(rng), random_sections(rng)
+
+        def run(_):
+            sa = SimulatedAnnealing(profile, [s.copy() for s in sections], DEFAULT_COEFFICIENTS, 0.999, 0.0005, 42)
+            sa.run_algorithm()
+            return [s.volume for s in sa.state]
+
+        expected = run(None)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as pool:
+            for volumes in pool.map(run, range(8)):
+                self.assertEqual(volumes, expected)
+
+    def test_multi_start(self):
+        rng = random.Random(6)
+        profile, sections = random_profile_spec(rng), random_sections(rng) + random_sections(rng)
+        results = []
+        for _ in range(2):
+            ms = MultiStartAnnealing(profile, [s.copy() for s in sections], DEFAULT_COEFFICIENTS, 0.98, 0.0005, 7, 16)
+            ms.run_algorithm()
+            results.append([s.volume for s in ms.state])
+            self.assertAlmostEqual(ms.final_cost, ms.cost_of(ms.state))
+            for start in (ms.lo_state(), ms.mid_state(), ms.hi_state()):
+                self.assertLessEqual(ms.final_cost, ms.cost_of(start))
+        self.assertEqual(results[0], results[1])
+
+    def test_cached_requirements(self):
+        profile = random_profile_spec(random.Random(8))
+        lo, hi = cached_nutritional_info_for(profile)
+        self.assertEqual((lo, hi), nutritional_info_for(profile))
+        lo.calories = -5
+        self.assertEqual(cached_nutritional_info_for(profile), nutritional_info_for(profile))
+        invalidate_requirements(profile)
+        profile.weight += 10
+        self.assertEqual(cached_nutritional_info_for(profile), nutritional_info_for(profile))
+
+    def test_quantized_requirements(self):
+        lo, hi = nutritional_info_for(random_profile_spec(random.Random(8)))
+        self.assertEqual(quantize_requirements(lo, hi), (lo, hi))
+        q_lo, q_hi = quantize_requirements(lo, hi, 1.02)
+        for exact, quantized in ((lo.vec, q_lo.vec), (hi.vec, q_hi.vec)):
+            self.assertTrue(np.array_equal(np.sign(exact), np.sign(quantized)))
+            finite = np.isfinite(exact) & (exact != 0)
+            self.assertLessEqual(np.abs(np.log(quantized[finite] / exact[finite])).max(), np.log(1.02) / 2 + 1e-12)
+
+    def test_requirements_for_many(self):
+        rng = random.Random(9)
+        profiles = [random_profile_spec(rng) for _ in range(50)]
+        for profile in profiles:
+            profile.birthdate += datetime.timedelta(days=rng.randint(-3000, 3000))
+        lo, hi = nutritional_info_for_many(*([getattr(p, name) for p in profiles] for name in
+                                             ('height', 'weight', 'birthdate', 'sex', 'health_goal', 'activity_level')))
+        for i, profile in enumerate(profiles):
+            expected_lo, expected_hi = nutritional_info_for(profile)
+            np.testing.assert_allclose(lo[i], expected_lo.vec)
+            np.testing.assert_allclose(hi[i], expected_hi.vec)
+
+    def test_convex_solver(self):
+        rng = random.Random(4)
+        for seed in range(10):
+            profile, sections = random_profile_spec(rng), random_sections(rng)
+            solver = ConvexPortionSolver(profile, [s.copy() for s in sections], DEFAULT_COEFFICIENTS)
+            solver.run_algorithm()
+            sa = SimulatedAnnealing(profile, [s.copy() for s in sections], DEFAULT_COEFFICIENTS, 0.999, 0.0005, seed)
+            sa.run_algorithm()
+            for s in solver.state:
+                self.assertTrue(s.min_volume <= s.volume <= s.max_volume)
+                if s.discrete:
+                    self.assertIsInstance(s.volume, int)
+            self.assertAlmostEqual(solver.final_cost, solver.cost_of(solver.state))
+            self.assertLessEqual(solver.final_cost, sa.final_cost * (1 + 1e-9) + 1e-9)
+
+    def test_convex_solver_bounds(self):
+        rng = random.Random(5)
+        for _ in range(10):
+            profile, sections = random_profile_spec(rng), random_sections(rng)
+            solver = ConvexPortionSolver(profile, sections, DEFAULT_COEFFICIENTS)
+            # The INF sentinels of the one-sided requirements are replaced by reachable totals
+            self.assertTrue(np.all(np.abs(solver._a_lo) < INF / 1e10))
+            self.assertTrue(np.all(np.abs(solver._a_hi) < INF / 1e10))
+            self.assertTrue(np.all(solver._a_lo <= solver._a_hi))
+
+    def test_least_squares_iteration_cap(self):
+        a = np.eye(4)
+        b = np.array([-1., 2., -3., 4.])
+        lo, hi = np.zeros(4), np.ones(4)
+        np.testing.assert_allclose(bounded_least_squares(a, b, lo, hi, np.full(4, .5)), [0, 1, 0, 1])
+        with self.assertLogs('backend.algorithm.convex', 'WARNING'):
+            bounded_least_squares(a, b, lo, hi, np.full(4, .5), max_iterations=0)
+
+
+def exhaustive_best_combination(costs: np.ndarray, choose: int):
+    best, best_cost = ((), (), ()), None
+    for comb in itertools.product(*(itertools.combinations(range(n), min(choose, n)) for n in costs.shape)):
+        cur_cost = sum(costs[x, y, z] for x, y, z in itertools.product(*comb))
+        if best_cost is None or cur_cost < best_cost:
+            best, best_cost = comb, cur_cost
+    return (*best, best_cost)
+
+
+class CombinationSearchTestCase(SimpleTestCase):
+    def test_matches_exhaustive(self):
+        rng = np.random.default_rng(20210226)
+        for _ in range(100):
+            shape = tuple(rng.integers(1, 6, size=3))
+            # Small integer costs so that there are lots of ties
+            costs = rng.integers(0, 4, size=shape).astype(float)
+            self.assertEqual(best_combination(costs, 3), exhaustive_best_combination(costs, 3))
+
+            costs = rng.random(size=shape) * 1000
+            *got, got_cost = best_combination(costs, 3)
+            *expected, expected_cost = exhaustive_best_combination(costs, 3)
+            self.assertEqual(got, expected)
+            self.assertAlmostEqual(got_cost, expected_cost)
+
+    def test_top_combinations(self):
+        rng = np.random.default_rng(20210301)
+        for _ in range(50):
+            shape = tuple(rng.integers(1, 7, size=3))
+            costs = rng.random(size=shape) * 1000
+            expected = sorted(
+                (sum(costs[x, y, z] for x, y, z in itertools.product(*comb)), comb)
+                for comb in itertools.product(*(itertools.combinations(range(n), min(3, n)) for n in shape)))[:5]
+            got = top_combinations(costs, 3, 5)
+            self.assertEqual([comb[:3] for comb in got], [comb for _, comb in expected])
+            for (*_, got_cost), (expected_cost, _) in zip(got, expected):
+                self.assertAlmostEqual(got_cost, expected_cost)
+            self.assertEqual(got[0][:3], best_combination(costs, 3)[:3])
+
+    def test_empty_section(self):
+        self.assertEqual(best_combination(np.zeros((0, 4, 5)), 3), ((), (0, 1, 2), (0, 1, 2), 0.))
+        self.assertFalse(pruned_triples(np.zeros((0, 4, 5)), np.zeros((0, 4, 5)), 3, 1).any())
+
+    def test_pruned_triples(self):
+        rng = np.random.default_rng(20210302)
+        num_pruned = 0
+        for _ in range(50):
+            shape = tuple(rng.integers(1, 7, size=3))
+            costs = rng.random(size=shape) ** 4 * 1000
+            lower, upper = costs * rng.random(size=shape), costs * (1 + rng.random(size=shape))
+            for count in (1, 3):
+                pruned = pruned_triples(lower, upper, 3, count)
+                for combination in top_combinations(costs, 3, count):
+                    self.assertFalse(pruned[np.ix_(*combination[:3])].any())
+                num_pruned += pruned.sum()
+        self.assertGreater(num_pruned, 0)
+
+    def test_triple_costs_bytes(self):
+        for shape, with_volumes in (((3, 4, 5), False), ((3, 4, 5), True), ((0, 2, 3), True)):
+            rng = np.random.default_rng(0)
+            obj = TripleCosts(large_ids=tuple(range(shape[0])),
+                              small1_ids=tuple(range(10, 10 + shape[1])),
+                              small2_ids=tuple(range(20, 20 + shape[2])),
+                              costs=rng.random(size=shape),
+                              volumes=rng.random(size=shape + (3,)) if with_volumes else None)
+            loaded = TripleCosts.from_bytes(obj.to_bytes())
+            self.assertEqual((loaded.large_ids, loaded.small1_ids, loaded.small2_ids),
+                             (obj.large_ids, obj.small1_ids, obj.small2_ids))
+            self.assertTrue(np.array_equal(loaded.costs, obj.costs))
+            if with_volumes:
+                self.assertTrue(np.array_equal(loaded.volumes, obj.volumes))
+                self.assertTrue(np.array_equal(loaded.without({0}).volumes, obj.volumes[1:]))
+            else:
+                self.assertIsNone(loaded.volumes)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TripleCostsCacheTestCase(SimpleTestCase):
+    def make_selector(self, profile, items):
+        # Without pruning, so that the number of annealed triples only depends on the cache
+        return MealItemSelector(profile, items, 610, 270, DEFAULT_COEFFICIENTS, 0.9, 0.01, 0,
+                                requirements=quantize_requirements(*nutritional_info_for(profile), 1.02),
+                                prune=False)
+
+    def test_cache_hit_and_invalidation(self):
+        rng = random.Random(3)
+        profile = random_profile_spec(rng)
+        items = synthetic_menu(rng, 4)
+
+        first = self.make_selector(profile, items)
+        run_meal_item_selector(-1, first)
+        self.assertEqual(first.num_annealed, 4 ** 3)
+
+        second = self.make_selector(profile, items)
+        run_meal_item_selector(-1, second)
+        self.assertEqual(second.num_annealed, 0)
+        self.assertEqual(second.result_obj(), first.result_obj())
+
+        # Changes to the meal keep the triple costs, only those of changed items are recomputed
+        invalidate_meal(-1)
+        third = self.make_selector(profile, items)
+        run_meal_item_selector(-1, third)
+        self.assertEqual(third.num_annealed, 0)
+
+        forget_triple_costs(-1, {items[0].id})
+        fourth = self.make_selector(profile, items)
+        run_meal_item_selector(-1, fourth)
+        self.assertEqual(fourth.num_annealed, 4 ** 2)
+
+        forget_triple_costs(-1)
+        fifth = self.make_selector(profile, items)
+        run_meal_item_selector(-1, fifth)
+        self.assertEqual(fifth.num_annealed, 4 ** 3)
+
+    def test_remove_meal_items(self):
+        rng = random.Random(7)
+        profile = random_profile_spec(rng)
+        items = synthetic_menu(rng, 4)
+        preferences = ItemPreferences()
+        alg = self.make_selector(profile, items)
+        run_meal_item_selector(-4, alg)
+        result = alg.result_obj()
+        set_suggestion(-4, 1, profile, preferences, 610, 270, result)
+
+        chosen = {item_id for section in result.values() for item_id in section['items']}
+        unused = [item.id for item in items if item.id not in chosen]
+        remove_meal_items(-4, unused[:1])
+        self.assertEqual(get_suggestion(-4, 1, profile, preferences, 610, 270), result)
+        remaining = [item for item in items if item.id != unused[0]]
+        alg = self.make_selector(profile, remaining)
+        run_meal_item_selector(-4, alg)
+        self.assertEqual(alg.num_annealed, 0)
+        self.assertEqual(alg.result_obj(), result)
+
+        remove_meal_items(-4, list(chosen)[:1])
+        self.assertIsNone(get_suggestion(-4, 1, profile, preferences, 610, 270))
+        # The triple costs of removed items are kept for when they're added back
+        alg = self.make_selector(profile, items)
+        run_meal_item_selector(-4, alg)
+        self.assertEqual(alg.num_annealed, 0)
+
+    def test_read_meal_cache(self):
+        profile, preferences = random_profile_spec(random.Random(11)), ItemPreferences()
+        entries = read_meal_cache(-6)
+        self.assertEqual((entries.meal_version, entries.triple_costs_version),
+                         (meal_version(-6), triple_costs_version(-6)))
+        set_suggestion(-6, 1, profile, preferences, 610, 270, {'stored': True}, entries)
+
+        # Everything the suggestion needs is read at once
+        entries = read_meal_cache(-6, [suggestion_key(-6, 1, 610, 270)])
+        with mock.patch.object(cache, 'get', side_effect=AssertionError), \
+                mock.patch.object(cache, 'get_many', side_effect=AssertionError):
+            self.assertEqual(get_suggestion(-6, 1, profile, preferences, 610, 270, entries), {'stored': True})
+            self.assertIn(entries.meal_version, meal_snapshot_key(-6, entries))
+        invalidate_meal(-6)
+        self.assertIsNone(get_suggestion(-6, 1, profile, preferences, 610, 270))
+
+    def test_meal_snapshot(self):
+        items = synthetic_menu(random.Random(4), 5)
+        items[0].category = None
+        snapshot = MealSnapshot.from_bytes(MealSnapshot.from_item_specs(items).to_bytes())
+        for item in items:
+            item.cafeteria_id = ''
+        self.assertEqual(snapshot.item_specs(), items)
+
+        key = meal_snapshot_key(-2)
+        self.assertIsNone(get_meal_snapshot(key))
+        set_meal_snapshot(key, snapshot)
+        self.assertIs(get_meal_snapshot(key), snapshot)
+        invalidate_meal(-2)
+        self.assertIsNone(get_meal_snapshot(meal_snapshot_key(-2)))
+
+    def test_item_preferences(self):
+        items = synthetic_menu(random.Random(5), 3)
+        snapshot = MealSnapshot.from_item_specs(items, [(items[0].id, 100), (items[1].id, 200), (items[2].id, 100)])
+        preferences = ItemPreferences(ban=frozenset([items[3].id]), favour=frozenset([items[8].id]),
+                                      allergies=frozenset([100, 300]))
+        self.assertEqual([item.id for item in snapshot.item_specs(preferences)],
+                         [items[8].id, items[1].id] + [item.id for item in items[4:8]])
+        self.assertEqual(len(snapshot.item_specs(ItemPreferences())), len(items))
+
+    def test_selector_from_snapshot(self):
+        rng = random.Random(12)
+        profile = random_profile_spec(rng)
+        items = synthetic_menu(rng, 4)
+        snapshot = MealSnapshot.from_item_specs(items)
+        preferences = ItemPreferences(ban=frozenset([items[0].id]), favour=frozenset([items[5].id]))
+
+        # The arrays of a snapshot give the same candidates, and selection, as its items
+        states = [PlateSectionState.from_item_spec(item, 610, 1, 'large') for item in items]
+        candidates = SectionCandidates.from_items(snapshot.portion_volumes, snapshot.max_pieces, snapshot.nutrients,
+                                                  610, 1)
+        expected = SectionCandidates.from_states(states)
+        for field in ('density', 'max_volume', 'min_volume', 'discrete'):
+            self.assertTrue(np.array_equal(getattr(candidates, field), getattr(expected, field)))
+
+        from_items, from_snapshot = (self.make_selector(profile, chosen)
+                                     for chosen in (snapshot.item_specs(preferences), snapshot.subset(preferences)))
+        from_items.run_algorithm()
+        from_snapshot.run_algorithm()
+        self.assertEqual(from_snapshot.result_obj(), from_items.result_obj())
+        self.assertTrue(np.array_equal(from_snapshot.triple_costs.costs, from_items.triple_costs.costs))
+
+    def test_subset_merging(self):
+        rng = random.Random(6)
+        profile = random_profile_spec(rng)
+        items = synthetic_menu(rng, 4)
+
+        subset = self.make_selector(profile, items[3:])
+        run_meal_item_selector(-3, subset)
+        self.assertEqual(subset.num_annealed, 3 ** 3)
+
+        full = self.make_selector(profile, items)
+        run_meal_item_selector(-3, full)
+        self.assertEqual(full.num_annealed, 4 ** 3 - 3 ** 3)
+
+        again = self.make_selector(profile, items[:3] + items[6:])
+        run_meal_item_selector(-3, again)
+        self.assertEqual(again.num_annealed, 0)
+
+    def test_favoured_items(self):
+        rng = random.Random(10)
+        profile = random_profile_spec(rng)
+        items = synthetic_menu(rng, 5)
+        plain = self.make_selector(profile, items)
+        plain.run_algorithm()
+        # Triple costs within 10% of each other, so that favouring any item makes it worth choosing
+        triple_costs = TripleCosts(plain.triple_costs.large_ids, plain.triple_costs.small1_ids,
+                                   plain.triple_costs.small2_ids,
+                                   costs=np.random.default_rng(10).uniform(1., 1.1, size=plain.triple_costs.costs.shape))
+
+        def selected(favoured):
+            alg = MealItemSelector(profile, items, 610, 270, DEFAULT_COEFFICIENTS, 0.9, 0.01, 0,
+                                   requirements=plain.requirements, triple_costs=triple_costs, favoured=favoured)
+            alg.run_algorithm()
+            self.assertEqual(alg.num_annealed, 0)
+            self.assertTrue(np.array_equal(alg.triple_costs.costs, triple_costs.costs))
+            return {item_id for section in alg.result_obj().values() for item_id in section['items']}
+
+        chosen = selected(frozenset())
+        for item in items:
+            if item.id not in chosen:
+                self.assertIn(item.id, selected(frozenset([item.id])))
+
+    def test_pruning(self):
+        rng = random.Random(8)
+        profile = random_profile_spec(rng)
+        items = synthetic_menu(rng, 6)
+        pruned = MealItemSelector(profile, items, 610, 270, DEFAULT_COEFFICIENTS, 0.9, 0.01, 0)
+        run_meal_item_selector(-5, pruned)
+        self.assertGreater(pruned.num_pruned, 0)
+        self.assertEqual(pruned.num_annealed + pruned.num_pruned, 6 ** 3)
+        self.assertEqual(np.isnan(pruned.triple_costs.costs).sum(), pruned.num_pruned)
+
+        # The pruned triples aren't cached, but they are pruned again instead of being annealed
+        again = MealItemSelector(profile, items, 610, 270, DEFAULT_COEFFICIENTS, 0.9, 0.01, 0)
+        run_meal_item_selector(-5, again)
+        self.assertEqual(again.num_annealed, 0)
+        self.assertEqual(again.result_obj(), pruned.result_obj())
+
+
+class BlockingAlgorithm:
+    def __init__(self):
+        self.release = threading.Event()
+
+    def run_algorithm(self):
+        self.release.wait(10)
+
+
+class CrashingAlgorithm:
+    def run_algorithm(self):
+        os._exit(1)
+
+
+class ExecutorTestCase(SimpleTestCase):
+    def test_runs_algorithm(self):
+        rng = random.Random(11)
+        profile, sections = random_profile_spec(rng), random_sections(rng)
+        for kind in (INLINE, THREAD, PROCESS):
+            executor = AlgorithmExecutor(kind, max_workers=1, max_queue=0, timeout=10)
+            alg = executor.run(SimulatedAnnealing(profile, sections, DEFAULT_COEFFICIENTS, 0.9, 0.01, 0))
+            self.assertTrue(alg.done)
+            self.assertAlmostEqual(alg.final_cost, alg.cost_of(alg.state))
+            if executor.pool is not None:
+                executor.pool.shutdown()
+
+    def test_timeout_and_full_queue(self):
+        executor = AlgorithmExecutor(THREAD, max_workers=1, max_queue=0, timeout=0.05)
+        slow = BlockingAlgorithm()
+        with self.assertRaises(AlgorithmUnavailable):
+            executor.run(slow)
+        # The timed out algorithm still holds the only slot
+        with self.assertRaises(AlgorithmUnavailable):
+            executor.run(BlockingAlgorithm())
+
+        slow.release.set()
+        executor.pool.submit(int).result()  # Queued behind the slow algorithm
+        fast = BlockingAlgorithm()
+        fast.release.set()
+        self.assertIs(executor.run(fast), fast)
+        executor.pool.shutdown()
+
+    def test_broken_process_pool(self):
+        executor = AlgorithmExecutor(PROCESS, max_workers=1, max_queue=1, timeout=10)
+        broken = executor.pool
+        with self.assertRaises(AlgorithmUnavailable):
+            executor.run(CrashingAlgorithm())
+        # The pool is replaced
+        self.assertIsNot(executor.pool, broken)
+        rng = random.Random(12)
+        alg = executor.run(SimulatedAnnealing(random_profile_spec(rng), random_sections(rng), DEFAULT_COEFFICIENTS,
+                                              0.9, 0.01, 0))
+        self.assertTrue(alg.done)
+        executor.pool.shutdown()
+
+    def test_selector_time_budget(self):
+        rng = random.Random(13)
+        profile, items = random_profile_spec(rng), synthetic_menu(rng, 4)
+        for time_budget in (None, 0):
+            trace = AnnealingTrace()
+            alg = MealItemSelector(profile, items, 610, 270, DEFAULT_COEFFICIENTS, 0.9, 0.01, 0, trace=trace,
+                                   share_scales=(0.75,), time_budget=time_budget)
+            alg.run_algorithm()
+            # Out of time, the triples keep their starting volumes
+            self.assertEqual(trace.counters['proposed'] == 0, time_budget == 0)
+            self.assertEqual(len(alg.shares_obj()), 1)
+
+
+class DayPlanTestCase(SimpleTestCase):
+    def test_best_day_plan(self):
+        rng = np.random.default_rng(20210303)
+        for num_slots in range(1, 5):
+            options = share_options(num_slots)
+            self.assertIn(DAY_PLAN_UNITS // num_slots, options)
+            for _ in range(20):
+                costs = [rng.random(size=(rng.integers(1, 4), len(options))) for _ in range(num_slots)]
+                expected = min((sum(slot_costs[i, k] for slot_costs, (i, k) in zip(costs, plan)), plan)
+                               for plan in itertools.product(*(itertools.product(range(len(slot_costs)),
+                                                                                 range(len(options)))
+                                                               for slot_costs in costs))
+                               if sum(options[k] for _, k in plan) == DAY_PLAN_UNITS)
+                plan, cost = best_day_plan(costs, options)
+                self.assertEqual(plan, list(expected[1]))
+                self.assertAlmostEqual(cost, expected[0])
+        self.assertIsNone(best_day_plan([], share_options(1)))
+        options = share_options(2)
+        self.assertIsNone(best_day_plan([np.full((2, len(options)), np.inf), np.ones((1, len(options)))], options))
+
+    def test_share_scales(self):
+        rng = random.Random(9)
+        profile, items = random_profile_spec(rng), synthetic_menu(rng, 4)
+        plain = MealItemSelector(profile, items, 610, 270, DEFAULT_COEFFICIENTS, 0.9, 0.01, 0)
+        plain.run_algorithm()
+        alg = MealItemSelector(profile, items, 610, 270, DEFAULT_COEFFICIENTS, 0.9, 0.01, 0,
+                               triple_costs=plain.triple_costs, share_scales=(1., 1.5))
+        alg.run_algorithm()
+        # Only the triples the plain run pruned are annealed, and re-scoring for the same requirements gives the same
+        # selection
+        self.assertGreater(plain.num_pruned, 0)
+        self.assertEqual(alg.num_annealed, plain.num_pruned)
+        self.assertEqual(alg.shares_obj()[0], alg.result_obj())
+        self.assertAlmostEqual(alg.share_result_costs[0] / alg.result_cost, 1)
+        self.assertNotAlmostEqual(alg.share_result_costs[1] / alg.result_cost, 1)
+
+        # The volumes of every triple are kept, so the next run doesn't anneal from scratch
+        again = MealItemSelector(profile, items, 610, 270, DEFAULT_COEFFICIENTS, 0.9, 0.01, 0,
+                                 triple_costs=alg.triple_costs, share_scales=(1., 1.5))
+        again.run_algorithm()
+        self.assertEqual(again.num_annealed, 0)
+        self.assertEqual(again.shares_obj(), alg.shares_obj())
+        self.assertEqual(again.share_result_costs, alg.share_result_costs)
+
+    def test_share_costs_against_annealing(self):
+        # Starting from the scaled best volumes should be about as good as annealing for the scaled requirements from
+        # scratch (scaling the volumes alone can be hundreds of times worse)
+        rng = random.Random(2)
+        ratios = []
+        for profile in synthetic_profiles(rng, 5):
+            items = synthetic_menu(rng, 4)
+            lo, hi = nutritional_info_for(profile)
+            alg = MealItemSelector(profile, items, 610, 270, DEFAULT_COEFFICIENTS, 0.9, 0.01, 0, requirements=(lo, hi),
+                                   share_scales=(0.75, 1.25))
+            alg.run_algorithm()
+            for scale, cost in zip(alg.share_scales, alg.share_result_costs):
+                cold = MealItemSelector(profile, items, 610, 270, DEFAULT_COEFFICIENTS, 0.9, 0.01, 0,
+                                        requirements=(Nutrition(lo.vec * scale), Nutrition(hi.vec * scale)))
+                cold.run_algorithm()
+                ratios.append(cost / cold.result_cost)
+        self.assertLessEqual(np.median(ratios), 1.)
+        self.assertLess(max(ratios), 20.)
+
+
+class BenchmarkTestCase(SimpleTestCase):
+    def test_synthetic_data_is_reproducible(self):
+        self.assertEqual(synthetic_menu(random.Random(1), 3), synthetic_menu(random.Random(1), 3))
+        profiles = synthetic_profiles(random.Random(1), 10)
+        self.assertEqual(profiles, synthetic_profiles(random.Random(1), 10))
+        self.assertEqual(len({profile.health_goal for profile in profiles}), 5)
+
+    def test_run_benchmarks(self):
+        results = json.loads(json.dumps(run_benchmarks(seed=1, portion_sizes=(1,), menu_sizes=(2,), runs=2)))
+        self.assertEqual(len(results['portions']), 3)
+        for res in results['portions'] + results['item_selector']:
+            self.assertEqual(res['runs'], 2)
+            self.assertLessEqual(res['runtime']['p50'], res['runtime']['max'])
+        self.assertEqual(len(compare_results(results, results)), 5)
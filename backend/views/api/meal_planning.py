@@ -1,14 +1,19 @@
 from rest_framework import viewsets, serializers
 from rest_framework.authentication import SessionAuthentication, TokenAuthentication
 from rest_framework.decorators import action
+from rest_framework.exceptions import APIException
 from rest_framework.generics import get_object_or_404
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.request import Request
 from rest_framework.response import Response
 
-from backend.algorithm.integration import meal_item_selector_from_model, simulated_annealing_from_model, \
-    result_object_for_simulated_annealing
-from backend.algorithm.requirements import nutritional_info_for
+from backend.algorithm.cache import run_meal_item_selector, get_suggestion, set_suggestion, read_meal_cache, \
+    suggestion_key
+from backend.algorithm.executor import get_executor, AlgorithmUnavailable
+from backend.algorithm.integration import meal_item_selector_from_model, portion_optimizer_from_model, \
+    result_object_for_portion_optimizer, student_profile_spec_from_model, PORTION_ENGINES, MULTI_START, \
+    item_preferences_from_model, sampled_trace, day_plan_from_model, meal_snapshot_from_model
+from backend.algorithm.requirements import cached_nutritional_info_for
 from backend.models import StudentProfile, MealItem, MealSelection
 from backend.utils import IsStudent
 
@@ -19,7 +24,7 @@ class NutritionalRequirementsViewSet(viewsets.ViewSet):
 
     def list(self, request):
         profile = StudentProfile.objects.get(user=request.user)
-        lo, hi = nutritional_info_for(profile)
+        lo, hi = cached_nutritional_info_for(profile)
         return Response({
             'lo': lo.as_dict(),
             'hi': hi.as_dict()
@@ -32,17 +37,36 @@ class PortionRequestSerializer(serializers.Serializer):
     large = serializers.PrimaryKeyRelatedField(queryset=MealItem.objects.all(), many=True)
     large_max_volume = serializers.FloatField()
     small_max_volume = serializers.FloatField()
+    engine = serializers.ChoiceField(choices=PORTION_ENGINES, default=MULTI_START)
 
 
 class ChoiceRequestSerializer(serializers.Serializer):
     large_max_volume = serializers.FloatField()
     small_max_volume = serializers.FloatField()
+    alternatives = serializers.IntegerField(default=0, min_value=0, max_value=10)
+
+
+class DayPlanRequestSerializer(serializers.Serializer):
+    date = serializers.DateField()
+    large_max_volume = serializers.FloatField()
+    small_max_volume = serializers.FloatField()
+
+
+class SuggestionUnavailable(APIException):
+    status_code = 503
+    default_detail = 'The server is busy computing suggestions, please try again later'
+    default_code = 'algorithm_unavailable'
 
 
 class SuggestViewSet(viewsets.ViewSet):
     authentication_classes = [SessionAuthentication, TokenAuthentication]
     permission_classes = [IsAuthenticated, IsStudent]
 
+    def handle_exception(self, exc):
+        if isinstance(exc, AlgorithmUnavailable):
+            exc = SuggestionUnavailable(str(exc))
+        return super().handle_exception(exc)
+
     def list(self, _):
         return Response({'detail': 'page either suggest/<meal_id>/items or suggest/portions!'})
 
@@ -56,12 +80,38 @@ class SuggestViewSet(viewsets.ViewSet):
         profile = StudentProfile.objects.get(user=request.user)
         ser = ChoiceRequestSerializer(data=request.query_params)
         ser.is_valid(raise_exception=True)
-
-        alg = meal_item_selector_from_model(meal, profile, ser.validated_data['large_max_volume'],
-                                            ser.validated_data['small_max_volume'])
-        alg.run_algorithm()
-
-        return Response(alg.result_obj())
+        large_max_volume = ser.validated_data['large_max_volume']
+        small_max_volume = ser.validated_data['small_max_volume']
+        num_alternatives = ser.validated_data['alternatives']
+
+        profile_spec = student_profile_spec_from_model(profile)
+        preferences = item_preferences_from_model(profile)
+        if num_alternatives:
+            # Alternatives aren't stored with the suggestions, but the triple costs are still reused
+            entries = read_meal_cache(meal.id)
+            alg = meal_item_selector_from_model(meal, profile, large_max_volume, small_max_volume, preferences,
+                                                meal_snapshot_from_model(meal, entries),
+                                                num_alternatives=num_alternatives, trace=sampled_trace())
+            alg = run_meal_item_selector(meal.id, alg, entries)
+            if alg.trace is not None:
+                alg.trace.log(f'MealItemSelector (meal {meal.id})')
+            return Response({**alg.result_obj(), 'alternatives': alg.alternatives_obj()})
+
+        # Suggestions are usually precomputed by the precompute_suggestions job.  The cache entries the request needs
+        # are read at once
+        entries = read_meal_cache(meal.id, (suggestion_key(meal.id, profile.id, large_max_volume, small_max_volume),))
+        if (result := get_suggestion(meal.id, profile.id, profile_spec, preferences,
+                                     large_max_volume, small_max_volume, entries)) is None:
+            alg = meal_item_selector_from_model(meal, profile, large_max_volume, small_max_volume, preferences,
+                                                meal_snapshot_from_model(meal, entries), trace=sampled_trace())
+            alg = run_meal_item_selector(meal.id, alg, entries)
+            if alg.trace is not None:
+                alg.trace.log(f'MealItemSelector (meal {meal.id})')
+            result = alg.result_obj()
+            set_suggestion(meal.id, profile.id, profile_spec, preferences, large_max_volume, small_max_volume, result,
+                           entries)
+
+        return Response(result)
 
     @action(methods=['get'], detail=False)
     def portions(self, request: Request):
@@ -72,9 +122,28 @@ class SuggestViewSet(viewsets.ViewSet):
         small2 = req_ser.validated_data['small2']
         large = req_ser.validated_data['large']
 
-        algo = simulated_annealing_from_model(profile, large, small1, small2,
-                                              req_ser.validated_data['large_max_volume'],
-                                              req_ser.validated_data['small_max_volume'])
-        algo.run_algorithm()
+        algo = portion_optimizer_from_model(profile, large, small1, small2,
+                                            req_ser.validated_data['large_max_volume'],
+                                            req_ser.validated_data['small_max_volume'],
+                                            req_ser.validated_data['engine'],
+                                            trace=sampled_trace())
+        algo = get_executor().run(algo)
+        if algo.trace is not None:
+            algo.trace.log(type(algo).__name__)
+
+        return Response(result_object_for_portion_optimizer(algo))
+
+    @action(methods=['get'], detail=False)
+    def day(self, request: Request):
+        profile = StudentProfile.objects.get(user=request.user)
+        ser = DayPlanRequestSerializer(data=request.query_params)
+        ser.is_valid(raise_exception=True)
+        date = ser.validated_data['date']
 
-        return Response(result_object_for_simulated_annealing(algo))
+        meals = MealSelection.objects.filter(school=profile.school, group__in=profile.meals, timestamp__year=date.year,
+                                             timestamp__month=date.month, timestamp__day=date.day).order_by('timestamp')
+        return Response({
+            'date': date.isoformat(),
+            'meals': day_plan_from_model(profile, list(meals), ser.validated_data['large_max_volume'],
+                                         ser.validated_data['small_max_volume'], item_preferences_from_model(profile))
+        })
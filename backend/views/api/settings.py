@@ -5,6 +5,7 @@ from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 
+from backend.algorithm.requirements import invalidate_requirements
 from backend.models import StudentProfile, MealItem, Ingredient
 from backend.utils import IsStudent, update_object
 
@@ -47,6 +48,7 @@ class SettingsViewSet(viewsets.ViewSet):
         serialized_data = UpdateSettingsSerializer(data=request.data, partial=True)
         serialized_data.is_valid(raise_exception=True)
         profile = StudentProfile.objects.get(user=request.user)
+        invalidate_requirements(profile)
         upd = update_object(serialized_data, profile)
 
         return Response({'detail': f'Updated fields {upd}'})
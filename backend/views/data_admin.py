@@ -11,8 +11,12 @@ from django.http import HttpResponse, HttpResponsePermanentRedirect
 from django.shortcuts import render
 from django.urls import path
 
-from backend.algorithm.item_choice import PlateSection, MealItemSelector
-from backend.algorithm.portion import SimulatedAnnealing
+from backend.algorithm.common import NUTRIENTS
+from backend.algorithm.integration import meal_item_selector_from_model, item_preferences_from_model, \
+    portion_optimizer_from_model, PORTION_ENGINES, ANNEALING
+from backend.algorithm.item_choice import PlateSection
+from backend.algorithm.portion import nutrition_of
+from backend.algorithm.telemetry import AnnealingTrace
 from backend.models import School, StudentProfile, MealSelection, MealItem, Ingredient, ImageQueueEntry
 from backend.views.jobs import get_job_results
 
@@ -110,6 +114,12 @@ class AlgorithmTestPortionsForm(forms.Form):
         label='Profile (ID)',
         required=True,
     )
+    engine = forms.ChoiceField(
+        label='Engine',
+        choices=tuple((engine, engine) for engine in PORTION_ENGINES),
+        initial=ANNEALING,
+        required=True,
+    )
 
     def __init__(self, *args, **kwargs):
         result = kwargs.pop('result', None)
@@ -146,17 +156,23 @@ def test_algorithm_choices(request):
             profile: StudentProfile = form.cleaned_data['profile']
             meal: MealSelection = form.cleaned_data['meal']
             plate_sizes: tuple[float, float] = form.cleaned_data['plate_sizes']
-            alg = MealItemSelector(meal, profile, plate_sizes[0], plate_sizes[1])
+            # Runs without the triple costs cache, so that every triple is annealed and traced
+            alg = meal_item_selector_from_model(meal, profile, plate_sizes[0], plate_sizes[1],
+                                                item_preferences_from_model(profile), trace=AnnealingTrace())
             alg.run_algorithm()
 
             portions_form = AlgorithmTestPortionsForm({
                 'plate_sizes': f'{plate_sizes[0]},{plate_sizes[1]}',
-                'profile': profile.id
-            }, result=alg._result_obj)
+                'profile': profile.id,
+                'engine': ANNEALING
+            }, result=alg.result_obj())
 
             return render(request, 'data_admin/test_algorithm_choices.html', {
                 'choices_form': form,
-                'portions_form': portions_form
+                'portions_form': portions_form,
+                'cost': alg.result_cost,
+                'runtime': alg.runtime,
+                'trace': alg.trace.as_dict()
             })
     else:
         return render(request, 'data_admin/test_algorithm_choices.html', {
@@ -174,11 +190,13 @@ def test_algorithm_portions(request):
         small2 = form.cleaned_data['small2']
         plate_sizes = form.cleaned_data['plate_sizes']
 
-        sa = SimulatedAnnealing(profile, large, small1, small2, *plate_sizes)
+        sa = portion_optimizer_from_model(profile, [large], [small1], [small2], *plate_sizes,
+                                          engine=form.cleaned_data['engine'], trace=AnnealingTrace())
         sa.run_algorithm()
-        got_info = sa.nutrition_of(sa.state)
-        lo_info = sa.nutrition_of(sa.lo_state())
-        hi_info = sa.nutrition_of(sa.hi_state())
+        got_info = nutrition_of(sa.state).as_dict()
+        lo_info = nutrition_of(sa.lo_state()).as_dict()
+        hi_info = nutrition_of(sa.hi_state()).as_dict()
+        lo_req, hi_req = sa.lo_req.as_dict(), sa.hi_req.as_dict()
 
         return render(request, 'data_admin/test_algorithm_portions.html', {
             'form': form,
@@ -187,23 +205,19 @@ def test_algorithm_portions(request):
             'large': large,
             'small1': small1,
             'small2': small2,
-            'info': [(k, v1, v2, v3, v4, v5) for (k, v1), (_, v2), (__, v3), (___, v4), (____, v5) in
-                     zip(sa.lo_req.as_dict().items(), sa.hi_req.as_dict().items(), got_info.as_dict().items(),
-                         lo_info.as_dict().items(),
-                         hi_info.as_dict().items())
-                     if k != '_state' and k != 'id' and k != 'name'],
+            'info': [(k, lo_req[k], hi_req[k], got_info[k], lo_info[k], hi_info[k]) for k in NUTRIENTS],
             'cost': sa.final_cost,
             'runtime': sa.runtime,
-            'large_size': sa.large_volume,
-            'small1_size': sa.small1_volume,
-            'small2_size': sa.small2_volume,
+            'iterations': sa.iterations,
+            'stop_reason': sa.stop_reason,
+            'sizes': [(s.section_name, s.format_volume()) for s in sa.state],
+            'trace': sa.trace.as_dict(),
         })
     else:
         return render(request, 'data_admin/test_algorithm_portions.html', {
             'form': form,
             'error': form.errors
         })
-    # TODO: rewrite_this
 
 
 @data_admin_view
@@ -296,7 +310,7 @@ def add_school_account(request):
 
 class SelectJobForm(forms.Form):
     job = forms.ChoiceField(choices=(
-        (f'/jobs/{job}/', job) for job in ('clear_tokens', 'clear_cache', 'send_push')
+        (f'/jobs/{job}/', job) for job in ('clear_tokens', 'clear_cache', 'send_push', 'precompute_suggestions')
     ))
 
 
@@ -1,5 +1,7 @@
 import datetime
 import functools
+import logging
+import time
 from dataclasses import dataclass
 
 import pytz
@@ -9,14 +11,22 @@ from django.core.cache import cache
 from django.core.handlers.wsgi import WSGIRequest
 from django.http import HttpResponse, HttpResponseForbidden
 from django.urls import path
+from django.utils import timezone
 from rest_framework.authtoken.models import Token
 
-from backend.models import MealSelection
+from backend.algorithm.cache import run_meal_item_selector, get_suggestion, set_suggestion, read_meal_cache, \
+    suggestion_key
+from backend.algorithm.executor import AlgorithmUnavailable
+from backend.algorithm.integration import meal_item_selector_from_model, meal_snapshot_from_model, \
+    student_profile_spec_from_model, item_preferences_from_model
+from backend.models import MealSelection, StudentProfile
 from backend.models.token import ExpoPushToken
 
 JOB_LOG_CACHE_KEY = 'job_log'
 PUSH_LAST_MEAL_CACHE_KEY = 'last_meal_push_notifed'
 
+logger = logging.getLogger(__name__)
+
 
 @dataclass
 class JobResult:
@@ -107,8 +117,63 @@ def send_push(_):
     return HttpResponse('No next meal found or push notification already sent for next meal')
 
 
+@appengine_job
+def precompute_suggestions(_):
+    """
+    Computes and stores the item suggestions of every verified student for every meal they eat (see
+    StudentProfile.meals) of their school that starts within settings.SUGGESTION_PRECOMPUTE_WINDOW, so that
+    SuggestViewSet.items doesn't have to compute them during the meal rush.  Soonest meals first, until every suggestion
+    is stored or the run has taken settings.SUGGESTION_PRECOMPUTE_TIME_LIMIT, the rest are left to the next runs.
+    Suggestions that can't be computed right now (see AlgorithmUnavailable) are skipped.  How many failed or are left is
+    logged
+    """
+    now = timezone.now()
+    deadline = time.perf_counter() + settings.SUGGESTION_PRECOMPUTE_TIME_LIMIT
+    meals = MealSelection.objects.filter(timestamp__gt=now,
+                                         timestamp__lte=now + datetime.timedelta(
+                                             seconds=settings.SUGGESTION_PRECOMPUTE_WINDOW)).order_by('timestamp')
+
+    def missing_suggestions():
+        for meal in meals:
+            profiles = [profile for profile in StudentProfile.objects.filter(school=meal.school, is_verified=True)
+                        .prefetch_related('ban', 'favour', 'allergies') if meal.group in profile.meals]
+            # The meal's versions and stored suggestions are read at once
+            entries = read_meal_cache(meal.id, [suggestion_key(meal.id, profile.id, *plate_size) for profile in profiles
+                                                for plate_size in settings.SUGGESTION_PRECOMPUTE_PLATE_SIZES])
+            snapshot = meal_snapshot_from_model(meal, entries)
+            for profile in profiles:
+                profile_spec = student_profile_spec_from_model(profile)
+                preferences = item_preferences_from_model(profile)
+                for large_max_volume, small_max_volume in settings.SUGGESTION_PRECOMPUTE_PLATE_SIZES:
+                    if get_suggestion(meal.id, profile.id, profile_spec, preferences,
+                                      large_max_volume, small_max_volume, entries) is None:
+                        yield meal, snapshot, entries, profile, profile_spec, preferences, large_max_volume, \
+                            small_max_volume
+
+    count, failed, left = 0, 0, 0
+    for meal, snapshot, entries, profile, profile_spec, preferences, large_max_volume, small_max_volume in \
+            missing_suggestions():
+        if time.perf_counter() >= deadline:
+            left += 1
+            continue
+        alg = meal_item_selector_from_model(meal, profile, large_max_volume, small_max_volume, preferences, snapshot)
+        try:
+            alg = run_meal_item_selector(meal.id, alg, entries)
+        except AlgorithmUnavailable:
+            failed += 1
+            continue
+        set_suggestion(meal.id, profile.id, profile_spec, preferences, large_max_volume, small_max_volume,
+                       alg.result_obj(), entries)
+        count += 1
+
+    message = f'Precomputed {count} suggestions for {len(meals)} meals, {failed} failed, {left} left'
+    logger.log(logging.WARNING if failed or left else logging.INFO, message)
+    return HttpResponse(message)
+
+
 urlpatterns = [
     path('clear_tokens/', clear_tokens, name='clear_tokens'),
     path('clear_cache/', clear_cache, name='clear cache'),
     path('send_push/', send_push, name='send_push'),
+    path('precompute_suggestions/', precompute_suggestions, name='precompute_suggestions'),
 ]
\ No newline at end of file
@@ -29,7 +29,8 @@ env = environ.Env(
     DEBUG=(bool, True),
     SECRET_KEY=(str, 'django-insecure-h1#o@85ph_lx=$*pcdfo$=w^m_ayh6tl($9&ceftmzncu+d5fp'),
     PROD=(bool, False),
-    GS_BUCKET_NAME=(str, '')
+    GS_BUCKET_NAME=(str, ''),
+    ALGORITHM_EXECUTOR=(str, 'inline')
 )
 env_file = os.environ.get('ENV_FILE', '.env')
 SETTINGS_LOG_MSG.append(('.env file', env_file))
@@ -174,6 +175,61 @@ SENDGRID_API_KEY = 'SG.kzdp4We8Rgu_tOKNK_Zf0g.xTgaGKDwAya4zovB3KhF-LaAsE5BO_TlSL
 # Job related things
 JOB_LOG_MAX_SIZE = 1000
 
+# Algorithm result caching
+TRIPLE_COSTS_CACHE_TIMEOUT = 6 * 60 * 60  # Seconds
+TRIPLE_COSTS_LOCAL_CACHE_SIZE = 32  # Entries kept in memory by each worker
+MEAL_SNAPSHOT_CACHE_TIMEOUT = 24 * 60 * 60  # Seconds
+MEAL_SNAPSHOT_LOCAL_CACHE_SIZE = 64  # Entries kept in memory by each worker
+SUGGESTION_CACHE_TIMEOUT = 12 * 60 * 60  # Seconds
+# Students whose requirements round to the same powers of this ratio share triple costs and suggestions (see
+# backend.algorithm.requirements.quantize_requirements), at the cost of bounds off by up to ~1% for 1.02.  None
+# keeps every student's requirements exact
+REQUIREMENT_BUCKET_RATIO = None
+SUGGESTION_PRECOMPUTE_WINDOW = 3 * 60 * 60  # Seconds, suggestions are precomputed for meals starting this soon
+SUGGESTION_PRECOMPUTE_PLATE_SIZES = ((610, 270), (800, 400))  # (large, small) section sizes, in mL
+# Seconds a run of the precompute_suggestions job may spend, below the 10 minute limit of App Engine cron requests
+SUGGESTION_PRECOMPUTE_TIME_LIMIT = 8 * 60
+
+# Where the algorithms run, see backend.algorithm.executor
+ALGORITHM_EXECUTOR = env('ALGORITHM_EXECUTOR')  # 'inline', 'thread' or 'process'
+ALGORITHM_EXECUTOR_WORKERS = 2
+ALGORITHM_EXECUTOR_MAX_QUEUE = 8
+ALGORITHM_TIMEOUT = 20  # Seconds, algorithms still running after it keep their worker until they finish
+
+# Limits of the portion algorithm, see backend.algorithm.portion.SimulatedAnnealing.  None means no limit
+PORTION_TIME_BUDGET = 2  # Seconds
+PORTION_PLATEAU_STEPS = None
+# 'geometric' or 'adaptive'.  The adaptive schedule takes fewer steps but ends up worse on some plates, see
+# backend.algorithm.benchmark
+PORTION_SCHEDULE = 'geometric'
+
+# Limit of the item selecting algorithm, see backend.algorithm.item_choice.MealItemSelector
+ITEM_SELECTOR_TIME_BUDGET = 10  # Seconds, below ALGORITHM_TIMEOUT so that selectors give their worker back in time
+
+# Fraction of the algorithm runs of the suggest endpoints that are traced and logged, see
+# backend.algorithm.telemetry.AnnealingTrace
+ALGORITHM_TRACE_SAMPLE_RATE = 0.01
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'backend.algorithm': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+        'backend.views.jobs': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+    },
+}
+
 # Versioning
 BACKEND_VERSION = '1.0.0'
 MAINTENANCE = True